@@ -0,0 +1,216 @@
+'''
+Stage benchmarks on synthetic universes.
+
+    python -m benchmarks.run run --scales 190 3000 10000 --bars 150 --interval 1d
+    python -m benchmarks.run run --scales 190 --bars 1950 --interval 1m --stages convert resample indicators
+    python -m benchmarks.run compare benchmarks/results/before.json benchmarks/results/after.json
+
+Every stage is timed `--repeat` times on inputs prepared outside the timing (best and all wall
+times, CPU time of the best run), then run once more under tracemalloc for the peak of Python
+and numpy allocations. Results go to one JSON file per run together with the commit and library
+versions; `compare` matches stages by (stage, tickers, bars, interval) and exits with 1 when a
+stage got slower or bigger by more than `--threshold`.
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from benchmarks.universe import SyntheticUniverse
+from common.chunked_reader import ChunkedReader
+from common.storage import get_storage
+from core import resample
+from core.backtester import Backtester
+from core.data_collector import DataCollector
+from core.indicators import IndicatorCalculator
+from core.rules import DEFAULT_RULES, RuleSet
+from core.strategies import Strategies
+
+
+STAGES = ['convert', 'convert_list', 'resample', 'indicators', 'levels', 'strategies', 'backtest', 'write', 'read']
+
+
+class StageBench:
+    '''prepares the inputs of one universe lazily and hands out a callable per stage'''
+    def __init__(self, universe:SyntheticUniverse, prop_file:str, tmp_dir:str):
+        self.universe = universe
+        self.prop_file = prop_file
+        self.tmp_dir = tmp_dir
+        self.calculator = IndicatorCalculator(prop_file)
+        self.strategies = Strategies(prop_file=prop_file)
+        self.collector = DataCollector(interval=universe.interval, period='', use_combine_interval=False,
+                                       combine_interval=1, start_date='', end_date='')
+        self.inputs = dict()
+
+    def input(self, name:str):
+        if name not in self.inputs:
+            if name == 'download':
+                self.inputs[name] = self.universe.download_frame()
+            elif name == 'history':
+                self.inputs[name] = self.collector.convert_data_frame(self.input('download'))
+            elif name == 'indicators':
+                self.inputs[name] = self.calculator.ema_supertrend_calculator(self.input('history').copy())
+            elif name == 'stored':
+                path = self.calculator.storage.path_for(directory=self.tmp_dir, startswith='bench-')
+                self.calculator.storage.write(self.input('indicators'), path)
+                self.inputs[name] = path
+        return self.inputs[name]
+
+    def stage(self, name:str):
+        '''(callable, rows) or None when the stage does not apply to this universe'''
+        if name == 'convert':
+            df = self.input('download')
+            return (lambda: self.collector.convert_data_frame(df)), self.universe.n_tickers * df.shape[0]
+        if name == 'convert_list':
+            df = self.input('download')
+            return (lambda: self.collector.convert_data_list(df)), self.universe.n_tickers * df.shape[0]
+        if name == 'resample':
+            if not self.universe.market.is_intraday(self.universe.interval):
+                return None
+            df = self.input('download')
+            return (lambda: resample.aggregate(df, *resample.time_bounds(df['Date'], rule='30min'))), \
+                self.universe.n_tickers * df.shape[0]
+        if name == 'indicators':
+            df = self.input('history')
+            return (lambda: self.calculator.ema_supertrend_calculator(df.copy())), df.shape[0]
+        if name == 'levels':
+            df = self.input('indicators')
+            return (lambda: self.calculator.levels_calculator(df)), df.shape[0]
+        if name == 'strategies':
+            df = self.input('indicators')
+            today = self.universe.market.end + pd.Timedelta(days=1)
+            return (lambda: self.strategies.compute(df, today=today)), df.shape[0]
+        if name == 'backtest':
+            df = self.input('indicators')
+            backtester = Backtester(RuleSet(self.strategies.p_reader.strategy_rules or DEFAULT_RULES), fee_bps=5)
+            return (lambda: backtester.run(df)), df.shape[0]
+        if name == 'write':
+            df = self.input('indicators')
+            path = self.calculator.storage.path_for(directory=self.tmp_dir, startswith='bench-write-')
+            return (lambda: self.calculator.storage.write(df, path)), df.shape[0]
+        if name == 'read':
+            path = self.input('stored')
+            return (lambda: ChunkedReader(path).read()), self.input('indicators').shape[0]
+        raise ValueError('unknown stage ' + name + ', expected one of ' + ', '.join(STAGES))
+
+
+def measure(func, repeat:int) -> dict:
+    walls, cpus = list(), list()
+    for _ in range(max(repeat, 1)):
+        wall, cpu = time.perf_counter(), time.process_time()
+        func()
+        walls.append(time.perf_counter() - wall)
+        cpus.append(time.process_time() - cpu)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    best = int(np.argmin(walls))
+    return {'wall_sec': walls[best], 'wall_all_sec': walls, 'cpu_sec': cpus[best], 'peak_mb': peak / 2 ** 20}
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__,
+            'pandas': pd.__version__, 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'created': datetime.now().isoformat(timespec='seconds')}
+
+
+def run(args) -> str:
+    results = list()
+    tmp_dir = tempfile.mkdtemp(prefix='bench-')
+    try:
+        for n_tickers in args.scales:
+            universe = SyntheticUniverse(n_tickers, args.bars, interval=args.interval, seed=args.seed)
+            bench = StageBench(universe, args.conf, tmp_dir)
+            for name in args.stages:
+                stage = bench.stage(name)
+                if stage is None:
+                    continue
+                func, rows = stage
+                result = {'stage': name, **universe.describe(), 'stage_rows': rows}
+                result.update(measure(func, args.repeat))
+                results.append(result)
+                print('%-12s %6d tickers x %5d bars  %8.3fs  cpu %8.3fs  peak %9.1f MB'
+                      % (name, n_tickers, args.bars, result['wall_sec'], result['cpu_sec'], result['peak_mb']))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    out = args.out
+    if out is None:
+        label = args.label or datetime.now().strftime('%Y_%m_%d_%H%M%S')
+        out = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', label + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as writer:
+        writer.write(json.dumps({'environment': environment(), 'args': {k: v for k, v in vars(args).items() if k != 'func'},
+                                 'results': results}, indent=2))
+    print('results:', out)
+    return out
+
+
+def compare(args) -> int:
+    with open(args.base, 'r') as handler:
+        base = json.loads(handler.read())
+    with open(args.new, 'r') as handler:
+        new = json.loads(handler.read())
+
+    def key(result):
+        return result['stage'], result['tickers'], result['bars'], result['interval']
+    base_results = {key(result): result for result in base['results']}
+    regressions = 0
+    print('%-12s %8s %6s %5s  %9s %9s %7s  %9s %9s %7s' % ('stage', 'tickers', 'bars', 'int', 'base s', 'new s',
+                                                            'ratio', 'base MB', 'new MB', 'ratio'))
+    for result in new['results']:
+        old = base_results.get(key(result))
+        if old is None:
+            continue
+        time_ratio = result['wall_sec'] / old['wall_sec'] if old['wall_sec'] > 0 else float('nan')
+        mem_ratio = result['peak_mb'] / old['peak_mb'] if old['peak_mb'] > 0 else float('nan')
+        flag = ''
+        if time_ratio > 1 + args.threshold or mem_ratio > 1 + args.threshold:
+            flag = 'REGRESSION'
+            regressions += 1
+        elif time_ratio < 1 - args.threshold:
+            flag = 'faster'
+        print('%-12s %8d %6d %5s  %9.3f %9.3f %7.2f  %9.1f %9.1f %7.2f  %s'
+              % (result['stage'], result['tickers'], result['bars'], result['interval'], old['wall_sec'],
+                 result['wall_sec'], time_ratio, old['peak_mb'], result['peak_mb'], mem_ratio, flag))
+    print('%d regression(s) above %.0f%%' % (regressions, 100 * args.threshold))
+    return 1 if regressions > 0 else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='time and memory profile every pipeline stage on synthetic data')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='run the benchmarks and save a JSON result file')
+    run_parser.add_argument('--scales', nargs='+', type=int, default=[190, 3000, 10000], help='ticker counts')
+    run_parser.add_argument('--bars', type=int, default=150, help='bars per ticker')
+    run_parser.add_argument('--interval', default='1d', help='1d or a minute interval such as 1m')
+    run_parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    run_parser.add_argument('--repeat', type=int, default=3)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--conf', default='data/conf.ini')
+    run_parser.add_argument('--label', default=None, help='result file name, default: timestamp')
+    run_parser.add_argument('--out', default=None, help='result file path, overrides --label')
+    run_parser.set_defaults(func=run)
+    compare_parser = commands.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.10, help='relative change that counts')
+    compare_parser.set_defaults(func=compare)
+    args = parser.parse_args()
+    status = args.func(args)
+    sys.exit(status if isinstance(status, int) else 0)
@@ -0,0 +1,54 @@
+import math
+import pandas as pd
+from common.synthetic import SyntheticMarket
+from core.data_collector import DataCollector
+from core.fetchers import Fetcher
+
+
+class SyntheticUniverse:
+    '''
+    N tickers x M bars of deterministic OHLCV at daily ('1d') or minute ('1m') granularity.
+    The same (n_tickers, n_bars, interval, seed, end) always produces the same bars.
+
+    - `download_frame()` is shaped like a multi ticker yf.download result after the fetcher
+      reset it to a 'Date' column: (field, ticker) columns
+    - `history_frame()` is the long (ticker, timestamp, ...) table the data downloader writes
+    '''
+    def __init__(self, n_tickers:int, n_bars:int, interval:str='1d', seed:int=0, end:str='2021-12-31'):
+        self.n_tickers = int(n_tickers)
+        self.n_bars = int(n_bars)
+        self.interval = interval
+        self.market = SyntheticMarket(seed=seed, end=end)
+
+    def tickers(self) -> list:
+        width = max(len(str(self.n_tickers - 1)), 4)
+        return ['T' + str(i).zfill(width) for i in range(self.n_tickers)]
+
+    def index(self) -> pd.DatetimeIndex:
+        if self.market.is_intraday(self.interval):
+            freq = pd.Timedelta(self.interval.replace('m', 'min') if self.interval.endswith('m') else self.interval)
+            session = pd.Timedelta(self.market.session_end + ':00') - pd.Timedelta(self.market.session_start + ':00')
+            per_day = int(session / freq)
+            days = math.ceil(self.n_bars / max(per_day, 1))
+        else:
+            days = self.n_bars
+        # business days only: pad the calendar window for weekends and holidays
+        period = '%dd' % (math.ceil(days * 7 / 5) + 7)
+        index = self.market.timestamps(self.interval, period=period)
+        return index[-self.n_bars:]
+
+    def download_frame(self) -> pd.DataFrame:
+        return Fetcher()._with_date_column(self.market.frame(self.tickers(), self.index()))
+
+    def history_frame(self) -> pd.DataFrame:
+        collector = DataCollector(interval=self.interval, period='', use_combine_interval=False, combine_interval=1,
+                                  start_date='', end_date='')
+        return collector.convert_data_frame(self.download_frame())
+
+    def last_dates(self, days:int) -> pd.Timestamp:
+        '''start of the window Strategies.compute keeps when "today" is the universe end'''
+        return self.market.end - pd.Timedelta(days=days)
+
+    def describe(self) -> dict:
+        return {'tickers': self.n_tickers, 'bars': self.n_bars, 'interval': self.interval,
+                'rows': self.n_tickers * self.n_bars, 'end': str(self.market.end.date())}
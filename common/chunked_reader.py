@@ -0,0 +1,133 @@
+import os
+import pickle
+import shutil
+import tempfile
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+from common.schema import Schema
+from common.storage import storage_for_path
+from common.timestamps import to_epoch
+
+
+class ChunkedReader:
+    '''
+    Streams a history / indicator table in chunks of at most `chunk_rows` rows, whatever format
+    wrote it. Every chunk is coerced to compact dtypes on arrival (epoch int64 timestamps, float64
+    values), and rows are deduplicated on the (ticker, timestamp) key only; the last copy of a bar
+    wins, so a same-day re-download replaces the earlier one. With a `schema` the chunks are
+    also converted to its column types (categorical tickers, float32, bool flags).
+
+    Legacy timestamp strings are read as local times of the exchange `timezone`.
+
+    `path` may also be a list of files (e.g. the partitions of a dataset run), read one after another.
+    '''
+    key = ['ticker', 'timestamp']
+
+    def __init__(self, path, chunk_rows:int=200000, spill_dir:str=None, schema:Schema=None, timezone:str=None):
+        self.path = path
+        self.paths = [path] if isinstance(path, str) else list(path)
+        self.schema = schema
+        self.chunk_rows = max(int(chunk_rows), 1)
+        self.spill_dir = spill_dir
+        self.timezone = timezone
+
+    def coerce(self, df:pd.DataFrame) -> pd.DataFrame:
+        df = df.reset_index(drop=True)
+        if 'timestamp' in df.columns:
+            df['timestamp'] = to_epoch(df['timestamp'], timezone=self.timezone)
+        for col in df.columns:
+            if col not in self.key and not pd.api.types.is_numeric_dtype(df[col]):
+                converted = pd.to_numeric(df[col], errors='coerce')
+                if converted.notna().sum() == df[col].notna().sum():
+                    df[col] = converted
+        if self.schema is not None:
+            self.schema.compact(df)
+        return df
+
+    def concat(self, frames:list) -> pd.DataFrame:
+        if self.schema is not None:
+            return self.schema.concat(frames)
+        return pd.concat(frames, ignore_index=True)
+
+    def deduplicate(self, df:pd.DataFrame) -> pd.DataFrame:
+        # tables without bars (e.g. the backtest summary) have no key to deduplicate on
+        if any(col not in df.columns for col in self.key):
+            return df
+        duplicated = df.duplicated(subset=self.key, keep='last')
+        # drop_duplicates copies the frame even when nothing is dropped
+        return df[~duplicated.to_numpy()].reset_index(drop=True) if duplicated.any() else df
+
+    def iter_chunks(self, columns:list=None):
+        for path in self.paths:
+            for chunk in storage_for_path(path).iter_chunks(path, chunk_rows=self.chunk_rows, columns=columns):
+                yield self.coerce(chunk)
+
+    def read(self, columns:list=None) -> pd.DataFrame:
+        '''
+        the whole table in memory: the chunks are concatenated once, so the peak is about twice the
+        table (plus the kept rows when there are duplicates). Tables too big for that go through
+        iter_chunks or iter_ticker_batches, as the out-of-core indicator stage does.
+        '''
+        chunks = list(self.iter_chunks(columns=columns))
+        if len(chunks) == 0:
+            return pd.DataFrame(columns=self.key if columns is None else columns)
+        df = self.concat(chunks)
+        del chunks
+        return self.deduplicate(df)
+
+    def ticker_counts(self) -> Counter:
+        counts = Counter()
+        for chunk in self.iter_chunks(columns=['ticker']):
+            counts.update(chunk['ticker'].value_counts().to_dict())
+        return counts
+
+    def plan_batches(self, batch_rows:int) -> list:
+        '''sorted tickers grouped into consecutive batches of at most `batch_rows` rows (a bigger ticker gets its own)'''
+        batches, current, size = list(), list(), 0
+        for ticker, count in sorted(self.ticker_counts().items()):
+            if len(current) > 0 and size + count > batch_rows:
+                batches.append(current)
+                current, size = list(), 0
+            current.append(ticker)
+            size += count
+        if len(current) > 0:
+            batches.append(current)
+        return batches
+
+    def iter_ticker_batches(self, batch_rows:int=1000000):
+        '''
+        yields deduplicated frames holding every bar of a group of whole tickers, sorted by
+        (ticker, timestamp), in ticker order. A first pass counts rows per ticker, a second pass
+        spills each chunk's rows to its batch's file, so memory stays at about one chunk plus one batch.
+        '''
+        batches = self.plan_batches(batch_rows)
+        if len(batches) == 0:
+            return
+        batch_of = {ticker: i for i, tickers in enumerate(batches) for ticker in tickers}
+        spill = tempfile.mkdtemp(prefix='ticker-batches-', dir=self.spill_dir)
+        try:
+            writers = dict()
+            for chunk in self.iter_chunks():
+                ids = chunk['ticker'].map(batch_of).to_numpy()
+                for i in np.unique(ids):
+                    if i not in writers:
+                        writers[i] = open(os.path.join(spill, '%d.pkl' % i), 'ab')
+                    pickle.dump(chunk[ids == i], writers[i], protocol=pickle.HIGHEST_PROTOCOL)
+            for writer in writers.values():
+                writer.close()
+
+            for i in range(len(batches)):
+                pieces = list()
+                with open(os.path.join(spill, '%d.pkl' % i), 'rb') as handler:
+                    while True:
+                        try:
+                            pieces.append(pickle.load(handler))
+                        except EOFError:
+                            break
+                os.remove(os.path.join(spill, '%d.pkl' % i))
+                df = self.deduplicate(self.concat(pieces))
+                yield df.sort_values(self.key, kind='mergesort', ignore_index=True)
+        finally:
+            shutil.rmtree(spill, ignore_errors=True)
@@ -0,0 +1,359 @@
+'''
+Stage tables of saver.dir as a partitioned dataset (saver.layout=dataset):
+
+    <saver.dir>/<stage>/<timeframe>/<run>/<period><suffix>
+    <saver.dir>/manifest.json
+
+`stage` is the saver.dir.* prefix without its trailing '-' (history, indicators, strategy, ...),
+`run` the run date (a rerun on the same day replaces it) and `period` the month (granularity M,
+e.g. 2021-12) or day (D, 2021-12-31) of the bars in the partition. Tables without a timestamp
+column are one 'all' partition.
+
+The manifest holds, per stage and timeframe, the latest run and for every partition its rows,
+tickers and first / last timestamp. Finding the latest run is a lookup instead of a directory
+listing, and readers open only the partitions that overlap the requested time range and tickers.
+
+With saver.layout=files (the default) StageTables reads and writes the usual
+<saver.dir>/<prefix><YYYY_MM_DD><suffix> files, so the stages use one interface for both layouts.
+'''
+import json
+import os
+import shutil
+import threading
+from datetime import date, datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from common.chunked_reader import ChunkedReader
+from common.schema import Schema
+from common.storage import TableStorage, get_storage
+from common.timestamps import to_epoch
+from common.utilities import Utilities
+
+
+GRANULARITIES = {'M': 'datetime64[M]', 'D': 'datetime64[D]'}
+LAYOUTS = ('files', 'dataset')
+# writers of every Dataset in the process update the manifest one at a time
+_MANIFEST_LOCK = threading.Lock()
+
+
+def stage_name(startswith:str) -> str:
+    '''dataset stage of a saver.dir.* prefix: history- -> history'''
+    return startswith.rstrip('-_')
+
+
+def key_sorted(df:pd.DataFrame) -> bool:
+    '''whether the rows of `df` are sorted by (ticker, timestamp), as the indicator table is'''
+    if any(col not in df.columns for col in ChunkedReader.key):
+        return False
+    tickers = df['ticker']
+    tickers = tickers.cat.codes.to_numpy() if isinstance(tickers.dtype, pd.CategoricalDtype) \
+        and tickers.cat.categories.is_monotonic_increasing else tickers.to_numpy()
+    timestamps = to_epoch(df['timestamp'])
+    same = tickers[1:] == tickers[:-1]
+    return bool(np.all((tickers[1:] > tickers[:-1]) | (same & (timestamps[1:] >= timestamps[:-1]))))
+
+
+class Dataset:
+    manifest_file = 'manifest.json'
+
+    def __init__(self, directory:str, storage:TableStorage, granularity:str='M', chunk_rows:int=200000,
+                 schema:Schema=None):
+        granularity = granularity.strip().upper()
+        if granularity not in GRANULARITIES:
+            raise ValueError('unknown saver.layout.granularity ' + granularity + ', expected M or D')
+        self.directory = str(Path(directory).absolute())
+        self.storage = storage
+        self.granularity = granularity
+        self.chunk_rows = chunk_rows
+        self.schema = schema
+
+    def manifest(self) -> dict:
+        path = os.path.join(self.directory, self.manifest_file)
+        if not os.path.exists(path):
+            return {'stages': dict()}
+        with open(path, 'r') as handler:
+            return json.loads(handler.read())
+
+    def save_manifest(self, manifest:dict):
+        path = os.path.join(self.directory, self.manifest_file)
+        with open(path + '.tmp', 'w') as writer:
+            writer.write(json.dumps(manifest, indent=1))
+        os.replace(path + '.tmp', path)
+
+    def run_dir(self, stage:str, timeframe:str, run:str) -> str:
+        return os.path.join(self.directory, stage, timeframe, run)
+
+    def split(self, df:pd.DataFrame):
+        '''(period, rows) per period of the bars, in period order; rows keep their order'''
+        if 'timestamp' not in df.columns or df.shape[0] == 0:
+            if df.shape[0] > 0:
+                yield 'all', df
+            return
+        periods = to_epoch(df['timestamp']).astype('datetime64[s]').astype(GRANULARITIES[self.granularity])
+        keys, ids = np.unique(periods, return_inverse=True)
+        for i, key in enumerate(keys):
+            yield str(key), df[ids == i]
+
+    @staticmethod
+    def describe(df:pd.DataFrame, period:str, file:str) -> dict:
+        partition = {'period': period, 'file': file, 'rows': int(df.shape[0]), 'tickers': None,
+                     'min_timestamp': None, 'max_timestamp': None}
+        if 'ticker' in df.columns:
+            partition['tickers'] = sorted(str(ticker) for ticker in df['ticker'].unique())
+        if 'timestamp' in df.columns and df.shape[0] > 0:
+            timestamps = to_epoch(df['timestamp'])
+            partition.update(min_timestamp=int(timestamps.min()), max_timestamp=int(timestamps.max()))
+        return partition
+
+    def writer(self, stage:str, timeframe:str, day:date=None) -> 'DatasetWriter':
+        '''builds the `day` (default today) run of `stage` from consecutive frames'''
+        return DatasetWriter(self, stage, timeframe, day=day)
+
+    def write(self, stage:str, timeframe:str, df:pd.DataFrame, day:date=None) -> str:
+        '''writes `df` as the `day` (default today) run of `stage`; returns the run directory'''
+        with self.writer(stage, timeframe, day=day) as writer:
+            writer.write(df)
+        return writer.path
+
+    def publish(self, stage:str, timeframe:str, run:str, tmp_dir:str, entry:dict) -> str:
+        '''moves a run built in `tmp_dir` into place and records it in the manifest'''
+        run_dir = self.run_dir(stage, timeframe, run)
+        with _MANIFEST_LOCK:
+            shutil.rmtree(run_dir, ignore_errors=True)
+            os.replace(tmp_dir, run_dir)
+            manifest = self.manifest()
+            runs = manifest['stages'].setdefault(stage, dict()).setdefault(timeframe, {'latest': None, 'runs': dict()})
+            runs['runs'][run] = dict(entry, written=datetime.now().isoformat(timespec='seconds'))
+            runs['latest'] = max(runs['runs'])
+            self.save_manifest(manifest)
+        return run_dir
+
+    def latest(self, stage:str, timeframe:str) -> str:
+        '''the latest run of `stage`, None when there is none'''
+        entry = self.manifest()['stages'].get(stage, dict()).get(timeframe)
+        return None if entry is None else entry['latest']
+
+    def partitions(self, stage:str, timeframe:str, run:str=None, start:int=None, end:int=None,
+                   tickers:list=None) -> (dict, list):
+        '''
+        (run entry, partitions of the run that can hold bars in [start, end] epoch seconds of
+        `tickers`); the latest run by default
+        '''
+        entry = self.manifest()['stages'].get(stage, dict()).get(timeframe)
+        run = entry['latest'] if run is None and entry is not None else run
+        if entry is None or run not in entry['runs']:
+            raise FileNotFoundError('no ' + stage + ' run for ' + timeframe + ' in ' + self.directory)
+        wanted = None if tickers is None else set(str(ticker) for ticker in tickers)
+        selected = list()
+        for partition in entry['runs'][run]['partitions']:
+            if start is not None and partition['max_timestamp'] is not None and partition['max_timestamp'] < start:
+                continue
+            if end is not None and partition['min_timestamp'] is not None and partition['min_timestamp'] > end:
+                continue
+            if wanted is not None and partition['tickers'] is not None and wanted.isdisjoint(partition['tickers']):
+                continue
+            selected.append(dict(partition, path=os.path.join(self.run_dir(stage, timeframe, run), partition['file'])))
+        return entry['runs'][run], selected
+
+    def reader(self, stage:str, timeframe:str, run:str=None) -> ChunkedReader:
+        '''every partition of a run, in period order, as one ChunkedReader'''
+        _, partitions = self.partitions(stage, timeframe, run=run)
+        return ChunkedReader([partition['path'] for partition in partitions], chunk_rows=self.chunk_rows,
+                             schema=self.schema)
+
+    def read(self, stage:str, timeframe:str, run:str=None, start:int=None, end:int=None, tickers:list=None,
+             columns:list=None) -> pd.DataFrame:
+        '''
+        the bars of `tickers` in [start, end] from the partitions that can hold them, in the order
+        they were written when that was (ticker, timestamp) or time order; other tables come back
+        in period order
+        '''
+        entry, partitions = self.partitions(stage, timeframe, run=run, start=start, end=end, tickers=tickers)
+        frames = list()
+        for partition in partitions:
+            reader = ChunkedReader(partition['path'], chunk_rows=self.chunk_rows, schema=self.schema)
+            frames.append(filter_rows(reader.read(columns=columns), start=start, end=end, tickers=tickers))
+        if len(frames) == 0:
+            return pd.DataFrame(columns=entry['columns'] if columns is None else columns)
+        df = self.schema.concat(frames) if self.schema is not None else pd.concat(frames, ignore_index=True)
+        if len(frames) > 1 and entry['key_sorted']:
+            df = df.sort_values(ChunkedReader.key, kind='mergesort', ignore_index=True)
+        return df
+
+
+class DatasetWriter:
+    '''
+    builds one dataset run from consecutive frames (e.g. ticker batches) without holding them:
+    every period keeps an open TableWriter, and its manifest entry grows with every frame.
+    `close` publishes the run and returns its directory; as a context manager the run is published
+    on success and its tmp directory removed on error.
+    '''
+    def __init__(self, dataset:Dataset, stage:str, timeframe:str, day:date=None):
+        self.dataset = dataset
+        self.stage = stage
+        self.timeframe = timeframe
+        self.run = (date.today() if day is None else day).strftime('%Y_%m_%d')
+        self.path = dataset.run_dir(stage, timeframe, self.run)
+        self.tmp_dir = self.path + '.tmp'
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        os.makedirs(self.tmp_dir)
+        self.writers, self.partitions = dict(), dict()
+        self.columns, self.rows = None, 0
+        self.key_sorted, self.last_key = True, None
+
+    def write(self, df:pd.DataFrame):
+        if self.columns is None:
+            self.columns = [str(col) for col in df.columns]
+        self.rows += df.shape[0]
+        self.track_order(df)
+        for period, part in self.dataset.split(df):
+            if period not in self.writers:
+                file = period + self.dataset.storage.suffix
+                self.writers[period] = self.dataset.storage.writer(os.path.join(self.tmp_dir, file))
+                self.partitions[period] = self.dataset.describe(part.iloc[:0], period, file)
+            self.writers[period].write(part)
+            self.merge(self.partitions[period], self.dataset.describe(part, period, self.partitions[period]['file']))
+
+    def track_order(self, df:pd.DataFrame):
+        '''the run stays (ticker, timestamp) sorted while every frame is and starts after the last one'''
+        if not self.key_sorted or df.shape[0] == 0:
+            return
+        if not key_sorted(df):
+            self.key_sorted = False
+            return
+        first = (str(df['ticker'].iloc[0]), int(to_epoch(df['timestamp'].iloc[:1])[0]))
+        if self.last_key is not None and first < self.last_key:
+            self.key_sorted = False
+        self.last_key = (str(df['ticker'].iloc[-1]), int(to_epoch(df['timestamp'].iloc[-1:])[0]))
+
+    @staticmethod
+    def merge(partition:dict, part:dict):
+        partition['rows'] += part['rows']
+        if part['tickers'] is not None:
+            partition['tickers'] = sorted(set(partition['tickers'] or list()) | set(part['tickers']))
+        for name, pick in (('min_timestamp', min), ('max_timestamp', max)):
+            if part[name] is not None:
+                partition[name] = part[name] if partition[name] is None else pick(partition[name], part[name])
+
+    def close(self) -> str:
+        for writer in self.writers.values():
+            writer.close()
+        entry = {'rows': int(self.rows), 'columns': self.columns or list(), 'key_sorted': self.key_sorted,
+                 'partitions': [self.partitions[period] for period in sorted(self.partitions)]}
+        return self.dataset.publish(self.stage, self.timeframe, self.run, self.tmp_dir, entry)
+
+    def abort(self):
+        '''drops the partial run; the manifest and the published runs are untouched'''
+        for writer in self.writers.values():
+            writer.abort()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def filter_rows(df:pd.DataFrame, start:int=None, end:int=None, tickers:list=None) -> pd.DataFrame:
+    keep = np.ones(df.shape[0], dtype=bool)
+    if start is not None and 'timestamp' in df.columns:
+        keep &= df['timestamp'].to_numpy() >= start
+    if end is not None and 'timestamp' in df.columns:
+        keep &= df['timestamp'].to_numpy() <= end
+    if tickers is not None and 'ticker' in df.columns:
+        keep &= df['ticker'].astype(str).isin(set(str(ticker) for ticker in tickers)).to_numpy()
+    return df if keep.all() else df[keep].reset_index(drop=True)
+
+
+class StageTables:
+    '''
+    reads and writes the stage tables (history, indicators, strategy, backtest) of a stage in the
+    configured saver.layout. Tables are named by their saver.dir.* prefix in both layouts.
+    Every table is written for one run `day` (today when the stage starts), so the path prepare
+    returns is the one write / writer use even when a run crosses midnight.
+    '''
+    def __init__(self, p_reader, schema:Schema=None, day:date=None):
+        if p_reader.saver_layout not in LAYOUTS:
+            raise ValueError('unknown saver.layout ' + p_reader.saver_layout + ', expected one of ' + ', '.join(LAYOUTS))
+        self.p_reader = p_reader
+        self.schema = schema
+        self.day = date.today() if day is None else day
+        self.layout = p_reader.saver_layout
+        self.utilities = Utilities()
+        self.storage = get_storage(p_reader.storage_format)
+        # the dataset stays at saver.dir when a multi timeframe run moves the stage to saver.dir/<timeframe>
+        self.dataset = Dataset(p_reader.historical_dir, self.storage, granularity=p_reader.saver_granularity,
+                               chunk_rows=p_reader.chunk_rows, schema=schema) if self.layout == 'dataset' else None
+
+    def prepare(self, startswith:str) -> str:
+        '''where a `startswith` table will be written, None (after printing why) when it cannot be'''
+        try:
+            if self.dataset is not None:
+                if not Path(self.dataset.directory).is_dir():
+                    raise FileNotFoundError(self.dataset.directory)
+                return self.dataset.run_dir(stage_name(startswith), self.p_reader.timeframe,
+                                            self.day.strftime('%Y_%m_%d'))
+            filename = self.storage.path_for(directory=self.p_reader.historical_dir, startswith=startswith, day=self.day)
+            self.storage.prepare(filename)
+        except Exception as e:
+            print(e)
+            return None
+        return filename
+
+    def write(self, startswith:str, df:pd.DataFrame) -> str:
+        '''writes the run day's `startswith` table, replacing one written earlier that day; returns its path'''
+        if self.dataset is not None:
+            return self.dataset.write(stage_name(startswith), self.p_reader.timeframe, df, day=self.day)
+        file_path = self.storage.path_for(directory=self.p_reader.historical_dir, startswith=startswith, day=self.day)
+        self.storage.write(df, file_path)
+        return file_path
+
+    def writer(self, startswith:str):
+        '''
+        builds the run day's `startswith` table from consecutive frames: write(df) per frame, close()
+        replaces the table written earlier that day and returns its path
+        '''
+        if self.dataset is not None:
+            return self.dataset.writer(stage_name(startswith), self.p_reader.timeframe, day=self.day)
+        return self.storage.writer(self.storage.path_for(directory=self.p_reader.historical_dir, startswith=startswith,
+                                                         day=self.day))
+
+    def latest(self, startswith:str) -> str:
+        '''path of the latest `startswith` table (a run directory in the dataset layout)'''
+        if self.dataset is None:
+            return self.utilities.get_latest_file(directory=self.p_reader.historical_dir, startswith=startswith)
+        stage = stage_name(startswith)
+        run = self.dataset.latest(stage, self.p_reader.timeframe)
+        if run is None:
+            raise FileNotFoundError('no ' + stage + ' run for ' + self.p_reader.timeframe + ' in ' + self.dataset.directory)
+        return self.dataset.run_dir(stage, self.p_reader.timeframe, run)
+
+    def read(self, startswith:str, start:int=None, tickers:list=None, columns:list=None) -> pd.DataFrame:
+        '''
+        the latest `startswith` table, limited to bars at or after `start` (epoch seconds) and to
+        `tickers`; the dataset layout only opens the partitions that can hold them
+        '''
+        if self.dataset is not None:
+            return self.dataset.read(stage_name(startswith), self.p_reader.timeframe, start=start, tickers=tickers,
+                                     columns=columns)
+        reader = self.reader(startswith)
+        if start is None and tickers is None:
+            return reader.read(columns=columns)
+        # rows are dropped chunk by chunk, so only the kept ones are ever held together
+        frames = [filter_rows(chunk, start=start, tickers=tickers) for chunk in reader.iter_chunks(columns=columns)]
+        if len(frames) == 0:
+            return pd.DataFrame(columns=reader.key if columns is None else columns)
+        return reader.deduplicate(reader.concat(frames)).reset_index(drop=True)
+
+    def reader(self, startswith:str) -> ChunkedReader:
+        '''a ChunkedReader over the latest `startswith` table (every partition of the run in the dataset layout)'''
+        if self.dataset is not None:
+            return self.dataset.reader(stage_name(startswith), self.p_reader.timeframe)
+        return ChunkedReader(self.latest(startswith), chunk_rows=self.p_reader.chunk_rows, schema=self.schema,
+                             timezone=self.p_reader.session_timezone)
@@ -0,0 +1,257 @@
+'''
+Run instrumentation: wall time, CPU time, resident memory and row / ticker counts per stage and
+sub-step, plus an optional profiler around the stages, written as one JSON run report.
+
+    recorder = Recorder(enabled=True)
+    with recorder.stage('indicators') as span:
+        with recorder.stage('ema9'):
+            ...
+        span.count(rows=df.shape[0], tickers=n)
+    recorder.write_report(path)
+
+Spans nest per thread. Work running on pool threads names its parent explicitly with
+`stage(name, parent='download')`; `cpu_sec` is process CPU time (all threads), `thread_cpu_sec`
+the CPU time of the recording thread only. `peak_rss_mb` is the process high-water mark when
+the span ended and `peak_rss_growth_mb` how much the span raised it.
+'''
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def current_rss_mb():
+    '''resident set size now, None where it cannot be read'''
+    try:
+        with open('/proc/self/statm', 'r') as handler:
+            return int(handler.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+class Span:
+    '''one recorded stage or sub-step'''
+    def __init__(self, recorder:'Recorder', name:str, path:str, counts:dict):
+        self.recorder = recorder
+        self.name = name
+        self.path = path
+        self.counts = dict(counts)
+        self.record = None
+
+    def count(self, **counts):
+        self.counts.update(counts)
+
+    def __enter__(self):
+        self.recorder._push(self)
+        self.started = time.perf_counter()
+        self.cpu = time.process_time()
+        self.thread_cpu = time.thread_time()
+        self.rss = current_rss_mb()
+        self.peak = peak_rss_mb()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        rss, peak = current_rss_mb(), peak_rss_mb()
+        self.record = {'path': self.path, 'name': self.name, 'thread': threading.current_thread().name,
+                       'start_sec': self.started - self.recorder.started,
+                       'wall_sec': time.perf_counter() - self.started,
+                       'cpu_sec': time.process_time() - self.cpu,
+                       'thread_cpu_sec': time.thread_time() - self.thread_cpu,
+                       'rss_start_mb': self.rss, 'rss_end_mb': rss, 'peak_rss_mb': peak,
+                       'peak_rss_growth_mb': None if peak is None else peak - self.peak,
+                       'counts': self.counts, 'error': None if exc_type is None else repr(exc_value)}
+        self.recorder._pop(self)
+        return False
+
+
+class NullSpan:
+    def count(self, **counts):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+class SamplingProfiler:
+    '''
+    samples the stack of one thread every `interval` seconds from a background thread; the report
+    lists the hottest functions (self and total samples) and the most frequent stacks.
+    '''
+    def __init__(self, interval:float=0.005, thread_id:int=None):
+        self.interval = interval
+        self.thread_id = threading.main_thread().ident if thread_id is None else thread_id
+        self.stacks = Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def __run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = tuple('%s (%s:%d)' % (f.name, os.path.basename(f.filename), f.lineno)
+                          for f in traceback.extract_stack(frame))
+            self.stacks[stack] += 1
+            self.samples += 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.__run, name='sampling-profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def summary(self, top:int=30) -> dict:
+        own, total = Counter(), Counter()
+        for stack, n in self.stacks.items():
+            own[stack[-1]] += n
+            for function in set(stack):
+                total[function] += n
+        return {'samples': self.samples, 'interval_sec': self.interval,
+                'self': own.most_common(top), 'total': total.most_common(top),
+                'stacks': [(';'.join(stack), n) for stack, n in self.stacks.most_common(top)]}
+
+
+class Recorder:
+    '''
+    Collects spans for one run. A disabled recorder hands out no-op spans, so instrumented code
+    does not need to check whether instrumentation is on.
+
+    `profile` is '' / 'none', 'cprofile' or 'sample'; it applies to the top level stages listed in
+    `profile_stages` (all top level stages when empty).
+    '''
+    def __init__(self, enabled:bool=True, profile:str='', profile_stages:list=None, sample_interval:float=0.005):
+        self.enabled = enabled
+        self.profile = (profile or '').strip().lower()
+        if self.profile not in ('', 'none', 'cprofile', 'sample'):
+            raise ValueError('unknown instrument.profile ' + self.profile + ', expected none, cprofile or sample')
+        self.profile_stages = set(profile_stages or [])
+        self.sample_interval = sample_interval
+        self.started = time.perf_counter()
+        self.created = datetime.now()
+        self.records = list()
+        self.profiles = dict()
+        self.info = dict()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_properties(cls, p_reader) -> 'Recorder':
+        return cls(enabled=p_reader.instrument_enabled, profile=p_reader.instrument_profile,
+                   profile_stages=p_reader.instrument_profile_stages,
+                   sample_interval=p_reader.instrument_sample_ms / 1000.0)
+
+    @classmethod
+    def disabled(cls) -> 'Recorder':
+        return cls(enabled=False)
+
+    def __stack(self) -> list:
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = list()
+        return self.local.stack
+
+    def stage(self, name:str, parent:str=None, **counts):
+        if not self.enabled:
+            return NullSpan()
+        if parent is None:
+            parent = self.current_path()
+        path = parent + '/' + name if parent else name
+        return Span(self, name, path, counts)
+
+    def current_path(self) -> str:
+        '''path of the innermost open span on this thread, '' outside any span'''
+        if not self.enabled:
+            return ''
+        stack = self.__stack()
+        return stack[-1].path if len(stack) > 0 else ''
+
+    def _push(self, span:Span):
+        stack = self.__stack()
+        stack.append(span)
+        if self.__profiled(span):
+            span.profiler = cProfile.Profile() if self.profile == 'cprofile' else SamplingProfiler(self.sample_interval)
+            if self.profile == 'cprofile':
+                span.profiler.enable()
+            else:
+                span.profiler.start()
+
+    def _pop(self, span:Span):
+        stack = self.__stack()
+        if len(stack) > 0 and stack[-1] is span:
+            stack.pop()
+        profiler = getattr(span, 'profiler', None)
+        if profiler is not None:
+            if self.profile == 'cprofile':
+                profiler.disable()
+                out = io.StringIO()
+                pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(30)
+                self.profiles[span.path] = {'profiler': 'cprofile', 'text': out.getvalue(), 'stats': profiler}
+            else:
+                profiler.stop()
+                self.profiles[span.path] = {'profiler': 'sample', **profiler.summary()}
+        with self.lock:
+            self.records.append(span.record)
+
+    def __profiled(self, span:Span) -> bool:
+        if self.profile in ('', 'none') or '/' in span.path:
+            return False
+        if threading.current_thread() is not threading.main_thread():
+            return False
+        return len(self.profile_stages) == 0 or span.name in self.profile_stages
+
+    def annotate(self, **info):
+        '''run level facts for the report, e.g. interval, number of tickers'''
+        self.info.update(info)
+
+    def report(self) -> dict:
+        records = sorted(self.records, key=lambda record: record['start_sec'])
+        profiles = {path: {k: v for k, v in profile.items() if k != 'stats'} for path, profile in self.profiles.items()}
+        return {'created': self.created.isoformat(timespec='seconds'),
+                'wall_sec': time.perf_counter() - self.started, 'peak_rss_mb': peak_rss_mb(),
+                'info': self.info, 'spans': records, 'profiles': profiles}
+
+    def write_report(self, path:str) -> str:
+        if not self.enabled:
+            return None
+        with open(path, 'w') as writer:
+            writer.write(json.dumps(self.report(), indent=2, default=str))
+        for span_path, profile in self.profiles.items():
+            if profile['profiler'] == 'cprofile':
+                profile['stats'].dump_stats(os.path.splitext(path)[0] + '-' + span_path.replace('/', '-') + '.prof')
+        return path
+
+    def summary(self) -> str:
+        lines = ['%-40s %9s %9s %9s  %s' % ('stage', 'wall s', 'cpu s', 'rss MB', 'counts')]
+        for record in sorted(self.records, key=lambda record: record['start_sec']):
+            depth = record['path'].count('/')
+            rss = record['rss_end_mb']
+            lines.append('%-40s %9.3f %9.3f %9s  %s' % ('  ' * depth + record['name'], record['wall_sec'],
+                                                     record['thread_cpu_sec'] if depth else record['cpu_sec'],
+                                                     '-' if rss is None else '%.0f' % rss,
+                                                     ' '.join('%s=%s' % kv for kv in record['counts'].items())))
+        return '\n'.join(lines)
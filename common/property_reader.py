@@ -10,18 +10,90 @@ class PropertyReader:
 
         self.interval = str(config.get('Data', 'loader.interval'))
         self.period = str(config.get('Data', 'loader.period'))
-        self.use_combine_interval = bool(config.get('Data', 'loader.use_combine_interval'))
+        self.use_combine_interval = config.getboolean('Data', 'loader.use_combine_interval')
         self.combine_interval = int(config.get('Data', 'loader.combine_interval'))
+        self.combine_rule = str(config.get('Data', 'loader.combine_rule', fallback=''))
+        self.session_start = str(config.get('Data', 'loader.session.start', fallback='09:30'))
+        self.session_timezone = str(config.get('Data', 'loader.session.timezone', fallback='America/New_York'))
+        self.timeframes = ast.literal_eval(config.get('Data', 'loader.timeframes', fallback='[]'))
+        # bar width the stages work on; names the timeframe partition of saver.layout=dataset
+        self.timeframe = self.combine_rule.strip() or self.interval
+        if len(self.combine_rule.strip()) == 0 and self.use_combine_interval and self.combine_interval > 1:
+            self.timeframe = self.interval + 'x' + str(self.combine_interval)
         self.start_date = str(config.get('Data', 'loader.start_date'))
         self.end_date = str(config.get('Data', 'loader.end_date'))
         self.ticker_file = str(config.get('Data', 'loader.ticker.file'))
+        self.fetcher = str(config.get('Data', 'loader.fetcher', fallback='yahoo'))
+        self.concurrency = int(config.get('Data', 'loader.concurrency', fallback='4'))
+        self.rate_per_sec = float(config.get('Data', 'loader.rate.per_sec', fallback='1.0'))
+        self.rate_burst = int(config.get('Data', 'loader.rate.burst', fallback='2'))
+        self.retries = int(config.get('Data', 'loader.retries', fallback='3'))
+        self.backoff = float(config.get('Data', 'loader.backoff.sec', fallback='2.0'))
         self.historical_dir = str(config.get('Data', 'saver.dir'))
         self.history_startswith = str(config.get('Data', 'saver.dir.history'))
         self.indicator_startswith = str(config.get('Data', 'saver.dir.indicators'))
         self.strategy_startswith = str(config.get('Data', 'saver.dir.strategy'))
         self.buysell_startswith = str(config.get('Data', 'saver.dir.buysells'))
+        self.storage_format = str(config.get('Data', 'saver.format', fallback='jsonl'))
+        self.saver_layout = str(config.get('Data', 'saver.layout', fallback='files')).strip().lower()
+        self.saver_granularity = str(config.get('Data', 'saver.layout.granularity', fallback='M'))
+        self.state_startswith = str(config.get('Data', 'saver.dir.state', fallback='indicator-state-'))
+        self.signal_index_startswith = str(config.get('Data', 'saver.dir.signal_index', fallback='signal-index-'))
+        self.backtest_startswith = str(config.get('Data', 'saver.dir.backtest', fallback='backtest-summary-'))
+        self.backtest_trades_startswith = str(config.get('Data', 'saver.dir.backtest.trades', fallback='backtest-trades-'))
+        self.sweep_startswith = str(config.get('Data', 'saver.dir.sweep', fallback='sweep-results-'))
+        self.sweep_checkpoint_startswith = str(config.get('Data', 'saver.dir.sweep.checkpoint', fallback='sweep-checkpoint-'))
+        self.stream_startswith = str(config.get('Data', 'saver.dir.stream', fallback='stream-signals-'))
+        self.report_startswith = str(config.get('Data', 'saver.dir.report', fallback='run-report-'))
+        self.chunk_rows = int(config.get('Data', 'reader.chunk.rows', fallback='200000'))
+        self.schema_categorical = config.getboolean('Data', 'schema.categorical', fallback=False)
+        self.schema_float32 = config.getboolean('Data', 'schema.float32', fallback=False)
+        self.schema_flags = str(config.get('Data', 'schema.flags', fallback='float')).strip().lower()
+        self.cache_mode = str(config.get('Data', 'cache.mode', fallback='off')).strip().lower()
+        self.cache_dir = str(config.get('Data', 'cache.dir', fallback='data/bar_cache'))
+        self.cache_max_age_days = float(config.get('Data', 'cache.max_age_days', fallback='30'))
+        self.cache_max_mb = float(config.get('Data', 'cache.max_mb', fallback='1024'))
 
         self.emas = ast.literal_eval(config.get('Indicators', 'indicator.emas'))
         self.supertrends = ast.literal_eval(config.get('Indicators', 'indicator.supertrends'))
+        self.incremental = config.getboolean('Indicators', 'indicator.incremental', fallback=False)
+        self.incremental_verify = config.getboolean('Indicators', 'indicator.incremental.verify', fallback=False)
+        self.indicator_workers = int(config.get('Indicators', 'indicator.workers', fallback='1'))
+        self.indicator_memory_mb = float(config.get('Indicators', 'indicator.memory.mb', fallback='0'))
+        self.signal_index = config.getboolean('Indicators', 'indicator.signal_index', fallback=False)
+        self.signal_index_last_bars = int(config.get('Indicators', 'indicator.signal_index.last_bars', fallback='5'))
+        self.smas = ast.literal_eval(config.get('Indicators', 'indicator.smas', fallback='[]'))
+        self.bollinger = ast.literal_eval(config.get('Indicators', 'indicator.bollinger', fallback='[]'))
+        self.vwap = config.getboolean('Indicators', 'indicator.vwap', fallback=False)
+        self.prev_highs = ast.literal_eval(config.get('Indicators', 'indicator.prev_highs', fallback='[]'))
+        self.levels = config.getboolean('Indicators', 'indicator.levels', fallback=False)
+        self.levels_window = int(config.get('Indicators', 'indicator.levels.window', fallback='2'))
 
-        self.last_interval = int(config.get('Strategy', 'strategy.last.intervals'))
\ No newline at end of file
+        self.last_interval = int(config.get('Strategy', 'strategy.last.intervals'))
+        self.strategy_rules = ast.literal_eval(config.get('Strategy', 'strategy.rules', fallback='[]'))
+
+        self.backtest_enabled = config.getboolean('Backtest', 'backtest.enabled', fallback=False)
+        self.backtest_rules = ast.literal_eval(config.get('Backtest', 'backtest.rules', fallback='[]'))
+        self.backtest_fee_bps = float(config.get('Backtest', 'backtest.fee.bps', fallback='5'))
+        self.backtest_entry_lag = int(config.get('Backtest', 'backtest.entry.lag', fallback='0'))
+        self.backtest_allow_short = config.getboolean('Backtest', 'backtest.allow_short', fallback=False)
+
+        self.sweep_periods = ast.literal_eval(config.get('Sweep', 'sweep.supertrend.periods', fallback='[7,10,14]'))
+        self.sweep_multipliers = ast.literal_eval(config.get('Sweep', 'sweep.supertrend.multipliers', fallback='[2,3,4]'))
+        self.sweep_emas = ast.literal_eval(config.get('Sweep', 'sweep.emas', fallback='[55,100,200]'))
+        self.sweep_buy = str(config.get('Sweep', 'sweep.buy', fallback='buy > 0 and close > ema'))
+        self.sweep_sell = str(config.get('Sweep', 'sweep.sell', fallback='sell > 0 and close < ema'))
+        self.sweep_workers = int(config.get('Sweep', 'sweep.workers', fallback='4'))
+        self.sweep_shard_tickers = int(config.get('Sweep', 'sweep.shard.tickers', fallback='500'))
+        self.sweep_rank_by = str(config.get('Sweep', 'sweep.rank_by', fallback='mean_return'))
+
+        self.stream_speed = float(config.get('Streaming', 'stream.replay.speed', fallback='0'))
+        self.stream_print_signals = config.getboolean('Streaming', 'stream.print_signals', fallback=True)
+
+        self.pipeline_in_memory = config.getboolean('Pipeline', 'pipeline.in_memory', fallback=False)
+        self.pipeline_sink = str(config.get('Pipeline', 'pipeline.sink', fallback='background'))
+
+        self.instrument_enabled = config.getboolean('Instrument', 'instrument.enabled', fallback=True)
+        self.instrument_profile = str(config.get('Instrument', 'instrument.profile', fallback='none'))
+        self.instrument_profile_stages = ast.literal_eval(config.get('Instrument', 'instrument.profile.stages', fallback='[]'))
+        self.instrument_sample_ms = float(config.get('Instrument', 'instrument.sample.interval_ms', fallback='5'))
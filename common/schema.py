@@ -0,0 +1,128 @@
+'''
+Compact column types for the stage tables:
+
+- ticker: object strings, or with `schema.categorical` categorical with sorted categories, so
+  sorting by ticker sorts by the integer codes
+- timestamp: int64 epoch seconds
+- prices and indicator lines: float64, or float32 with `schema.float32` (about 7 significant
+  digits; rules then compare float32 values)
+- buy_* / sell_* flags: 0.0 / 1.0 floats, or with `schema.flags=bool` bools (1 byte instead of 8)
+
+The defaults are the legacy layout (Schema.legacy()); the compact types are opt-in.
+
+Volume stays float64: float32 cannot hold volumes above 2**24 exactly. JSON lines files
+store the same values (flags as true / false), while Parquet and npy keep the types.
+'''
+import sys
+import numpy as np
+import pandas as pd
+from common.timestamps import TIMESTAMP_FORMAT, to_epoch
+
+
+FLAG_PREFIXES = ('buy_', 'sell_')
+PRICE_COLUMNS = ('open', 'close', 'high', 'low', 'support', 'resistance')
+LINE_PREFIXES = ('ema', 'sup_', 'sma', 'bb_', 'vwap', 'prev_')
+
+
+class Schema:
+    def __init__(self, categorical:bool=False, float32:bool=False, flags:str='float'):
+        if flags not in ('bool', 'float'):
+            raise ValueError('unknown schema.flags ' + flags + ', expected bool or float')
+        self.categorical = categorical
+        self.float32 = float32
+        self.flags = flags
+
+    @classmethod
+    def from_properties(cls, p_reader) -> 'Schema':
+        return cls(categorical=p_reader.schema_categorical, float32=p_reader.schema_float32,
+                   flags=p_reader.schema_flags)
+
+    @classmethod
+    def legacy(cls) -> 'Schema':
+        '''object tickers, float64 values and flags: the layout before this schema existed'''
+        return cls(categorical=False, float32=False, flags='float')
+
+    @property
+    def float_dtype(self):
+        return np.float32 if self.float32 else np.float64
+
+    @property
+    def flag_dtype(self):
+        return np.bool_ if self.flags == 'bool' else np.float64
+
+    def dtype(self, col:str):
+        '''target dtype of a value column, None for columns the schema leaves alone'''
+        if col.startswith(FLAG_PREFIXES):
+            return self.flag_dtype
+        if col in PRICE_COLUMNS or col.startswith(LINE_PREFIXES):
+            return self.float_dtype
+        return None
+
+    def tickers(self, values:pd.Series) -> pd.Series:
+        '''`values` in the ticker type; the same object when it already is'''
+        categorical = isinstance(values.dtype, pd.CategoricalDtype)
+        if not self.categorical:
+            return values.astype(object) if categorical else values
+        if categorical:
+            categories = values.cat.categories
+            return values if categories.is_monotonic_increasing else values.cat.reorder_categories(sorted(categories))
+        return values.astype(pd.CategoricalDtype(sorted(values.dropna().unique())))
+
+    def compact(self, df:pd.DataFrame) -> pd.DataFrame:
+        '''converts the columns of `df` in place (only those not already in the target type)'''
+        if 'ticker' in df.columns:
+            values = df['ticker']
+            tickers = self.tickers(values)
+            if tickers is not values:
+                df['ticker'] = tickers
+        if 'timestamp' in df.columns and df['timestamp'].dtype != np.int64:
+            df['timestamp'] = to_epoch(df['timestamp'])
+        for col in df.columns:
+            dtype = self.dtype(col)
+            if dtype is None or df[col].dtype == dtype:
+                continue
+            if dtype == np.bool_:
+                df[col] = df[col].to_numpy(dtype=float) > 0
+            else:
+                df[col] = df[col].to_numpy(dtype=dtype)
+        return df
+
+    def concat(self, frames:list) -> pd.DataFrame:
+        '''pd.concat that keeps a categorical ticker column categorical across frames with different tickers'''
+        frames = [frame for frame in frames if frame is not None]
+        if len(frames) == 0:
+            return pd.DataFrame()
+        if self.categorical and all('ticker' in frame.columns and
+                                    isinstance(frame['ticker'].dtype, pd.CategoricalDtype) for frame in frames):
+            categories = sorted(set().union(*(frame['ticker'].cat.categories for frame in frames)))
+            frames = [frame.assign(ticker=frame['ticker'].cat.set_categories(categories)) for frame in frames]
+        return pd.concat(frames, ignore_index=True)
+
+    @staticmethod
+    def memory_mb(df:pd.DataFrame) -> float:
+        return df.memory_usage(index=True, deep=True).sum() / 2 ** 20
+
+    @staticmethod
+    def legacy_mb(df:pd.DataFrame) -> float:
+        '''
+        what `df` takes in the legacy layout: a Python str per ticker and per timestamp string
+        (as pandas counts object columns), float64 values and flags
+        '''
+        n = df.shape[0]
+        total = df.index.memory_usage()
+        for col in df.columns:
+            if col == 'ticker':
+                counts = df['ticker'].value_counts(sort=False)
+                total += 8 * n + sum(int(c) * sys.getsizeof(str(t)) for t, c in counts.items())
+            elif col == 'timestamp':
+                total += n * (8 + sys.getsizeof(pd.Timestamp(0).strftime(TIMESTAMP_FORMAT)))
+            else:
+                total += df[col].memory_usage(index=False, deep=True) if df[col].dtype == object else 8 * n
+        return total / 2 ** 20
+
+    def report(self, name:str, df:pd.DataFrame) -> dict:
+        '''prints and returns the memory of `df` next to its legacy layout size'''
+        now, legacy = self.memory_mb(df), self.legacy_mb(df)
+        print('%s: %d rows, %.1f MB (legacy layout %.1f MB, %.1fx smaller)'
+              % (name, df.shape[0], now, legacy, legacy / now if now > 0 else float('nan')))
+        return {'memory_mb': round(now, 2), 'legacy_mb': round(legacy, 2)}
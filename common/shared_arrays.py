@@ -0,0 +1,64 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedArrays:
+    '''
+    Named numpy arrays copied once into shared memory blocks, so worker processes can map them
+    instead of receiving a pickled copy with every task.
+
+    The owning process creates it from a dict of arrays and passes `specs` (small and picklable) to
+    the workers, which call `SharedArrays.attach(specs)`. The owner must `unlink()` when done; using
+    it as a context manager does that.
+    '''
+    def __init__(self, arrays:dict=None):
+        self.blocks = dict()
+        self.arrays = dict()
+        self.specs = dict()
+        self.owner = arrays is not None
+        for name, values in (arrays or dict()).items():
+            values = np.ascontiguousarray(values)
+            block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+            shared = np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)
+            shared[...] = values
+            self.blocks[name] = block
+            self.arrays[name] = shared
+            self.specs[name] = (block.name, values.shape, values.dtype.str)
+
+    @classmethod
+    def attach(cls, specs:dict) -> 'SharedArrays':
+        shared = cls()
+        for name, (block_name, shape, dtype) in specs.items():
+            block = shared_memory.SharedMemory(name=block_name)
+            shared.blocks[name] = block
+            shared.arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+            shared.specs[name] = (block_name, shape, dtype)
+        return shared
+
+    def __getitem__(self, name:str) -> np.ndarray:
+        return self.arrays[name]
+
+    def __contains__(self, name:str) -> bool:
+        return name in self.arrays
+
+    def close(self):
+        self.arrays = dict()
+        for block in self.blocks.values():
+            block.close()
+
+    def unlink(self):
+        blocks = list(self.blocks.values())
+        self.close()
+        for block in blocks:
+            block.unlink()
+        self.blocks = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.owner:
+            self.unlink()
+        else:
+            self.close()
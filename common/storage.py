@@ -0,0 +1,388 @@
+import argparse
+import json
+import math
+import os
+import shutil
+from datetime import date
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dump_record(record:dict) -> str:
+    '''one JSON line; NaN and infinite values are written as null, which every JSON parser reads back as NaN'''
+    return json.dumps({key: None if isinstance(value, float) and not math.isfinite(value) else value
+                       for key, value in record.items()})
+
+
+class TableStorage:
+    '''
+    Reads and writes the tabular stage outputs (history, indicators, strategy rows).
+    A backend is picked with `saver.format` in conf.ini; the file suffix tells readers which
+    backend wrote a file, so directories holding files of several formats stay readable.
+    '''
+    name = None
+    suffix = ''
+
+    def path_for(self, directory:str, startswith:str, day:date=None) -> str:
+        day = date.today() if day is None else day
+        file_path = Path(directory + '/' + startswith + day.strftime("%Y_%m_%d") + self.suffix)
+        return str(file_path.absolute())
+
+    def prepare(self, path:str):
+        if not Path(path).parent.is_dir():
+            raise FileNotFoundError(str(Path(path).parent))
+
+    def write(self, df:pd.DataFrame, path:str, append:bool=False):
+        '''
+        writes `df` as the table at `path`. Only JSON lines can `append` in place; the columnar
+        formats would rewrite the whole table per call, so tables of several frames go through writer(path)
+        '''
+        raise NotImplementedError
+
+    def read(self, path:str, columns:list=None) -> pd.DataFrame:
+        raise NotImplementedError
+
+    def iter_chunks(self, path:str, chunk_rows:int, columns:list=None):
+        '''the table as consecutive frames of at most `chunk_rows` rows'''
+        df = self.read(path, columns=columns)
+        for start in range(0, df.shape[0], chunk_rows):
+            yield df.iloc[start:start + chunk_rows]
+
+    def writer(self, path:str) -> 'TableWriter':
+        '''a writer that builds the table at `path` from consecutive frames'''
+        raise NotImplementedError
+
+
+class TableWriter:
+    '''
+    Appends frames with the same columns to one table without holding the earlier ones. The table
+    is built at `path`.tmp and only replaces `path` on `close`, so readers never see half of it.
+    Used as a context manager, the table is closed on success and the tmp file removed on error.
+    '''
+    def __init__(self, path:str):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.rows = 0
+
+    def write(self, df:pd.DataFrame):
+        self.rows += df.shape[0]
+
+    def close(self) -> str:
+        os.replace(self.tmp_path, self.path)
+        return self.path
+
+    def abort(self):
+        '''drops the partial table; `path` keeps whatever it held before'''
+        if os.path.isdir(self.tmp_path):
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+        elif os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class JsonLinesWriter(TableWriter):
+    def __init__(self, path:str):
+        super().__init__(path)
+        self.handle = open(self.tmp_path, 'w')
+
+    def write(self, df:pd.DataFrame):
+        super().write(df)
+        for record in df.to_dict('records'):
+            self.handle.write(dump_record(record))
+            self.handle.write('\n')
+
+    def close(self) -> str:
+        self.handle.close()
+        return super().close()
+
+    def abort(self):
+        self.handle.close()
+        super().abort()
+
+
+class ParquetWriter(TableWriter):
+    '''one row group per frame'''
+    def __init__(self, path:str, pa, pq):
+        super().__init__(path)
+        self.pa, self.pq = pa, pq
+        self.writer = None
+
+    def write(self, df:pd.DataFrame):
+        super().write(df)
+        # the dictionary of a categorical column differs from frame to frame; the file keeps plain strings
+        df = df.assign(**{col: df[col].astype(object) for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)})
+        table = self.pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.tmp_path, table.schema)
+        self.writer.write_table(table.cast(self.writer.schema))
+
+    def close(self) -> str:
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.tmp_path, self.pa.schema([]))
+        self.writer.close()
+        return super().close()
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.close()
+        super().abort()
+
+
+class NumpyWriter(TableWriter):
+    '''
+    each frame's columns go to their own .npy pieces; `close` concatenates the pieces of every
+    column through a memory mapped output file, one piece at a time
+    '''
+    def __init__(self, path:str, storage:'NumpyStorage'):
+        super().__init__(path)
+        self.storage = storage
+        self.columns, self.dtypes, self.pieces = None, dict(), 0
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+
+    def write(self, df:pd.DataFrame):
+        super().write(df)
+        if self.columns is None:
+            self.columns = list(df.columns)
+            self.dtypes = {col: str(df[col].dtype) for col in df.columns}
+        for i, col in enumerate(self.columns):
+            values = df[col].to_numpy()
+            if values.dtype == object:
+                values = df[col].astype(str).to_numpy(dtype=str)
+            np.save(os.path.join(self.tmp_path, '%d.%d.piece.npy' % (i, self.pieces)), values, allow_pickle=False)
+        self.pieces += 1
+
+    def close(self) -> str:
+        for i, col in enumerate(self.columns or list()):
+            paths = [os.path.join(self.tmp_path, '%d.%d.piece.npy' % (i, k)) for k in range(self.pieces)]
+            pieces = [np.load(piece, mmap_mode='r') for piece in paths]
+            # fixed width strings take the widest piece's width
+            dtype = np.result_type(*[piece.dtype for piece in pieces])
+            out = np.lib.format.open_memmap(os.path.join(self.tmp_path, '%d.npy' % i), mode='w+', dtype=dtype,
+                                            shape=(self.rows,) + pieces[0].shape[1:])
+            start = 0
+            for piece in pieces:
+                out[start:start + len(piece)] = piece
+                start += len(piece)
+            out.flush()
+            del out, pieces
+            for piece in paths:
+                os.remove(piece)
+        with open(os.path.join(self.tmp_path, self.storage.schema_file), 'w') as writer:
+            writer.write(json.dumps({'columns': list(self.columns or list()), 'dtypes': self.dtypes, 'rows': int(self.rows)}))
+        shutil.rmtree(self.path, ignore_errors=True)
+        return super().close()
+
+
+class JsonLinesStorage(TableStorage):
+    '''the original format: one json.dumps(record) per line'''
+    name = 'jsonl'
+    suffix = ''
+
+    def prepare(self, path:str):
+        Path(path).touch(exist_ok=True)
+
+    def write(self, df:pd.DataFrame, path:str, append:bool=False):
+        records = df.to_dict('records')
+        writer = open(path, 'a' if append else 'w')
+        for record in records:
+            writer.write(dump_record(record))
+            writer.write('\n')
+        writer.close()
+
+    def read(self, path:str, columns:list=None) -> pd.DataFrame:
+        data = list()
+        with open(path, 'r') as handler:
+            for line in handler:
+                data.append(json.loads(line))
+        df = pd.DataFrame(data)
+        return df if columns is None else df[columns]
+
+    def writer(self, path:str) -> TableWriter:
+        return JsonLinesWriter(path)
+
+    def parse_lines(self, lines:list) -> list:
+        # one parser call per chunk; files written before dump_record hold the NaN / Infinity literals
+        # orjson rejects, and the json module reads them
+        text = '[' + ','.join(line for line in lines if len(line.strip()) > 0) + ']'
+        if orjson is not None:
+            try:
+                return orjson.loads(text)
+            except orjson.JSONDecodeError:
+                pass
+        return json.loads(text)
+
+    def iter_chunks(self, path:str, chunk_rows:int, columns:list=None):
+        with open(path, 'r') as handler:
+            while True:
+                lines = list()
+                for line in handler:
+                    lines.append(line)
+                    if len(lines) >= chunk_rows:
+                        break
+                if len(lines) == 0:
+                    return
+                df = pd.DataFrame(self.parse_lines(lines))
+                yield df if columns is None else df[columns]
+
+
+class ParquetStorage(TableStorage):
+    '''columnar Parquet file, needs pyarrow'''
+    name = 'parquet'
+    suffix = '.parquet'
+
+    def _pyarrow(self):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('saver.format=parquet needs pyarrow: pip install pyarrow')
+        return pyarrow, pyarrow.parquet
+
+    def write(self, df:pd.DataFrame, path:str, append:bool=False):
+        if append:
+            raise ValueError('parquet tables are written whole; build one from several frames with writer(path)')
+        pa, pq = self._pyarrow()
+        tmp_path = path + '.tmp'
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp_path)
+        os.replace(tmp_path, path)
+
+    def read(self, path:str, columns:list=None) -> pd.DataFrame:
+        _, pq = self._pyarrow()
+        return pq.read_table(path, columns=columns).to_pandas()
+
+    def iter_chunks(self, path:str, chunk_rows:int, columns:list=None):
+        _, pq = self._pyarrow()
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows, columns=columns):
+            yield batch.to_pandas()
+
+    def writer(self, path:str) -> TableWriter:
+        return ParquetWriter(path, *self._pyarrow())
+
+
+class NumpyStorage(TableStorage):
+    '''
+    a directory with one .npy file per column plus a small schema.json, so single columns can be
+    memory mapped with `read_arrays(..., mmap=True)`. String columns are stored as fixed width unicode.
+    '''
+    name = 'npy'
+    suffix = '.npcol'
+    schema_file = 'schema.json'
+
+    def write(self, df:pd.DataFrame, path:str, append:bool=False):
+        if append:
+            raise ValueError('npy tables are written whole; build one from several frames with writer(path)')
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        dtypes = dict()
+        for i, col in enumerate(df.columns):
+            values = df[col].to_numpy()
+            if values.dtype == object:
+                values = df[col].astype(str).to_numpy(dtype=str)
+            dtypes[col] = str(df[col].dtype)
+            np.save(os.path.join(tmp_path, '%d.npy' % i), values, allow_pickle=False)
+        with open(os.path.join(tmp_path, self.schema_file), 'w') as writer:
+            writer.write(json.dumps({'columns': list(df.columns), 'dtypes': dtypes, 'rows': int(df.shape[0])}))
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+
+    def writer(self, path:str) -> TableWriter:
+        return NumpyWriter(path, self)
+
+    def read_schema(self, path:str) -> dict:
+        with open(os.path.join(path, self.schema_file), 'r') as handler:
+            return json.loads(handler.read())
+
+    def read_arrays(self, path:str, columns:list=None, mmap:bool=False) -> dict:
+        schema = self.read_schema(path)
+        index = {col: i for i, col in enumerate(schema['columns'])}
+        columns = schema['columns'] if columns is None else columns
+        return {col: np.load(os.path.join(path, '%d.npy' % index[col]), mmap_mode='r' if mmap else None)
+                for col in columns}
+
+    def read(self, path:str, columns:list=None) -> pd.DataFrame:
+        return self.__frame(self.read_schema(path), self.read_arrays(path, columns=columns))
+
+    def __frame(self, schema:dict, arrays:dict) -> pd.DataFrame:
+        df = pd.DataFrame({col: np.asarray(values) for col, values in arrays.items()})
+        for col in df.columns:
+            if schema['dtypes'][col] == 'object':
+                df[col] = df[col].astype(object)
+            elif schema['dtypes'][col] == 'category':
+                df[col] = df[col].astype(object).astype('category')
+        return df
+
+    def iter_chunks(self, path:str, chunk_rows:int, columns:list=None):
+        schema = self.read_schema(path)
+        arrays = self.read_arrays(path, columns=columns, mmap=True)
+        for start in range(0, schema['rows'], chunk_rows):
+            yield self.__frame(schema, {col: values[start:start + chunk_rows] for col, values in arrays.items()})
+
+
+STORAGES = {storage.name: storage for storage in (JsonLinesStorage, ParquetStorage, NumpyStorage)}
+
+
+def get_storage(name:str) -> TableStorage:
+    name = 'jsonl' if name is None or len(name.strip()) == 0 else name.strip().lower()
+    if name not in STORAGES:
+        raise ValueError('unknown saver.format ' + name + ', expected one of ' + ', '.join(STORAGES))
+    return STORAGES[name]()
+
+
+def storage_for_path(path:str) -> TableStorage:
+    for storage in (ParquetStorage, NumpyStorage):
+        if str(path).endswith(storage.suffix):
+            return storage()
+    return JsonLinesStorage()
+
+
+def read_table(path:str, columns:list=None) -> pd.DataFrame:
+    return storage_for_path(path).read(path, columns=columns)
+
+
+def convert_directory(directory:str, prefixes:list, target:str, remove:bool=False) -> list:
+    '''
+    migrate every stage file in `directory` whose name starts with one of `prefixes` to the `target` format.
+    Files already in the target format are skipped; originals are only deleted when `remove` is set.
+    '''
+    dst = get_storage(target)
+    converted = list()
+    for path in sorted(Path(directory).iterdir()):
+        if path.name.endswith('.tmp') or not any(path.name.startswith(p) for p in prefixes):
+            continue
+        src = storage_for_path(str(path))
+        if src.name == dst.name:
+            continue
+        base = str(path)[:len(str(path)) - len(src.suffix)] if src.suffix else str(path)
+        out_path = base + dst.suffix
+        dst.write(src.read(str(path)), out_path)
+        if remove:
+            shutil.rmtree(str(path)) if path.is_dir() else path.unlink()
+        converted.append(out_path)
+    return converted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='convert stage output files between storage formats')
+    parser.add_argument('directory', help='saver.dir, e.g. data/historical_data')
+    parser.add_argument('--to', required=True, choices=sorted(STORAGES))
+    parser.add_argument('--prefixes', nargs='+', default=['history-', 'indicators-', 'strategy-'])
+    parser.add_argument('--remove', action='store_true', help='delete the original files after conversion')
+    args = parser.parse_args()
+    for out_path in convert_directory(args.directory, prefixes=args.prefixes, target=args.to, remove=args.remove):
+        print(out_path)
@@ -0,0 +1,84 @@
+import zlib
+import numpy as np
+import pandas as pd
+
+
+class SyntheticMarket:
+    '''
+    Deterministic synthetic OHLCV, used as an offline stand-in for the data provider.
+
+    A bar is a pure function of (seed, ticker, timestamp): prices follow a few slow waves with a
+    ticker specific phase plus hashed noise, so any window of any ticker is reproducible and two
+    overlapping downloads agree on the bars they share.
+    '''
+    fields = ['Adj Close', 'Close', 'High', 'Low', 'Open', 'Volume']
+    session_start = '09:30'
+    session_end = '16:00'
+    timezone = 'America/New_York'
+
+    def __init__(self, seed:int=0, end:str=None):
+        self.seed = seed
+        self.end = pd.Timestamp(end) if end is not None else pd.Timestamp.today().normalize()
+
+    def ticker_key(self, ticker:str) -> int:
+        return zlib.crc32((str(self.seed) + ':' + ticker.upper()).encode())
+
+    def __uniform(self, keys:np.ndarray) -> np.ndarray:
+        # splitmix64 finaliser -> uniform [0, 1)
+        z = keys.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+        return (z >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+    def is_intraday(self, interval:str) -> bool:
+        return not interval.endswith(('d', 'wk', 'mo'))
+
+    def timestamps(self, interval:str, period:str=None, start:str=None, end:str=None) -> pd.DatetimeIndex:
+        end = self.end if end is None or len(str(end).strip()) == 0 else pd.Timestamp(end)
+        if start is None or len(str(start).strip()) == 0:
+            start = end - pd.Timedelta(period if period else '30d')
+        days = pd.bdate_range(pd.Timestamp(start).normalize(), pd.Timestamp(end).normalize())
+        if not self.is_intraday(interval):
+            index = days[(days >= pd.Timestamp(start).normalize()) & (days <= pd.Timestamp(end))]
+            return pd.DatetimeIndex(index, name='Date')
+        freq = pd.Timedelta(interval.replace('m', 'min') if interval.endswith('m') else interval)
+        opening = pd.Timedelta(self.session_start + ':00')
+        n = int((pd.Timedelta(self.session_end + ':00') - opening) / freq)
+        offsets = opening.to_timedelta64() + freq.to_timedelta64() * np.arange(n)
+        index = (days.values[:, None] + offsets[None, :]).ravel()
+        index = pd.DatetimeIndex(index)
+        index = index[(index >= pd.Timestamp(start)) & (index < pd.Timestamp(end) + pd.Timedelta('1d'))]
+        return pd.DatetimeIndex(index.tz_localize(self.timezone), name='Datetime')
+
+    def ohlcv(self, tickers:list, index:pd.DatetimeIndex) -> dict:
+        '''field -> (bars, tickers) array'''
+        seconds = (index.tz_convert(None) if index.tz is not None else index).values.astype('datetime64[s]')
+        seconds = seconds.astype(np.int64)
+        keys = np.array([self.ticker_key(t) for t in tickers], dtype=np.uint64)
+        phase = self.__uniform(keys) * 2 * np.pi
+        base = 20 + 480 * self.__uniform(keys ^ np.uint64(0xA5A5))
+        days = (seconds[:, None] / 86400.0)
+
+        def wave(t):
+            return (0.25 * np.sin(2 * np.pi * t / 180.0 + phase) + 0.08 * np.sin(2 * np.pi * t / 23.0 + 2 * phase)
+                    + 0.03 * np.sin(2 * np.pi * t / 5.0 + 3 * phase))
+
+        bar_keys = seconds.astype(np.uint64)[:, None] * np.uint64(1000003) + keys[None, :]
+        noise = self.__uniform(bar_keys) - 0.5
+        close = base * np.exp(wave(days) + 0.02 * noise)
+        open_ = base * np.exp(wave(days - 0.5) + 0.02 * (self.__uniform(bar_keys ^ np.uint64(1)) - 0.5))
+        high = np.maximum(open_, close) * (1 + 0.01 * self.__uniform(bar_keys ^ np.uint64(2)))
+        low = np.minimum(open_, close) * (1 - 0.01 * self.__uniform(bar_keys ^ np.uint64(3)))
+        volume = np.floor(1e5 + 5e6 * self.__uniform(bar_keys ^ np.uint64(4)))
+        return {'Adj Close': close, 'Close': close, 'High': high, 'Low': low, 'Open': open_, 'Volume': volume}
+
+    def download_frame(self, tickers:list, interval:str, period:str=None, start:str=None, end:str=None) -> pd.DataFrame:
+        '''a frame shaped like `yf.download(tickers=[...])`: (field, ticker) column MultiIndex, datetime index'''
+        return self.frame(tickers, self.timestamps(interval, period=period, start=start, end=end))
+
+    def frame(self, tickers:list, index:pd.DatetimeIndex) -> pd.DataFrame:
+        tickers = [t.upper() for t in tickers]
+        data = self.ohlcv(tickers, index)
+        frames = {field: pd.DataFrame(data[field], index=index, columns=tickers) for field in self.fields}
+        return pd.concat(frames, axis=1)
@@ -0,0 +1,32 @@
+'''
+Bar timestamps are stored as int64 epoch seconds (UTC). Files written before that change hold
+"%Y %m %d %H:%M:%S" strings in the exchange's local time; readers pass them through to_epoch
+with loader.session.timezone so every stage sees one format.
+'''
+import numpy as np
+import pandas as pd
+
+
+TIMESTAMP_FORMAT = "%Y %m %d %H:%M:%S"
+
+
+def to_epoch(values, timezone:str=None) -> np.ndarray:
+    '''
+    int64 epoch seconds from datetimes (naive = UTC), legacy timestamp strings or epoch numbers.
+    Legacy strings are local times of the exchange `timezone` (read as UTC without one); the hour
+    repeated when daylight saving ends is taken as standard time.
+    '''
+    if isinstance(values, (pd.DatetimeIndex, pd.Series)) and pd.api.types.is_datetime64_any_dtype(values):
+        return pd.DatetimeIndex(values).asi8 // 10 ** 9
+    values = pd.Series(values)
+    if pd.api.types.is_numeric_dtype(values):
+        return values.to_numpy(dtype=np.int64)
+    dates = pd.DatetimeIndex(pd.to_datetime(values, format=TIMESTAMP_FORMAT))
+    if timezone is not None:
+        dates = dates.tz_localize(timezone, ambiguous=np.zeros(len(dates), dtype=bool), nonexistent='shift_forward')
+    return dates.asi8 // 10 ** 9
+
+
+def to_datetime(values) -> pd.Series:
+    '''naive UTC datetimes from epoch seconds (or legacy timestamp strings)'''
+    return pd.Series(pd.to_datetime(to_epoch(values), unit='s'), index=getattr(values, 'index', None))
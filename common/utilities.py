@@ -21,7 +21,8 @@ class Utilities:
         path = Path(directory)
         files = list()
         for i in path.iterdir():
-            if startswith in str(i):
+            # tables still being written (or left by a failed run) end in .tmp
+            if startswith in str(i) and not str(i).endswith('.tmp'):
                 files.append(str(i))
         return sorted(files)[-1]
 
@@ -0,0 +1,219 @@
+import numpy as np
+import pandas as pd
+from common.instrumentation import Recorder
+from common.property_reader import PropertyReader
+from common.schema import Schema
+from common.utilities import Utilities
+from common.dataset import StageTables
+from common.storage import get_storage
+from core import kernels
+from core.rules import DEFAULT_RULES, RuleSet
+from core.ticker_blocks import TickerBlocks
+
+
+def forward_fill(values:np.ndarray, fill:float=0.0) -> np.ndarray:
+    '''row-wise forward fill of NaN, leading NaN become `fill`'''
+    valid = ~np.isnan(values)
+    index = np.where(valid, np.arange(values.shape[1])[None, :], 0)
+    np.maximum.accumulate(index, axis=1, out=index)
+    out = np.take_along_axis(values, index, axis=1)
+    out[~np.maximum.accumulate(valid, axis=1)] = fill
+    return out
+
+
+def signal_values(buy:np.ndarray, sell:np.ndarray) -> np.ndarray:
+    '''+1 on buy bars, -1 on sell bars, NaN elsewhere'''
+    return np.where(sell, -1.0, np.where(buy, 1.0, np.nan))
+
+
+def shift(values:np.ndarray, bars:int, fill:float=0.0) -> np.ndarray:
+    out = np.full(values.shape, fill, dtype=values.dtype)
+    if bars < values.shape[1]:
+        out[:, bars:] = values[:, :values.shape[1] - bars]
+    return out
+
+
+class Backtester:
+    '''
+    Turns rule signals into positions and returns for every (rule, ticker) row at once.
+
+    A buy signal on bar t sets the target position to +1, a sell signal to 0 (or -1 with
+    `allow_short`), and the target is carried forward until the next signal. The fill happens at the
+    close of bar t + `entry_lag`, so the position earns from the following bar on; a fee of `fee_bps`
+    is charged on every change of position. Trades still open at a ticker's last bar are closed there
+    and flagged as open.
+    '''
+    def __init__(self, rules:RuleSet, fee_bps:float=0.0, entry_lag:int=0, allow_short:bool=False):
+        self.rules = rules
+        self.fee = fee_bps / 10000.0
+        self.entry_lag = max(int(entry_lag), 0)
+        self.allow_short = allow_short
+
+    def signal_matrix(self, blocks:TickerBlocks) -> np.ndarray:
+        '''(rules * tickers, bars) matrix: +1 buy, -1 sell, NaN no signal'''
+        masks = self.rules.evaluate(blocks.df)
+        rows = list()
+        for rule in self.rules.rules:
+            buy, sell = masks[rule.name]
+            rows.append(kernels.pad_groups(signal_values(buy, sell), blocks.codes, blocks.positions, len(blocks), blocks.width))
+        return np.concatenate(rows, axis=0) if len(rows) else np.zeros((0, blocks.width))
+
+    def positions(self, signals:np.ndarray, lengths:np.ndarray) -> np.ndarray:
+        target = forward_fill(signals, fill=0.0)
+        if not self.allow_short:
+            target = np.maximum(target, 0.0)
+        position = shift(target, 1 + self.entry_lag)
+        position[~kernels.active_mask(lengths, position.shape[1])] = 0.0
+        return position
+
+    def simulate(self, close:np.ndarray, signals:np.ndarray, lengths:np.ndarray) -> dict:
+        '''
+        backtest (rows, bars) close / signal matrices. Returns per-row metrics plus the
+        'trade_runs' (see trade_runs); rows can be any mix of tickers and rules.
+        '''
+        active = kernels.active_mask(lengths, close.shape[1])
+        position = self.positions(signals, lengths)
+        bar_return = np.zeros(close.shape)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            bar_return[:, 1:] = close[:, 1:] / close[:, :-1] - 1.0
+        bar_return = np.nan_to_num(bar_return, nan=0.0, posinf=0.0, neginf=0.0)
+        turnover = np.abs(np.diff(position, axis=1, prepend=0.0))
+        strategy_return = position * bar_return - self.fee * turnover
+
+        equity = np.cumprod(1.0 + strategy_return, axis=1)
+        equity[~active] = np.nan
+        drawdown = equity / np.fmax.accumulate(equity, axis=1) - 1.0
+        last = np.maximum(lengths - 1, 0)
+        rows = np.arange(close.shape[0])
+
+        trades = self.trade_runs(position, close, lengths)
+        n_trades = np.bincount(trades['row'], minlength=close.shape[0])
+        wins = np.bincount(trades['row'], weights=(trades['return'] > 0), minlength=close.shape[0])
+        trade_sum = np.bincount(trades['row'], weights=trades['return'], minlength=close.shape[0])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return {
+                'bars': lengths,
+                'total_return': equity[rows, last] - 1.0,
+                'buy_hold_return': close[rows, last] / close[:, 0] - 1.0,
+                'max_drawdown': np.nanmin(np.where(active, drawdown, 0.0), axis=1),
+                'exposure': (position != 0).sum(axis=1) / np.maximum(lengths, 1),
+                'trades': n_trades,
+                'wins': wins,
+                'win_rate': wins / n_trades,
+                'avg_trade_return': trade_sum / n_trades,
+                'trade_runs': trades,
+            }
+
+    def run(self, df:pd.DataFrame) -> dict:
+        '''
+        returns {'summary': one row per (rule, ticker), 'trades': one row per trade,
+        'rules': one row per rule aggregated over tickers}
+        '''
+        blocks = TickerBlocks(df)
+        n_rules, n_tickers = len(self.rules.rules), len(blocks)
+        close = np.tile(blocks.pack('close'), (n_rules, 1))
+        lengths = np.tile(blocks.lengths, n_rules)
+        result = self.simulate(close, self.signal_matrix(blocks), lengths)
+
+        names = np.array([rule.name for rule in self.rules.rules], dtype=object)
+        runs = result.pop('trade_runs')
+        summary = pd.DataFrame({'rule': np.repeat(names, n_tickers), 'ticker': np.tile(blocks.tickers, n_rules)})
+        for col in ('bars', 'total_return', 'buy_hold_return', 'max_drawdown', 'exposure', 'trades', 'win_rate',
+                    'avg_trade_return'):
+            summary[col] = result[col]
+
+        ticker = runs['row'] % max(n_tickers, 1)
+        timestamps = blocks.df['timestamp'].to_numpy()
+        trades = pd.DataFrame({
+            'rule': names[runs['row'] // max(n_tickers, 1)],
+            'ticker': blocks.tickers[ticker],
+            'direction': runs['direction'],
+            'entry_timestamp': timestamps[blocks.starts[ticker] + runs['entry'] - 1],
+            'exit_timestamp': timestamps[blocks.starts[ticker] + runs['exit'] - 1],
+            'entry_price': runs['entry_price'],
+            'exit_price': runs['exit_price'],
+            'bars': runs['exit'] - runs['entry'],
+            'return': runs['return'],
+            'open': runs['open'],
+        })
+
+        by_rule = summary.groupby('rule', sort=False)
+        rules = pd.DataFrame({
+            'tickers': by_rule['ticker'].count(),
+            'mean_return': by_rule['total_return'].mean(),
+            'median_return': by_rule['total_return'].median(),
+            'mean_max_drawdown': by_rule['max_drawdown'].mean(),
+            'trades': by_rule['trades'].sum(),
+        })
+        wins_by_rule = trades.groupby('rule', sort=False)['return'].apply(lambda r: (r > 0).mean())
+        rules['win_rate'] = wins_by_rule.reindex(rules.index)
+        return {'summary': summary, 'trades': trades, 'rules': rules.reset_index()}
+
+    def trade_runs(self, position:np.ndarray, close:np.ndarray, lengths:np.ndarray) -> dict:
+        '''
+        a trade is a run of bars holding the same non-zero position. With entry bar e and first bar
+        after the run x, it is filled at the close of e - 1 and closed at the close of x - 1.
+        '''
+        padded = np.concatenate([np.zeros((position.shape[0], 1)), position, np.zeros((position.shape[0], 1))], axis=1)
+        changed = padded[:, 1:] != padded[:, :-1]
+        entries = np.flatnonzero((changed & (padded[:, 1:] != 0)).ravel())
+        exits = np.flatnonzero((changed & (padded[:, :-1] != 0)).ravel())
+        # both lists are in row-major order and every run has exactly one entry and one exit
+        width = padded.shape[1] - 1
+        row, entry = np.divmod(entries, width)
+        exit_bar = exits % width
+        direction = position[row, entry]
+        entry_price = close[row, entry - 1]
+        exit_price = close[row, exit_bar - 1]
+        return {
+            'row': row,
+            'entry': entry,
+            'exit': exit_bar,
+            'direction': direction,
+            'entry_price': entry_price,
+            'exit_price': exit_price,
+            'return': direction * (exit_price / entry_price - 1.0) - 2 * self.fee * np.abs(direction),
+            'open': exit_bar == lengths[row],
+        }
+
+
+class BacktestRunner:
+    def __init__(self, prop_file, recorder:Recorder=None):
+        self.p_reader = PropertyReader(prop_file=prop_file)
+        self.recorder = Recorder.disabled() if recorder is None else recorder
+        self.utilities = Utilities()
+        self.storage = get_storage(self.p_reader.storage_format)
+        rules = self.p_reader.backtest_rules or self.p_reader.strategy_rules or DEFAULT_RULES
+        self.backtester = Backtester(RuleSet(rules), fee_bps=self.p_reader.backtest_fee_bps,
+                                     entry_lag=self.p_reader.backtest_entry_lag,
+                                     allow_short=self.p_reader.backtest_allow_short)
+        self.tables = StageTables(self.p_reader, schema=Schema.from_properties(self.p_reader))
+
+    def read_indicator_file(self) -> pd.DataFrame:
+        return self.tables.read(self.p_reader.indicator_startswith)
+
+    def create_output_file(self, df:pd.DataFrame, startswith:str) -> str:
+        return self.tables.write(startswith, df)
+
+    def compute(self, df:pd.DataFrame) -> dict:
+        with self.recorder.stage('simulate', rows=df.shape[0], rules=len(self.backtester.rules.rules)) as span:
+            result = self.backtester.run(df)
+            span.count(trades=result['trades'].shape[0])
+        return result
+
+    def write_output(self, result:dict):
+        with self.recorder.stage('write'):
+            self.create_output_file(result['summary'], self.p_reader.backtest_startswith)
+            self.create_output_file(result['trades'], self.p_reader.backtest_trades_startswith)
+
+    def run_backtest(self):
+        if not self.p_reader.backtest_enabled:
+            print('backtest disabled')
+            return None
+        with self.recorder.stage('read') as span:
+            df = self.read_indicator_file()
+            span.count(rows=df.shape[0], tickers=df['ticker'].nunique())
+        result = self.compute(df)
+        self.write_output(result)
+        print(result['rules'].to_string(index=False))
+        return result
@@ -0,0 +1,336 @@
+'''
+Local OHLCV cache in front of a Fetcher.
+
+Bars are kept per (interval, ticker) in `cache.dir/<interval>/<TICKER>.pkl`. `index.json`
+records, per entry, the day ranges that were already requested from the provider. A run then
+only fetches the parts of its window that no range covers, usually just the tail since the
+previous run and a head when loader.period grows. The current day is never marked as covered:
+its bars are still forming, so every run fetches it again and the new bars replace the cached ones.
+
+The tail request also starts at the newest cached day before it, so every run gets that day's
+bars again. When they differ from the cached ones, the provider has back-adjusted the history
+(a split or a dividend): the entry is dropped and the whole window fetched again.
+
+- mode read_write: fetch the gaps, serve from the cache
+- mode cache_only: never call the provider (offline runs); tickers without cached bars fail
+- mode refresh: fetch the whole window again and overwrite the cached bars
+- entries unused for `max_age_days` are removed, then the least recently used ones until the
+  cache fits in `max_mb`; entries used by the current run are never evicted
+'''
+import json
+import os
+import re
+import threading
+import time
+import numpy as np
+import pandas as pd
+from common.timestamps import to_epoch
+from core.fetchers import Fetcher, FetchError
+
+
+FIELDS = ['Adj Close', 'Close', 'High', 'Low', 'Open', 'Volume']
+PRICE_FIELDS = ['Adj Close', 'Close', 'High', 'Low', 'Open']
+PERIOD_UNITS = {'d': 'days', 'wk': 'weeks', 'mo': 'months', 'y': 'years'}
+
+
+def merge_ranges(ranges:list) -> list:
+    '''union of [start, end) day ranges, adjacent ranges joined'''
+    out = list()
+    for start, end in sorted(ranges):
+        if len(out) > 0 and start <= out[-1][1]:
+            out[-1][1] = max(out[-1][1], end)
+        elif start < end:
+            out.append([start, end])
+    return out
+
+
+def subtract_ranges(window:tuple, ranges:list) -> list:
+    '''the parts of the [start, end) `window` not covered by `ranges`'''
+    start, end = window
+    gaps = list()
+    for r_start, r_end in merge_ranges(ranges):
+        if r_end <= start or r_start >= end:
+            continue
+        if r_start > start:
+            gaps.append((start, r_start))
+        start = max(start, r_end)
+    if start < end:
+        gaps.append((start, end))
+    return gaps
+
+
+class BarCache:
+    index_file = 'index.json'
+
+    def __init__(self, directory:str, max_age_days:float=30, max_mb:float=1024):
+        self.directory = directory
+        self.max_age_days = max_age_days
+        self.max_mb = max_mb
+        self.lock = threading.Lock()
+        self.used = set()
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, self.index_file)
+        self.index = dict()
+        if os.path.exists(path):
+            with open(path, 'r') as handler:
+                self.index = json.loads(handler.read())
+
+    @staticmethod
+    def key(ticker:str, interval:str) -> str:
+        return interval + '/' + ticker.upper()
+
+    def path(self, key:str) -> str:
+        return os.path.join(self.directory, key + '.pkl')
+
+    def ranges(self, key:str) -> list:
+        '''covered [start, end) day ranges as pd.Timestamps'''
+        entry = self.index.get(key)
+        if entry is None:
+            return list()
+        return [(pd.Timestamp(start), pd.Timestamp(end)) for start, end in entry['ranges']]
+
+    def missing(self, key:str, window:tuple) -> list:
+        return subtract_ranges(window, self.ranges(key))
+
+    def read(self, key:str) -> pd.DataFrame:
+        '''(timestamp, FIELDS...) bars of one entry sorted by timestamp, None when not cached'''
+        with self.lock:
+            self.used.add(key)
+            if key in self.index:
+                self.index[key]['last_used'] = time.time()
+            if key not in self.index or not os.path.exists(self.path(key)):
+                return None
+            return pd.read_pickle(self.path(key))
+
+    def timezone(self, key:str) -> str:
+        entry = self.index.get(key)
+        return None if entry is None else entry.get('tz')
+
+    def last_day(self, key:str) -> pd.Timestamp:
+        '''day of the newest cached bar inside the covered ranges, None when unknown'''
+        entry = self.index.get(key)
+        if entry is None or entry.get('last_day') is None:
+            return None
+        return pd.Timestamp(entry['last_day'])
+
+    @staticmethod
+    def days(timestamps, tz:str=None) -> pd.DatetimeIndex:
+        '''naive local days of epoch second timestamps'''
+        dates = pd.to_datetime(np.asarray(timestamps, dtype=np.int64), unit='s')
+        if tz is not None:
+            dates = dates.tz_localize('UTC').tz_convert(tz).tz_localize(None)
+        return dates.normalize()
+
+    def merge(self, key:str, bars:pd.DataFrame, covered:tuple, tz:str=None):
+        '''adds `bars` (newer bars win on equal timestamps) and marks the `covered` day range as fetched'''
+        with self.lock:
+            self.used.add(key)
+            path = self.path(key)
+            entry = self.index.get(key, {'ranges': [], 'rows': 0, 'bytes': 0})
+            if os.path.exists(path) and entry['rows'] > 0:
+                bars = pd.concat([pd.read_pickle(path), bars], ignore_index=True)
+            bars = bars.drop_duplicates('timestamp', keep='last').sort_values('timestamp', ignore_index=True)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            bars.to_pickle(path + '.tmp')
+            os.replace(path + '.tmp', path)
+            ranges = [[str(start.date()), str(end.date())] for start, end in self.ranges(key)]
+            if covered[0] < covered[1]:
+                ranges.append([str(covered[0].date()), str(covered[1].date())])
+            ranges = merge_ranges(ranges)
+            days = self.days(bars['timestamp'], tz)
+            days = days[days < pd.Timestamp(ranges[-1][1])] if len(ranges) > 0 else days[:0]
+            entry.update(ranges=ranges, rows=int(bars.shape[0]), bytes=os.path.getsize(path), tz=tz,
+                         last_day=str(days.max().date()) if len(days) > 0 else None,
+                         fetched=time.time(), last_used=time.time())
+            self.index[key] = entry
+
+    def remove(self, key:str):
+        with self.lock:
+            self.index.pop(key, None)
+            if os.path.exists(self.path(key)):
+                os.remove(self.path(key))
+
+    def evict(self, now:float=None) -> list:
+        now = time.time() if now is None else now
+        removed = list()
+        for key, entry in list(self.index.items()):
+            if key not in self.used and now - entry.get('last_used', 0) > self.max_age_days * 86400:
+                self.remove(key)
+                removed.append(key)
+        total = sum(entry['bytes'] for entry in self.index.values())
+        for key, entry in sorted(self.index.items(), key=lambda item: item[1].get('last_used', 0)):
+            if total <= self.max_mb * 2 ** 20:
+                break
+            if key in self.used:
+                continue
+            total -= entry['bytes']
+            self.remove(key)
+            removed.append(key)
+        return removed
+
+    def save_index(self):
+        with self.lock:
+            path = os.path.join(self.directory, self.index_file)
+            with open(path + '.tmp', 'w') as writer:
+                writer.write(json.dumps(self.index, indent=1, sort_keys=True))
+            os.replace(path + '.tmp', path)
+
+
+class CachedFetcher(Fetcher):
+    '''Fetcher serving bars from a BarCache and fetching only the day ranges it does not hold'''
+    name = 'cached'
+    modes = ('read_write', 'cache_only', 'refresh')
+
+    def __init__(self, fetcher:Fetcher, cache:BarCache, mode:str='read_write', today:pd.Timestamp=None):
+        if mode not in self.modes:
+            raise ValueError('unknown cache.mode ' + mode + ', expected off or one of ' + ', '.join(self.modes))
+        self.fetcher = fetcher
+        self.cache = cache
+        self.mode = mode
+        self.today = pd.Timestamp.today().normalize() if today is None else pd.Timestamp(today).normalize()
+        self.fetched = 0
+        self.served = 0
+        self.adjusted = 0
+
+    def window(self, period:str=None, start:str=None, end:str=None) -> tuple:
+        '''[start day, end day) of a request, None for periods like 'max' / 'ytd' that bypass the cache'''
+        if period is not None and len(period.strip()) > 0:
+            match = re.fullmatch(r'(\d+)(d|wk|mo|y)', period.strip())
+            if match is None:
+                return None
+            offset = pd.DateOffset(**{PERIOD_UNITS[match.group(2)]: int(match.group(1))})
+            return self.today - offset, self.today + pd.Timedelta(days=1)
+        # yfinance semantics: start inclusive, end exclusive
+        return pd.Timestamp(start).normalize(), pd.Timestamp(end).normalize()
+
+    def fetch(self, tickers:list, interval:str, period:str=None, start:str=None, end:str=None) -> pd.DataFrame:
+        window = self.window(period=period, start=start, end=end)
+        if window is None:
+            return self.fetcher.fetch(tickers=tickers, interval=interval, period=period, start=start, end=end)
+
+        # tickers missing the same day ranges share one request per range
+        plan = dict()
+        for ticker in tickers:
+            plan.setdefault(self.gaps(BarCache.key(ticker, interval), window), list()).append(ticker)
+        adjusted = list()
+        for gaps, group in plan.items():
+            for gap in gaps:
+                df = self.fetch_range(group, interval, gap)
+                if df is not None:
+                    adjusted += self.store(df, group, interval, gap, replace=self.mode == 'refresh')
+        if len(adjusted) > 0:
+            # the provider back-adjusted these histories: their entries were dropped, fetch the whole window
+            print('cache: history of', ', '.join(adjusted), 'changed, fetching', window[0].date(), '-', window[1].date())
+            self.adjusted += len(adjusted)
+            df = self.fetch_range(adjusted, interval, window)
+            if df is not None:
+                self.store(df, adjusted, interval, window, replace=True)
+        df = self.frame(tickers, interval, window)
+        if df is None:
+            raise FetchError('no cached bars for ' + ','.join(tickers))
+        self.served += 1
+        return df
+
+    def gaps(self, key:str, window:tuple) -> tuple:
+        '''the day ranges of `window` to request for one entry'''
+        if self.mode == 'cache_only':
+            return ()
+        if self.mode == 'refresh':
+            return (window,)
+        ranges = self.cache.ranges(key)
+        last_day = self.cache.last_day(key)
+        if last_day is not None:
+            # uncover the newest cached day (and the days after it), so the tail request fetches it again
+            ranges = [(start, min(end, last_day)) for start, end in ranges if start < last_day]
+        return tuple(subtract_ranges(window, ranges))
+
+    def fetch_range(self, tickers:list, interval:str, gap:tuple) -> pd.DataFrame:
+        try:
+            df = self.fetcher.fetch(tickers=tickers, interval=interval, start=str(gap[0].date()), end=str(gap[1].date()))
+        except FetchError as e:
+            # e.g. a tail range without trading days; the range stays uncovered
+            print('cache: no bars for', len(tickers), 'tickers in', gap[0].date(), '-', gap[1].date(), ':', e)
+            return None
+        self.fetched += 1
+        return df
+
+    def changed(self, key:str, bars:pd.DataFrame, tz:str=None) -> bool:
+        '''True when fetched `bars` of a day before today differ from the cached bars with their timestamps'''
+        cached = self.cache.read(key)
+        if cached is None or bars.shape[0] == 0:
+            return False
+        bars = bars[(self.cache.days(bars['timestamp'], tz) < self.today)]
+        both = bars.merge(cached, on='timestamp', suffixes=('', '_cached'))
+        if both.shape[0] == 0:
+            return False
+        fetched = both[PRICE_FIELDS].to_numpy(dtype=float)
+        kept = both[[field + '_cached' for field in PRICE_FIELDS]].to_numpy(dtype=float)
+        return not np.allclose(fetched, kept, rtol=1e-6, atol=0., equal_nan=True)
+
+    def store(self, df:pd.DataFrame, tickers:list, interval:str, gap:tuple, replace:bool=False) -> list:
+        '''
+        caches the bars of `df` for `tickers`; returns the tickers whose cached bars disagree with them
+        (their entries are removed and nothing is stored for them)
+        '''
+        changed = list()
+        multi = isinstance(df.columns, pd.MultiIndex)
+        date_col = [col for col in df.columns if (col[0] if multi else col) == 'Date'][0]
+        dates = df[date_col]
+        tz = str(dates.dt.tz) if dates.dt.tz is not None else None
+        timestamps = to_epoch(dates)
+        covered = (gap[0], min(gap[1], self.today))
+        for ticker in tickers:
+            key = BarCache.key(ticker, interval)
+            if replace:
+                self.cache.remove(key)
+            bars = {'timestamp': timestamps}
+            for field in FIELDS:
+                if not multi:
+                    bars[field] = df[field].to_numpy(dtype=float) if field in df.columns else np.nan
+                elif (field, ticker.upper()) in df.columns:
+                    bars[field] = df[(field, ticker.upper())].to_numpy(dtype=float)
+                else:
+                    bars[field] = np.nan
+            bars = pd.DataFrame(bars, columns=['timestamp'] + FIELDS)
+            bars = bars[bars[['Close', 'High', 'Low', 'Open']].notna().any(axis=1)]
+            if not replace and self.changed(key, bars, tz):
+                self.cache.remove(key)
+                changed.append(ticker)
+                continue
+            self.cache.merge(key, bars, covered=covered, tz=tz)
+        return changed
+
+    def frame(self, tickers:list, interval:str, window:tuple) -> pd.DataFrame:
+        '''the cached bars of `window` as a yf.download shaped frame with a 'Date' column'''
+        frames, tz = list(), None
+        for ticker in tickers:
+            key = BarCache.key(ticker, interval)
+            bars = self.cache.read(key)
+            if bars is None or bars.shape[0] == 0:
+                continue
+            tz = tz or self.cache.timezone(key)
+            frames.append(bars.assign(ticker=ticker.upper()))
+        if len(frames) == 0:
+            return None
+        bars = pd.concat(frames, ignore_index=True)
+        dates = pd.to_datetime(bars['timestamp'], unit='s')
+        if tz is not None:
+            dates = dates.dt.tz_localize('UTC').dt.tz_convert(tz)
+        days = dates.dt.tz_localize(None).dt.normalize() if tz is not None else dates.dt.normalize()
+        bars = bars[((days >= window[0]) & (days < window[1])).to_numpy()]
+        if bars.shape[0] == 0:
+            return None
+
+        wide = bars.pivot(index='timestamp', columns='ticker', values=FIELDS)
+        order = [ticker.upper() for ticker in tickers if ticker.upper() in set(bars['ticker'])]
+        wide = wide.reindex(columns=pd.MultiIndex.from_product([FIELDS, order]))
+        date = pd.to_datetime(wide.index.to_numpy(), unit='s')
+        date = date.tz_localize('UTC').tz_convert(tz) if tz is not None else date
+        wide.index = pd.DatetimeIndex(date, name='Date')
+        return self._with_date_column(wide)
+
+    def close(self):
+        self.cache.evict()
+        self.cache.save_index()
+        print('cache: %d provider requests, %d batches served, %d back-adjusted histories refetched'
+              % (self.fetched, self.served, self.adjusted))
@@ -1,15 +1,18 @@
-import math
 import warnings
 import numpy as np
 import pandas as pd
 from pandas import DataFrame
-import time
-import yfinance as yf
-from datetime import date
-from pathlib import Path
-import json
 import sys
+from common.dataset import StageTables
+from common.instrumentation import Recorder
 from common.property_reader import PropertyReader
+from common.schema import Schema
+from common.storage import JsonLinesStorage, TableStorage, get_storage
+from common.timestamps import to_epoch
+from core import resample
+from core.bar_cache import BarCache, CachedFetcher
+from core.download_scheduler import DownloadScheduler
+from core.fetchers import Fetcher, YahooFetcher, get_fetcher
 warnings.filterwarnings("ignore")
 
 
@@ -44,52 +47,44 @@ class TickerFileReader:
 
 class DataCollector:
     def __init__(self, interval, period, use_combine_interval,
-                 combine_interval, start_date, end_date):
+                 combine_interval, start_date, end_date, storage:TableStorage=None, fetcher:Fetcher=None,
+                 combine_rule:str='', session_start:str='09:30', schema:Schema=None):
         self.interval = interval
         self.period = period
         self.use_combine_interval = use_combine_interval
         self.combine_interval = combine_interval
         self.start_date = start_date
         self.end_date = end_date
+        self.storage = JsonLinesStorage() if storage is None else storage
+        self.fetcher = YahooFetcher() if fetcher is None else fetcher
+        self.combine_rule = combine_rule
+        if combine_rule is not None and len(combine_rule.strip()) > 0:
+            # checked here, not after the download
+            resample.rule_width(combine_rule)
+        self.session_start = session_start
+        self.schema = Schema.legacy() if schema is None else schema
 
     def __get_stock_history_period(self, name):
-        df = yf.download(tickers=name, period=self.period, interval=self.interval)
-        df.reset_index(inplace=True)
-        df = df.rename(columns={'index': 'Date'})
-        return df
+        return self.fetcher.fetch(tickers=name, interval=self.interval, period=self.period)
 
     def __get_stock_history_dates(self, name):
-        ticker = yf.Ticker(name)
-        df = ticker.history(interval=self.interval, start=self.start_date, end=self.end_date)
-        df.reset_index(inplace=True)
-        df = df.rename(columns={'index': 'Date'})
-        return df
+        return self.fetcher.fetch(tickers=name, interval=self.interval, start=self.start_date, end=self.end_date)
 
     def __interval_multiplier_df_creator(self, df):
         '''
-        works only
+        combines every `combine_interval` consecutive bars (split as np.array_split does), for all tickers at once
            - when input `df` is 1-h; output needed is 2-h, 3-h, 4-h
            - when input `df` is 1-m; output needed is 2-m, 3-m, 4-m
         '''
-        num_chunks = math.ceil(df.shape[0] / self.combine_interval)
-
-        _list = list()
-        for ch in np.array_split(df, num_chunks):
-            _list.append(ch)
-
-        dat = list()
-        for ch in _list:
-            _date = ch['Date'].iloc[0]
-            _open = ch['Open'].iloc[0]
-            _close = ch['Close'].iloc[-1]
-            _high = ch['High'].max()
-            _low = ch['Low'].min()
-            _vol = ch['Volume'].sum() / ch.shape[0]
-            dat.append((_date, _open, _high, _low, _close, _vol))
-
-        cols = ["Date", "Open", "High", "Low", "Close", "Volume"]
-        df_new = pd.DataFrame(data=dat, columns=cols)
-        return df_new
+        starts = resample.count_bounds(df.shape[0], self.combine_interval)
+        return resample.aggregate(df, starts)
+
+    def __time_bucket_df_creator(self, df):
+        '''
+        combines bars into `combine_rule` buckets (e.g. 2h, 4h) anchored to the session open, for all tickers at once
+        '''
+        starts, labels = resample.time_bounds(df['Date'], rule=self.combine_rule, session_start=self.session_start)
+        return resample.aggregate(df, starts, labels=labels)
 
     def get_data(self, name:list) -> DataFrame:
         '''
@@ -114,83 +109,159 @@ class DataCollector:
                 and len(self.start_date.strip()) > 0 and len(self.end_date.strip()) > 0:
             df = self.__get_stock_history_dates(name=name)
 
-        if self.use_combine_interval and self.combine_interval > 0:
+        if self.combine_rule is not None and len(self.combine_rule.strip()) > 0:
+            df = self.__time_bucket_df_creator(df)
+        elif self.use_combine_interval and self.combine_interval > 1:
             df = self.__interval_multiplier_df_creator(df)
 
         return df
 
-    def convert_data_list(self, df:DataFrame) -> list:
-        out = list()
-        dicts = df.to_dict('records')
-        for line in dicts:
-            timestamp = line['Date'].strftime("%Y %m %d %H:%M:%S")
-            _open = line['Open'].to_dict()
-            _close = line['Close'].to_dict()
-            _high = line['High'].to_dict()
-            _low = line['Low'].to_dict()
-            _vol = line['Volume'].to_dict()
-            keys = _open.keys()
-
-            for key in keys:
-                record = {'ticker': key,
-                          'timestamp': timestamp,
-                          'open': _open[key],
-                          'close': _close[key],
-                          'high': _high[key],
-                          'low': _low[key],
-                          'volume': _vol[key]}
-                out.append(record)
-        return out
+    def convert_data_frame(self, df:DataFrame, tickers:list=None) -> DataFrame:
+        '''
+        reshapes the wide yf.download frame (one row per bar, (field, ticker) columns) into a long
+        (ticker, timestamp, open, close, high, low, volume) table, bar-major like the old records.
+        Timestamps are int64 epoch seconds, the other columns follow `schema`. A flat single ticker
+        frame needs `tickers=[name]`.
+        '''
+        cols = ['ticker', 'timestamp', 'open', 'close', 'high', 'low', 'volume']
+        fields = {'open': 'Open', 'close': 'Close', 'high': 'High', 'low': 'Low', 'volume': 'Volume'}
+        if df is None or df.shape[0] == 0:
+            return pd.DataFrame(columns=cols)
+        multi = isinstance(df.columns, pd.MultiIndex)
+        date_col = [col for col in df.columns if (col[0] if multi else col) == 'Date'][0]
+        timestamps = to_epoch(df[date_col])
+        if multi:
+            keys = list(df['Open'].columns)
+            values = {name: df[field][keys].to_numpy(dtype=float) for name, field in fields.items()}
+        else:
+            keys = [tickers[0] if isinstance(tickers, (list, tuple)) else tickers]
+            values = {name: df[field].to_numpy(dtype=float)[:, None] for name, field in fields.items()}
+
+        n_bars, n_tickers = len(timestamps), len(keys)
+        if self.schema.categorical:
+            # codes into the sorted ticker names, tiled without materialising a string per row
+            order = np.argsort(np.asarray(keys, dtype=object))
+            codes = np.empty(n_tickers, dtype=np.int32)
+            codes[order] = np.arange(n_tickers, dtype=np.int32)
+            ticker = pd.Categorical.from_codes(np.tile(codes, n_bars), categories=np.asarray(keys, dtype=object)[order])
+        else:
+            ticker = np.tile(np.asarray(keys, dtype=object), n_bars)
+        out = {'ticker': ticker, 'timestamp': np.repeat(timestamps, n_tickers)}
+        for name in fields:
+            dtype = self.schema.dtype(name) or np.float64
+            out[name] = values[name].ravel().astype(dtype, copy=False)
+        return pd.DataFrame(out, columns=cols)
+
+    def convert_data_list(self, df:DataFrame, tickers:list=None) -> list:
+        return self.convert_data_frame(df, tickers=tickers).to_dict('records')
 
     def create_output_file(self, directory:str, startswith:str) -> str:
         try:
-            file_path = Path(directory + '/' + startswith + date.today().strftime("%Y_%m_%d"))
-            file_path.touch(exist_ok=True)
-            filename = str(file_path.absolute())
+            filename = self.storage.path_for(directory=directory, startswith=startswith)
+            self.storage.prepare(filename)
         except Exception as e:
             print(e)
             return None
         return filename
 
-    def save_output(self, filename:str, records:list):
-        writer = open(filename, 'a')
-        for record in records:
-            writer.write(json.dumps(record))
-            writer.write('\n')
-        writer.close()
-
 
 class DataDownloader:
-    # TODO - save data for 30m, 1h, 2h, 4h, 1d - in different files
-    def __init__(self, prop_file):
+    def __init__(self, prop_file, recorder:Recorder=None):
         self.p_reader = PropertyReader(prop_file=prop_file)
+        self.recorder = Recorder.disabled() if recorder is None else recorder
+        self.tables = StageTables(self.p_reader)
 
     def read_ticker_file(self) -> dict:
         ticker_file_reader = TickerFileReader(ticker_file=self.p_reader.ticker_file)
         tickers = ticker_file_reader.read_ticker_file()
         return tickers
 
-    def download_data(self) -> int:
+    def fetcher(self) -> Fetcher:
+        fetcher = get_fetcher(self.p_reader.fetcher)
+        if self.p_reader.cache_mode == 'off':
+            return fetcher
+        cache = BarCache(self.p_reader.cache_dir, max_age_days=self.p_reader.cache_max_age_days,
+                         max_mb=self.p_reader.cache_max_mb)
+        return CachedFetcher(fetcher, cache, mode=self.p_reader.cache_mode)
+
+    def data_collector(self, raw:bool=False) -> DataCollector:
+        '''`raw` skips loader.combine_rule / combine_interval, e.g. for the multi timeframe base download'''
+        return DataCollector(interval=self.p_reader.interval,
+                             period=self.p_reader.period,
+                             use_combine_interval=self.p_reader.use_combine_interval and not raw,
+                             combine_interval=self.p_reader.combine_interval,
+                             start_date=self.p_reader.start_date,
+                             end_date=self.p_reader.end_date,
+                             storage=get_storage(self.p_reader.storage_format),
+                             fetcher=self.fetcher(),
+                             combine_rule='' if raw else self.p_reader.combine_rule,
+                             session_start=self.p_reader.session_start,
+                             schema=Schema.from_properties(self.p_reader))
+
+    def download(self, data_collector:DataCollector) -> dict:
+        '''
+        downloads every category concurrently under the rate limit;
+        {category: (ticker list, yf.download shaped frame)} of the categories that succeeded
+        '''
         tickers = self.read_ticker_file()
-        data_collector = DataCollector(interval=self.p_reader.interval,
-                                       period=self.p_reader.period,
-                                       use_combine_interval=self.p_reader.use_combine_interval,
-                                       combine_interval=self.p_reader.combine_interval,
-                                       start_date=self.p_reader.start_date,
-                                       end_date=self.p_reader.end_date)
-        # create blank output file
-        _dir = self.p_reader.historical_dir
-        _startswith = self.p_reader.history_startswith
-        o_filename = data_collector.create_output_file(directory=_dir, startswith=_startswith)
+        scheduler = DownloadScheduler(concurrency=self.p_reader.concurrency,
+                                      rate=self.p_reader.rate_per_sec,
+                                      burst=self.p_reader.rate_burst,
+                                      retries=self.p_reader.retries,
+                                      backoff=self.p_reader.backoff)
+        # jobs run on the scheduler threads, so their spans name the stage they belong to
+        parent = self.recorder.current_path()
+
+        def get_data(category, ticker_list):
+            with self.recorder.stage('download:' + category, parent=parent, tickers=len(ticker_list)) as span:
+                df = data_collector.get_data(ticker_list)
+                span.count(rows=0 if df is None else df.shape[0])
+                return df
+
+        frames, errors = scheduler.run(get_data, {category: (category, ticker_list)
+                                                  for category, ticker_list in tickers.items()})
+        data_collector.fetcher.close()
+        downloaded = dict()
+        for category, ticker_list in tickers.items():
+            if category in errors:
+                print(category, '>> failed:', errors[category])
+                continue
+            if frames[category] is None:
+                print(category, '>> no data')
+                continue
+            print(category,'>>',len(ticker_list))
+            downloaded[category] = (ticker_list, frames[category])
+        return downloaded
+
+    def convert(self, data_collector:DataCollector, downloaded:dict, name:str='history') -> DataFrame:
+        '''the long (ticker, timestamp, ...) table of every downloaded category, None when there is none'''
+        converted = list()
+        for category, (ticker_list, frame) in downloaded.items():
+            with self.recorder.stage('convert:' + category, tickers=len(ticker_list)) as span:
+                converted.append(data_collector.convert_data_frame(frame, tickers=ticker_list))
+                span.count(rows=converted[-1].shape[0])
+        if len(converted) == 0:
+            return None
+        df = data_collector.schema.concat(converted)
+        with self.recorder.stage('schema') as span:
+            span.count(**data_collector.schema.report(name, df))
+        return df
+
+    def collect(self, data_collector:DataCollector) -> DataFrame:
+        '''download and convert; None when no category could be downloaded'''
+        return self.convert(data_collector, self.download(data_collector))
+
+    def download_data(self) -> int:
+        data_collector = self.data_collector()
+        # check the output location before downloading
+        o_filename = self.tables.prepare(self.p_reader.history_startswith)
         print('Data Downloader Output File:', o_filename)
         if o_filename is None:
             sys.exit(-1)
 
-        # download and save data
-        for category, ticker_list in tickers.items():
-            time.sleep(2)
-            print(category,'>>',len(ticker_list))
-            df = data_collector.get_data(name=ticker_list)
-            records = data_collector.convert_data_list(df)
-            data_collector.save_output(filename=o_filename, records=records)
+        # download all categories, then save data in one bulk write; a rerun on the same day replaces the file
+        df = self.collect(data_collector)
+        if df is not None:
+            with self.recorder.stage('write', rows=df.shape[0], tickers=df['ticker'].nunique()):
+                self.tables.write(self.p_reader.history_startswith, df)
         return 1
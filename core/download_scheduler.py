@@ -0,0 +1,75 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TokenBucket:
+    '''
+    thread safe token bucket: `rate` tokens per second, at most `burst` stored.
+    A rate <= 0 disables limiting.
+    '''
+    def __init__(self, rate:float, burst:int=1):
+        self.rate = float(rate)
+        self.burst = max(int(burst), 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class DownloadScheduler:
+    '''
+    Runs download jobs on a thread pool. Every attempt takes a token from a shared TokenBucket,
+    so the request rate follows the provider limit rather than the number of jobs; failed attempts
+    are retried with exponential backoff and jitter.
+    '''
+    def __init__(self, concurrency:int=4, rate:float=1.0, burst:int=2, retries:int=3, backoff:float=2.0,
+                 max_backoff:float=60.0):
+        self.concurrency = max(int(concurrency), 1)
+        self.bucket = TokenBucket(rate=rate, burst=burst)
+        self.retries = max(int(retries), 0)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.random = random.Random()
+
+    def __attempt(self, name, job, *args):
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            try:
+                return job(*args), None
+            except Exception as e:
+                if attempt == self.retries:
+                    return None, e
+                delay = min(self.backoff * (2 ** attempt), self.max_backoff)
+                delay = delay * (0.5 + self.random.random())
+                print(name, 'attempt', attempt + 1, 'failed:', e, '- retrying in %.1fs' % delay)
+                time.sleep(delay)
+
+    def run(self, job, args:dict) -> (dict, dict):
+        '''
+        job(*args[name]) for every name; returns ({name: result}, {name: exception}) in the order of `args`
+        '''
+        results, errors = dict(), dict()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            futures = {name: pool.submit(self.__attempt, name, job, *job_args) for name, job_args in args.items()}
+            for name, future in futures.items():
+                result, error = future.result()
+                if error is None:
+                    results[name] = result
+                else:
+                    errors[name] = error
+        return results, errors
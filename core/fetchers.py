@@ -0,0 +1,81 @@
+import random
+import threading
+import time
+import pandas as pd
+from common.synthetic import SyntheticMarket
+
+
+class FetchError(Exception):
+    pass
+
+
+class Fetcher:
+    '''
+    Source of OHLCV history. `fetch` returns a yf.download shaped frame, reset to a 'Date' column:
+    columns are (field, ticker) when several tickers are requested.
+    '''
+    name = None
+
+    def fetch(self, tickers:list, interval:str, period:str=None, start:str=None, end:str=None) -> pd.DataFrame:
+        raise NotImplementedError
+
+    def close(self):
+        '''called once all downloads of a run are done'''
+        pass
+
+    def _with_date_column(self, df:pd.DataFrame) -> pd.DataFrame:
+        # yfinance names the index 'Date' for daily bars and 'Datetime' for intraday bars
+        df = df.reset_index()
+        return df.rename(columns={df.columns[0][0] if isinstance(df.columns[0], tuple) else df.columns[0]: 'Date'})
+
+
+class YahooFetcher(Fetcher):
+    name = 'yahoo'
+
+    def fetch(self, tickers:list, interval:str, period:str=None, start:str=None, end:str=None) -> pd.DataFrame:
+        import yfinance as yf
+        if period is not None and len(period.strip()) > 0:
+            df = yf.download(tickers=tickers, period=period, interval=interval, threads=False, progress=False)
+        else:
+            df = yf.download(tickers=tickers, start=start, end=end, interval=interval, threads=False, progress=False)
+        if df is None or df.shape[0] == 0:
+            raise FetchError('no data returned for ' + ','.join(tickers))
+        return self._with_date_column(df)
+
+
+class SyntheticFetcher(Fetcher):
+    '''
+    offline stand-in for YahooFetcher serving SyntheticMarket bars, with injected latency
+    (uniform in [latency * (1 - jitter), latency * (1 + jitter)] seconds) and a failure rate
+    '''
+    name = 'synthetic'
+
+    def __init__(self, latency:float=0.0, jitter:float=0.5, failure_rate:float=0.0, seed:int=0, end:str=None):
+        self.market = SyntheticMarket(seed=seed, end=end)
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def fetch(self, tickers:list, interval:str, period:str=None, start:str=None, end:str=None) -> pd.DataFrame:
+        with self.lock:
+            self.calls += 1
+            delay = self.latency * (1 + self.jitter * (2 * self.random.random() - 1))
+            fail = self.random.random() < self.failure_rate
+        time.sleep(max(delay, 0.0))
+        if fail:
+            raise FetchError('injected failure for %d tickers' % len(tickers))
+        df = self.market.download_frame(tickers, interval=interval, period=period, start=start, end=end)
+        return self._with_date_column(df)
+
+
+FETCHERS = {fetcher.name: fetcher for fetcher in (YahooFetcher, SyntheticFetcher)}
+
+
+def get_fetcher(name:str, **kwargs) -> Fetcher:
+    name = 'yahoo' if name is None or len(name.strip()) == 0 else name.strip().lower()
+    if name not in FETCHERS:
+        raise ValueError('unknown loader.fetcher ' + name + ', expected one of ' + ', '.join(FETCHERS))
+    return FETCHERS[name](**kwargs)
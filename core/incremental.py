@@ -0,0 +1,137 @@
+import numpy as np
+import pandas as pd
+from core import kernels
+from core.ticker_blocks import TickerBlocks
+
+
+class IncrementalIndicators:
+    '''
+    Continues every EMA and supertrend from the trailing state of the previous run instead of
+    recomputing the whole history.
+
+    The state keeps, per ticker: the EMA recurrences (last value and weights), the ATR recurrence,
+    the final upper/lower bands, direction, last close and supertrend value, the number of bars seen
+    and the timestamp of the last bar folded into the state. The newest bar of every ticker is never
+    folded in, because the data source may still revise it; it is recomputed on the next run.
+    '''
+    def __init__(self, emas:list, supertrends:list):
+        self.emas = list(emas)
+        self.supertrends = [tuple(sup) for sup in supertrends]
+
+    def config_key(self) -> tuple:
+        # states written before timestamps became epoch seconds are not reused
+        return 'epoch', tuple(self.emas), tuple(self.supertrends)
+
+    def usable(self, state:dict) -> bool:
+        return state is not None and state.get('config') == self.config_key()
+
+    def new_rows(self, df:pd.DataFrame, state:dict) -> pd.Series:
+        '''bars after the last timestamp folded into the state; every bar of an unknown ticker'''
+        if state is None:
+            return pd.Series(True, index=df.index)
+        last = self.last_timestamps(df['ticker'], state)
+        return last.isna() | (df['timestamp'] > last)
+
+    def old_rows(self, previous:pd.DataFrame, tickers, state:dict) -> pd.DataFrame:
+        '''rows of the previous output that are already covered by the state'''
+        previous = previous[previous['ticker'].isin(set(tickers))]
+        last = self.last_timestamps(previous['ticker'], state)
+        return previous[previous['timestamp'] <= last]
+
+    @staticmethod
+    def last_timestamps(tickers:pd.Series, state:dict) -> pd.Series:
+        '''
+        the state's last timestamp of every row's ticker, NaN for unknown tickers. Mapped on strings:
+        a one-to-one map of a categorical ticker column returns a categorical, which cannot be compared with <
+        '''
+        last = tickers.astype(str).map(dict(zip(state['tickers'], state['last_timestamp'])))
+        return last.astype('float64')
+
+    def __take(self, state, index:np.ndarray, fresh):
+        if isinstance(fresh, dict):
+            return {key: self.__take(None if state is None else state[key], index, fresh[key]) for key in fresh}
+        if state is None:
+            return fresh
+        return np.where(index >= 0, state[np.maximum(index, 0)], fresh)
+
+    def __align(self, state:dict, tickers:np.ndarray) -> dict:
+        n = len(tickers)
+        fresh = {'last_timestamp': np.full(n, None, dtype=object),
+                 'emas': {ema: kernels.ewm_state(n) for ema in self.emas},
+                 'supertrends': {sup[2]: kernels.supertrend_state(n) for sup in self.supertrends}}
+        if state is None:
+            return fresh
+        position = {ticker: i for i, ticker in enumerate(state['tickers'])}
+        index = np.array([position.get(ticker, -1) for ticker in tickers], dtype=np.int64)
+        return {'last_timestamp': self.__take(state['last_timestamp'], index, fresh['last_timestamp']),
+                'emas': self.__take(state['emas'], index, fresh['emas']),
+                'supertrends': self.__take(state['supertrends'], index, fresh['supertrends'])}
+
+    def __merge(self, state:dict, tickers:np.ndarray, updated:dict) -> dict:
+        '''updated entries for `tickers`, everything else carried over from `state`'''
+        if state is None:
+            keep = np.zeros(0, dtype=np.int64)
+            old_tickers = np.zeros(0, dtype=object)
+        else:
+            keep = np.flatnonzero(~np.isin(state['tickers'], tickers))
+            old_tickers = state['tickers'][keep]
+
+        def merge(old, new):
+            if isinstance(new, dict):
+                return {key: merge(None if old is None else old[key], new[key]) for key in new}
+            return new if old is None else np.concatenate([old[keep], new])
+        merged = merge(None if state is None else {k: state[k] for k in updated}, updated)
+        merged['tickers'] = np.concatenate([old_tickers, np.asarray(tickers, dtype=object)])
+        merged['config'] = self.config_key()
+        return merged
+
+    def __run(self, state:dict, lengths:np.ndarray, columns:dict):
+        '''one kernel pass over the packed `columns`; returns the outputs and the state after the pass'''
+        outputs = dict()
+        ema_states = dict()
+        for ema in self.emas:
+            outputs['ema' + str(ema)], ema_states[ema] = kernels.ema(columns['close'], span=ema, lengths=lengths,
+                                                                     state=state['emas'][ema], return_state=True)
+        results = kernels.batched_supertrend(columns['high'], columns['low'], columns['close'], params=self.supertrends,
+                                             lengths=lengths, return_state=True,
+                                             states=[state['supertrends'][sup[2]] for sup in self.supertrends])
+        sup_states = dict()
+        for sup, (trend, _, sup_state) in zip(self.supertrends, results):
+            outputs['sup_' + sup[2]] = trend
+            sup_states[sup[2]] = sup_state
+        return outputs, {'emas': ema_states, 'supertrends': sup_states}
+
+    def compute(self, blocks:TickerBlocks, state:dict) -> (pd.DataFrame, dict):
+        '''
+        indicator columns for the rows of `blocks` (new bars only), continuing from `state`.
+        Returns the frame and the state to persist for the next run.
+        '''
+        n = len(blocks)
+        start = self.__align(state, blocks.tickers)
+        columns = {col: blocks.pack(col) for col in ('high', 'low', 'close')}
+        rows = np.arange(n)
+        last = blocks.lengths - 1
+
+        # everything except the newest bar of each ticker is folded into the next state ...
+        outputs, folded = self.__run(start, last, columns)
+        # ... and the newest bar is computed on top of it
+        last_columns = {col: values[rows, last][:, None] for col, values in columns.items()}
+        last_outputs, _ = self.__run(folded, np.ones(n, dtype=np.int64), last_columns)
+        for name, values in outputs.items():
+            values[rows, last] = last_outputs[name][:, 0]
+
+        for ema in self.emas:
+            blocks.assign('ema' + str(ema), outputs['ema' + str(ema)])
+        for period, multiplier, identifier in self.supertrends:
+            prev = start['supertrends'][identifier]
+            buys, sells = kernels.continued_crossovers(close=columns['close'], line=outputs['sup_' + identifier],
+                                                       period=period, prev_close=prev['close'],
+                                                       prev_line=prev['trend'], bars_seen=prev['bars'])
+            blocks.assign('sup_' + identifier, outputs['sup_' + identifier])
+            blocks.assign('buy_' + identifier, buys)
+            blocks.assign('sell_' + identifier, sells)
+
+        timestamps = blocks.df['timestamp'].to_numpy(dtype=object)
+        folded_ts = np.where(last > 0, timestamps[np.maximum(blocks.ends - 2, 0)], start['last_timestamp'])
+        folded['last_timestamp'] = folded_ts.astype(object)
+        return blocks.df, self.__merge(state, blocks.tickers, folded)
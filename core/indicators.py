@@ -1,126 +1,388 @@
 import numpy as np
 import pandas as pd
-import pandas_ta as ta
 import warnings
-import json
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date
 from pathlib import Path
+from common.instrumentation import Recorder
+from common.shared_arrays import SharedArrays
 from common.utilities import Utilities
 from common.property_reader import PropertyReader
+from common.schema import Schema
+from common.dataset import StageTables
+from common.storage import get_storage
+from core import kernels, rolling
+from core.incremental import IncrementalIndicators
+from core.rules import DEFAULT_RULES, RuleSet
+from core.signal_index import SignalIndexBuilder
+from core.ticker_blocks import TickerBlocks
 warnings.filterwarnings("ignore")
 
+PRICE_COLUMNS = ['high', 'low', 'close']
+
+_shared = None
+
+
+def _attach(specs:dict):
+    global _shared
+    _shared = SharedArrays.attach(specs)
 
-class Indicators:
-    def __init__(self):
-        return
 
-    def __is_support(self, df:pd.DataFrame, i:int):
-        support = df['Low'][i] < df['Low'][i-1]  and df['Low'][i] < df['Low'][i+1] \
-                  and df['Low'][i+1] < df['Low'][i+2] and df['Low'][i-1] < df['Low'][i-2]
-        return support
-
-    def __is_resistance(self, df:pd.DataFrame, i:int):
-        resistance = df['High'][i] > df['High'][i-1]  and df['High'][i] > df['High'][i+1] \
-                     and df['High'][i+1] > df['High'][i+2] and df['High'][i-1] > df['High'][i-2]
-        return resistance
-
-    def __is_far_from_level(self, l, levels, s):
-        return np.sum([abs(l-x) < s for x in levels]) == 0
-
-    def __calculate_levels(self, df:pd.DataFrame):
-        support = []
-        resistance = []
-        levels = []
-        s = np.mean(df['High'] - df['Low'])
-        for i in range(2, df.shape[0]-2):
-            if self.__is_support(df, i):
-                l = df['Low'][i]
-                if self.__is_far_from_level(l, levels, s):
-                    levels.append((i, l))
-                    support.append((i, l))
-            elif self.__is_resistance(df, i):
-                l = df['High'][i]
-                if self.__is_far_from_level(l, levels, s):
-                    levels.append((i, l))
-                    resistance.append((i, l))
-        return levels, support, resistance
+def indicator_shard(task:dict) -> int:
+    '''
+    every ema and supertrend of one shard of tickers (rows of the shared (tickers, bars) matrices),
+    cut to the shard's longest history; results are written to the shared output matrices
+    '''
+    rows = np.asarray(task['rows'], dtype=np.int64)
+    lengths = _shared['lengths'][rows]
+    width = int(lengths.max())
+    high, low, close = (_shared[col][rows, :width] for col in PRICE_COLUMNS)
+    for ema in task['emas']:
+        _shared['ema' + str(ema)][rows, :width] = kernels.ema(close, span=ema, lengths=lengths)
+    results = kernels.batched_supertrend(high, low, close, params=task['supertrends'], lengths=lengths)
+    for (period, multiplier, identifier), (trend, _) in zip(task['supertrends'], results):
+        buys, sells = kernels.crossovers(close=close, line=trend, start=period - 1)
+        _shared['sup_' + identifier][rows, :width] = trend
+        _shared['buy_' + identifier][rows, :width] = buys
+        _shared['sell_' + identifier][rows, :width] = sells
+    return len(rows)
+
+
+class Indicators:
+    def __init__(self, recorder:Recorder=None, schema:Schema=None):
+        self.recorder = Recorder.disabled() if recorder is None else recorder
+        self.schema = Schema.legacy() if schema is None else schema
 
     def calculate_ema(self, df1:pd.DataFrame, ema:int, col_name:str='close') -> pd.DataFrame:
         df1['ema' + str(ema)] = df1[col_name].ewm(span=ema, min_periods=0, adjust=False, ignore_na=False).mean()
         return df1
 
+    def calculate_crossovers(self, close:np.ndarray, line:np.ndarray, start:int):
+        '''
+        buy[i] = 1.0 when close crosses above `line` at bar i, sell[i] = 1.0 when it crosses below.
+        Bars before `start` (the indicator warm-up) and bar 0 are never flagged.
+        Comparisons against NaN are False, so bars without a `line` value are skipped as well.
+        '''
+        return kernels.crossovers(close=close, line=line, start=start)
+
     def calculate_supertrend(self, df_t:pd.DataFrame, identifier:str, period:int, multiplier:int):
-        r_col = 'SUPERT_7_' + str(int(multiplier)) + '.0'
         l_col = 'sup_' + identifier
-        df_t[l_col] = ta.supertrend(high=df_t['high'], low=df_t['low'], close=df_t['close'], period=period, multiplier=multiplier)[r_col]
-
-        df_t['buy_' + identifier] = 0.0
-        df_t['sell_' + identifier] = 0.0
-        n = period - 1
-        for i in range(n, len(df_t)):
-            if df_t['close'][i - 1] <= df_t['sup_' + identifier][i - 1] and df_t['close'][i] > \
-                    df_t['sup_' + identifier][i]:
-                df_t['buy_' + identifier][i] = 1.0
-            if df_t['close'][i - 1] >= df_t['sup_' + identifier][i - 1] and df_t['close'][i] < \
-                    df_t['sup_' + identifier][i]:
-                df_t['sell_' + identifier][i] = 1.0
+        high = df_t['high'].to_numpy(dtype=float)[None, :]
+        low = df_t['low'].to_numpy(dtype=float)[None, :]
+        close = df_t['close'].to_numpy(dtype=float)[None, :]
+        trend, _ = kernels.supertrend(high=high, low=low, close=close, length=period, multiplier=multiplier)
+        df_t[l_col] = trend[0]
+
+        buys, sells = self.calculate_crossovers(close=close[0], line=trend[0], start=period - 1)
+        df_t['buy_' + identifier] = buys
+        df_t['sell_' + identifier] = sells
         return df_t
 
+    def calculate_emas(self, blocks:TickerBlocks, emas:list, col_name:str='close') -> pd.DataFrame:
+        values = blocks.pack(col_name)
+        for ema in emas:
+            with self.recorder.stage('ema' + str(ema), rows=blocks.df.shape[0]):
+                blocks.assign('ema' + str(ema), kernels.ema(values, span=ema, lengths=blocks.lengths),
+                              dtype=self.schema.float_dtype)
+        return blocks.df
+
+    def calculate_supertrends(self, blocks:TickerBlocks, supertrends:list) -> pd.DataFrame:
+        '''
+        every (period, multiplier, identifier) supertrend for every ticker in one batch
+        '''
+        high, low, close = blocks.pack('high'), blocks.pack('low'), blocks.pack('close')
+        # the supertrends share one pass over the bars, so they are timed together
+        with self.recorder.stage('supertrends', rows=blocks.df.shape[0], lines=len(supertrends)):
+            results = kernels.batched_supertrend(high, low, close, params=supertrends, lengths=blocks.lengths)
+        for (period, multiplier, identifier), (trend, _) in zip(supertrends, results):
+            with self.recorder.stage('crossovers_' + identifier, rows=blocks.df.shape[0]):
+                buys, sells = kernels.crossovers(close=close, line=trend, start=period - 1)
+                blocks.assign('sup_' + identifier, trend, dtype=self.schema.float_dtype)
+                blocks.assign('buy_' + identifier, buys, dtype=self.schema.flag_dtype)
+                blocks.assign('sell_' + identifier, sells, dtype=self.schema.flag_dtype)
+        return blocks.df
+
+    def calculate_sharded(self, blocks:TickerBlocks, emas:list, supertrends:list, workers:int) -> pd.DataFrame:
+        '''
+        calculate_emas and calculate_supertrends on a pool of `workers` processes. Tickers are
+        sharded by bar count (TickerBlocks.shards); inputs and results are (tickers, bars) matrices
+        in shared memory, and every row is computed by exactly one worker with the serial kernels,
+        so the columns are identical to the serial ones and are assigned in the same order.
+        '''
+        arrays = {col: blocks.pack(col) for col in PRICE_COLUMNS}
+        arrays['lengths'] = blocks.lengths
+        outputs = ['ema' + str(ema) for ema in emas]
+        for _, _, identifier in supertrends:
+            outputs += ['sup_' + identifier, 'buy_' + identifier, 'sell_' + identifier]
+        for name in outputs:
+            arrays[name] = np.empty((len(blocks), blocks.width))
+        shards = blocks.shards(workers)
+        tasks = [{'rows': rows, 'emas': list(emas), 'supertrends': [tuple(st) for st in supertrends]} for rows in shards]
+
+        with SharedArrays(arrays) as shared:
+            # only the shared copies are kept
+            del arrays
+            with self.recorder.stage('shards', rows=blocks.df.shape[0], workers=workers, shards=len(tasks)):
+                with ProcessPoolExecutor(max_workers=len(tasks), initializer=_attach, initargs=(shared.specs,)) as executor:
+                    # workers only return row counts, the columns stay in shared memory
+                    for future in [executor.submit(indicator_shard, task) for task in tasks]:
+                        future.result()
+            for name in outputs:
+                dtype = self.schema.float_dtype if name.startswith(('ema', 'sup_')) else self.schema.flag_dtype
+                blocks.assign(name, shared[name], dtype=dtype)
+        return blocks.df
+
+    def calculate_smas(self, blocks:TickerBlocks, smas:list, col_name:str='close') -> pd.DataFrame:
+        values = blocks.pack(col_name)
+        for window in smas:
+            blocks.assign('sma' + str(window), rolling.sma(values, window, lengths=blocks.lengths),
+                          dtype=self.schema.float_dtype)
+        return blocks.df
+
+    def calculate_bollinger(self, blocks:TickerBlocks, bands:list, col_name:str='close') -> pd.DataFrame:
+        '''every (window, width, identifier) band: bb_mid_<id> is the SMA, bb_upper_<id> / bb_lower_<id> +- width std'''
+        values = blocks.pack(col_name)
+        for window, width, identifier in bands:
+            lines = rolling.bollinger(values, window, width, lengths=blocks.lengths)
+            for name, line in zip(('bb_mid_', 'bb_upper_', 'bb_lower_'), lines):
+                blocks.assign(name + str(identifier), line, dtype=self.schema.float_dtype)
+        return blocks.df
+
+    def calculate_vwap(self, blocks:TickerBlocks, session_start:str='09:30', timezone:str='America/New_York') -> pd.DataFrame:
+        sessions = rolling.session_keys(blocks.pack('timestamp'), session_start=session_start, timezone=timezone)
+        vwap = rolling.session_vwap(blocks.pack('high'), blocks.pack('low'), blocks.pack('close'), blocks.pack('volume'),
+                                    sessions, lengths=blocks.lengths)
+        blocks.assign('vwap', vwap, dtype=self.schema.float_dtype)
+        return blocks.df
+
+    def calculate_prev_highs(self, blocks:TickerBlocks, windows:list) -> pd.DataFrame:
+        '''prev_high<n> / prev_low<n>: the highest high / lowest low of the n bars before each bar'''
+        high, low = blocks.pack('high'), blocks.pack('low')
+        for window in windows:
+            highest = rolling.previous(rolling.rolling_max(high, window), lengths=blocks.lengths)
+            lowest = rolling.previous(rolling.rolling_min(low, window), lengths=blocks.lengths)
+            blocks.assign('prev_high' + str(window), highest, dtype=self.schema.float_dtype)
+            blocks.assign('prev_low' + str(window), lowest, dtype=self.schema.float_dtype)
+        return blocks.df
+
+    def calculate_levels(self, blocks:TickerBlocks, window:int=2) -> pd.DataFrame:
+        '''
+        support / resistance levels per ticker: 'support' holds the low of a fractal support pivot,
+        'resistance' the high of a resistance pivot, on the bar that confirms the pivot (`window`
+        bars after it) and NaN on every other bar. A pivot only becomes a level when it is at least
+        the ticker's mean bar range so far away from the earlier levels.
+        '''
+        support, resistance = kernels.support_resistance(blocks.pack('low'), blocks.pack('high'),
+                                                         lengths=blocks.lengths, window=window)
+        blocks.assign('support', support, dtype=self.schema.float_dtype)
+        blocks.assign('resistance', resistance, dtype=self.schema.float_dtype)
+        return blocks.df
+
 
 class IndicatorCalculator:
-    def __init__(self, prop_file):
+    def __init__(self, prop_file, recorder:Recorder=None):
         self.p_reader = PropertyReader(prop_file=prop_file)
-        self.indicators = Indicators()
+        self.recorder = Recorder.disabled() if recorder is None else recorder
+        self.schema = Schema.from_properties(self.p_reader)
+        self.indicators = Indicators(recorder=self.recorder, schema=self.schema)
         self.utilities = Utilities()
+        self.storage = get_storage(self.p_reader.storage_format)
+        self.tables = StageTables(self.p_reader, schema=self.schema)
 
     def read_history_file(self) -> pd.DataFrame:
-        _dir = self.p_reader.historical_dir
-        _startswith = self.p_reader.history_startswith
-        latest_file = self.utilities.get_latest_file(directory=_dir, startswith=_startswith)
-
-        data = list()
-        with open(latest_file, 'r') as handler:
-            for line in handler:
-                js = json.loads(line)
-                data.append(js)
-        df = pd.DataFrame(data)
-        df = df.drop_duplicates(keep='first')
-        return df
+        return self.tables.read(self.p_reader.history_startswith)
 
     def create_ouput_file(self, df:pd.DataFrame) -> str:
-        _dir = self.p_reader.historical_dir
-        _startswith = self.p_reader.indicator_startswith
-        file_path = Path(_dir + '/' + _startswith + date.today().strftime("%Y_%m_%d"))
-        records = df.to_dict('records')
-        writer = open(str(file_path.absolute()), 'w')
-        for record in records:
-            writer.write(json.dumps(record))
-            writer.write('\n')
-        writer.close()
-        return str(file_path.absolute())
+        return self.tables.write(self.p_reader.indicator_startswith, df)
 
     def ema_supertrend_calculator(self, df:pd.DataFrame) -> pd.DataFrame:
-        tickers = set(df['ticker'])
-
-        temp = list()
-        for ticker in tickers:
-            df1 = df[df['ticker'] == ticker]
-            df1 = df1.reset_index()
-
-            for ema in self.p_reader.emas:
-                df1 = self.indicators.calculate_ema(df1, ema=ema, col_name='close')
-            for sup in self.p_reader.supertrends:
-                period = sup[0]
-                multiplier = sup[1]
-                identifier = sup[2]
-                df1 = self.indicators.calculate_supertrend(df_t=df1, identifier=identifier, period=period, multiplier=multiplier)
-            temp.append(df1)
-        df_indicator = pd.concat(temp)
-        return df_indicator
+        with self.recorder.stage('blocks', rows=df.shape[0]):
+            blocks = TickerBlocks(df)
+        if self.p_reader.indicator_workers > 1 and len(blocks) > 1:
+            return self.indicators.calculate_sharded(blocks, emas=self.p_reader.emas,
+                                                     supertrends=self.p_reader.supertrends,
+                                                     workers=self.p_reader.indicator_workers)
+        self.indicators.calculate_emas(blocks, emas=self.p_reader.emas, col_name='close')
+        self.indicators.calculate_supertrends(blocks, supertrends=self.p_reader.supertrends)
+        return blocks.df
+
+    def has_rolling(self) -> bool:
+        p = self.p_reader
+        return len(p.smas) > 0 or len(p.bollinger) > 0 or p.vwap or len(p.prev_highs) > 0
+
+    def rolling_calculator(self, df:pd.DataFrame) -> pd.DataFrame:
+        '''the indicator.smas / bollinger / vwap / prev_highs columns, always over every bar of the tickers'''
+        with self.recorder.stage('rolling', rows=df.shape[0]):
+            blocks = TickerBlocks(df)
+            self.indicators.calculate_smas(blocks, smas=self.p_reader.smas, col_name='close')
+            self.indicators.calculate_bollinger(blocks, bands=self.p_reader.bollinger, col_name='close')
+            if self.p_reader.vwap:
+                self.indicators.calculate_vwap(blocks, session_start=self.p_reader.session_start,
+                                               timezone=self.p_reader.session_timezone)
+            self.indicators.calculate_prev_highs(blocks, windows=self.p_reader.prev_highs)
+            return blocks.df
+
+    def levels_calculator(self, df:pd.DataFrame) -> pd.DataFrame:
+        with self.recorder.stage('levels', rows=df.shape[0]):
+            blocks = TickerBlocks(df)
+            return self.indicators.calculate_levels(blocks, window=self.p_reader.levels_window)
+
+    def read_state(self):
+        _dir = self.p_reader.historical_dir
+        _startswith = self.p_reader.state_startswith
+        try:
+            latest_file = self.utilities.get_latest_file(directory=_dir, startswith=_startswith)
+        except IndexError:
+            return None
+        return self.utilities.read_pkl(latest_file)
+
+    def save_state(self, state:dict) -> str:
+        _dir = self.p_reader.historical_dir
+        _startswith = self.p_reader.state_startswith
+        file_path = str(Path(_dir + '/' + _startswith + date.today().strftime("%Y_%m_%d")).absolute())
+        self.utilities.save_pkl(state, file_path)
+        return file_path
+
+    def signal_index_builder(self) -> SignalIndexBuilder:
+        rules = RuleSet(self.p_reader.strategy_rules or DEFAULT_RULES)
+        return SignalIndexBuilder(rules, last_bars=self.p_reader.signal_index_last_bars)
+
+    def save_signal_index(self, builder:SignalIndexBuilder) -> str:
+        _dir = self.p_reader.historical_dir
+        _startswith = self.p_reader.signal_index_startswith
+        return builder.save(str(Path(_dir + '/' + _startswith + date.today().strftime("%Y_%m_%d")).absolute()))
+
+    def incremental_calculator(self, df:pd.DataFrame) -> (pd.DataFrame, dict):
+        '''
+        only the bars after the last timestamp of the saved state are computed; older rows are
+        taken from the indicator file the state was saved with. Without a usable state (first run,
+        changed `indicator.emas`/`indicator.supertrends`, indicator file replaced) every bar is computed.
+        '''
+        incremental = IncrementalIndicators(emas=self.p_reader.emas, supertrends=self.p_reader.supertrends)
+        state = self.read_state()
+        previous = None
+        if incremental.usable(state):
+            latest_file = self.tables.latest(self.p_reader.indicator_startswith)
+            if latest_file == state.get('indicator_file'):
+                previous = self.tables.read(self.p_reader.indicator_startswith)
+        if previous is None:
+            print('no usable indicator state, computing all bars')
+            state = None
+
+        new = incremental.new_rows(df, state)
+        print('incremental indicators: %d of %d bars are new' % (int(new.sum()), df.shape[0]))
+        df_new, new_state = incremental.compute(TickerBlocks(df[new]), state)
+        if previous is None:
+            df_indicator = df_new
+        else:
+            df_old = incremental.old_rows(previous, tickers=df['ticker'].unique(), state=state)
+            df_indicator = self.schema.concat([df_old[df_new.columns], df_new])
+            df_indicator = df_indicator.sort_values(['ticker', 'timestamp'], kind='mergesort', ignore_index=True)
+        # same column types as a full recompute, which the verification compares against
+        self.schema.compact(df_indicator)
+
+        if self.p_reader.incremental_verify and not self.verify_incremental(df_indicator, history_cols=list(df.columns)):
+            print('incremental indicators differ from a full recompute, using the full recompute')
+            df_indicator, new_state = incremental.compute(TickerBlocks(df_indicator[list(df.columns)]), None)
+        return df_indicator, new_state
+
+    def verify_incremental(self, df_indicator:pd.DataFrame, history_cols:list) -> bool:
+        '''recompute every indicator over the same bars and compare column by column'''
+        full = self.ema_supertrend_calculator(df_indicator[history_cols].copy())
+        same = True
+        for col in full.columns:
+            if col in history_cols:
+                continue
+            a = df_indicator[col].to_numpy(dtype=float)
+            b = full[col].to_numpy(dtype=float)
+            if not np.array_equal(a, b, equal_nan=True):
+                diff = np.nanmax(np.abs(a - b)) if np.any(~np.isnan(a - b)) else np.nan
+                print('incremental check:', col, 'differs, max abs diff', diff)
+                same = False
+        return same
+
+    def compute(self, df:pd.DataFrame) -> (pd.DataFrame, dict):
+        '''indicator table and, in incremental mode, the state to save with it; `df` is not modified'''
+        state = None
+        if self.p_reader.incremental:
+            with self.recorder.stage('incremental', rows=df.shape[0]):
+                df, state = self.incremental_calculator(df)
+        else:
+            df = self.ema_supertrend_calculator(df)
+        if self.has_rolling():
+            df = self.rolling_calculator(df)
+        if self.p_reader.levels:
+            df = self.levels_calculator(df)
+        with self.recorder.stage('schema') as span:
+            self.schema.compact(df)
+            span.count(**self.schema.report('indicators', df))
+        return df, state
+
+    def write_output(self, df:pd.DataFrame, state:dict=None) -> str:
+        with self.recorder.stage('write', rows=df.shape[0], columns=df.shape[1]):
+            o_filename = self.create_ouput_file(df)
+        if state is not None:
+            state['indicator_file'] = o_filename
+            with self.recorder.stage('save_state'):
+                self.save_state(state)
+        if self.p_reader.signal_index:
+            with self.recorder.stage('signal_index', rows=df.shape[0]):
+                builder = self.signal_index_builder()
+                builder.add(df)
+                self.save_signal_index(builder)
+        return o_filename
+
+    def batch_rows(self) -> int:
+        '''
+        history rows per out-of-core batch for indicator.memory.mb, from the measured peak working
+        set of the float64 kernels: about 160 bytes per row plus 32 per ema, 80 per supertrend and
+        24 per rolling column
+        '''
+        p = self.p_reader
+        rolling_columns = len(p.smas) + 3 * len(p.bollinger) + int(p.vwap) + 2 * len(p.prev_highs)
+        per_row = 160 + 32 * len(p.emas) + 80 * len(p.supertrends) + 24 * rolling_columns
+        return max(int(self.p_reader.indicator_memory_mb * 2 ** 20 / per_row), 1)
+
+    def calculate_out_of_core(self) -> str:
+        '''
+        the full calculation one batch of whole tickers at a time: ChunkedReader.iter_ticker_batches
+        spills the history to disk by batch, and every computed batch is appended to the indicator
+        table right away. Each ticker still sees all of its bars, so the table equals the in memory one.
+        '''
+        reader = self.tables.reader(self.p_reader.history_startswith)
+        builder = self.signal_index_builder() if self.p_reader.signal_index else None
+        batch_rows = self.batch_rows()
+        print('out-of-core indicators: batches of up to %d rows' % batch_rows)
+        # a failed batch drops the partial table instead of leaving it next to the last complete one
+        with self.tables.writer(self.p_reader.indicator_startswith) as writer:
+            for batch in reader.iter_ticker_batches(batch_rows=batch_rows):
+                with self.recorder.stage('batch', rows=batch.shape[0], tickers=batch['ticker'].nunique()):
+                    df = self.ema_supertrend_calculator(batch)
+                    if self.has_rolling():
+                        df = self.rolling_calculator(df)
+                    if self.p_reader.levels:
+                        df = self.levels_calculator(df)
+                    self.schema.compact(df)
+                with self.recorder.stage('write', rows=df.shape[0]):
+                    writer.write(df)
+                if builder is not None:
+                    with self.recorder.stage('signal_index', rows=df.shape[0]):
+                        builder.add(df)
+                # freed before the next batch is built
+                del batch, df
+        if builder is not None:
+            self.save_signal_index(builder)
+        return writer.path
 
     def calculate_indicators(self):
-        df = self.read_history_file()
-        df = self.ema_supertrend_calculator(df)
-        # TODO - add support resistance levels
-        self.create_ouput_file(df)
+        if self.p_reader.indicator_memory_mb > 0:
+            if not self.p_reader.incremental:
+                self.calculate_out_of_core()
+                return
+            print('indicator.memory.mb applies to full calculations, computing incrementally in memory')
+        with self.recorder.stage('read') as span:
+            df = self.read_history_file()
+            span.count(rows=df.shape[0], tickers=df['ticker'].nunique())
+        df, state = self.compute(df)
+        self.write_output(df, state)
         return
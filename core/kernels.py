@@ -0,0 +1,346 @@
+'''
+Array kernels shared by the indicator stages.
+
+Every kernel works on 2-D float arrays shaped (rows, bars): one row per ticker (or per ticker and
+parameter set), bars left-aligned and right-padded with NaN for shorter histories. `lengths` gives
+the number of real bars in each row; outputs beyond a row's length are NaN. Time is walked once
+and every row is updated together, so the Python-level cost grows with the number of bars, not
+with the number of tickers.
+'''
+import bisect
+import sys
+import numpy as np
+
+
+def as_rows(value, n_rows:int, dtype=float) -> np.ndarray:
+    arr = np.asarray(value, dtype=dtype)
+    if arr.ndim == 0:
+        arr = np.full(n_rows, arr, dtype=dtype)
+    return arr
+
+
+def active_mask(lengths:np.ndarray, n_bars:int) -> np.ndarray:
+    return np.arange(n_bars)[None, :] < np.asarray(lengths)[:, None]
+
+
+def pad_groups(values:np.ndarray, codes:np.ndarray, positions:np.ndarray, n_groups:int, width:int) -> np.ndarray:
+    '''scatter a long column into a (groups, width) NaN padded matrix: row = codes, column = positions'''
+    out = np.full((n_groups, width), np.nan)
+    out[codes, positions] = values
+    return out
+
+
+def alpha_from_span(span) -> np.ndarray:
+    # same float path as pandas: span -> com -> alpha
+    com = (np.asarray(span, dtype=float) - 1) / 2.0
+    return 1. / (1. + com)
+
+
+def alpha_from_alpha(alpha) -> np.ndarray:
+    # pandas converts an explicit alpha to a center of mass and back
+    alpha = np.asarray(alpha, dtype=float)
+    com = (1.0 - alpha) / alpha
+    return 1. / (1. + com)
+
+
+def ewm_state(n_rows:int) -> dict:
+    '''state of a series that has not seen any bar yet'''
+    return {'weighted': np.full(n_rows, np.nan), 'old_wt': np.ones(n_rows), 'nobs': np.zeros(n_rows, dtype=np.int64)}
+
+
+def ewm_mean(values:np.ndarray, alpha, adjust:bool, min_periods=0, lengths=None, state:dict=None,
+             return_state:bool=False):
+    '''
+    Row-wise exponentially weighted mean, numerically identical to
+    `Series.ewm(alpha=alpha, adjust=adjust, min_periods=min_periods, ignore_na=False).mean()`.
+    `alpha` must already be normalised with alpha_from_span / alpha_from_alpha.
+    Passing the `state` returned by an earlier call continues those series instead of starting new ones.
+    '''
+    n_rows, n_bars = values.shape
+    alpha = as_rows(alpha, n_rows)
+    minp = np.maximum(as_rows(min_periods, n_rows, dtype=np.int64), 1)
+    lengths = as_rows(n_bars if lengths is None else lengths, n_rows, dtype=np.int64)
+    state = ewm_state(n_rows) if state is None else state
+
+    factor = 1. - alpha
+    new_wt = np.ones(n_rows) if adjust else alpha
+    weighted = state['weighted'].copy()
+    old_wt = state['old_wt'].copy()
+    nobs = state['nobs'].copy()
+
+    out = np.full((n_rows, n_bars), np.nan)
+    with np.errstate(invalid='ignore'):
+        for j in range(n_bars):
+            active = j < lengths
+            cur = values[:, j]
+            is_obs = (cur == cur) & active
+            nobs += is_obs
+            has_weight = (weighted == weighted) & active
+
+            old_wt = np.where(has_weight, old_wt * factor, old_wt)
+            update = has_weight & is_obs
+            mixed = (old_wt * weighted + new_wt * cur) / (old_wt + new_wt)
+            weighted_new = np.where(update & (weighted != cur), mixed, weighted)
+            if adjust:
+                old_wt = np.where(update, old_wt + new_wt, old_wt)
+            else:
+                old_wt = np.where(update, 1., old_wt)
+            weighted = np.where(~has_weight & is_obs, cur, weighted_new)
+
+            out[:, j] = np.where(active & (nobs >= minp), weighted, np.nan)
+    if return_state:
+        return out, {'weighted': weighted, 'old_wt': old_wt, 'nobs': nobs}
+    return out
+
+
+def ema(values:np.ndarray, span, lengths=None, state:dict=None, return_state:bool=False):
+    '''same as `ewm(span=span, min_periods=0, adjust=False, ignore_na=False).mean()`'''
+    return ewm_mean(values, alpha=alpha_from_span(span), adjust=False, min_periods=0, lengths=lengths,
+                    state=state, return_state=return_state)
+
+
+def true_range(high:np.ndarray, low:np.ndarray, close:np.ndarray, prev_close:np.ndarray=None,
+               has_zero:np.ndarray=None, first:np.ndarray=None) -> np.ndarray:
+    '''
+    pandas_ta.true_range: max(|high - low|, |high - prev close|, |low - prev close|).
+    The first bar of a series is NaN; rows where `first` is False continue a series from `prev_close`.
+    '''
+    high_low = high - low
+    # pandas_ta shifts the whole series by epsilon when any bar has high == low
+    if has_zero is None:
+        has_zero = np.any(high_low == 0, axis=1)
+    high_low[has_zero] += sys.float_info.epsilon
+
+    shifted = np.full_like(close, np.nan)
+    shifted[:, 1:] = close[:, :-1]
+    if prev_close is not None:
+        shifted[:, 0] = prev_close
+    tr = np.fmax(np.fmax(np.abs(high_low), np.abs(high - shifted)), np.abs(low - shifted))
+    first = np.ones(close.shape[0], dtype=bool) if first is None else first
+    tr[first, :1] = np.nan
+    return tr
+
+
+def atr(high:np.ndarray, low:np.ndarray, close:np.ndarray, length, lengths=None) -> np.ndarray:
+    '''pandas_ta.atr with the default 'rma' smoothing'''
+    length = as_rows(length, high.shape[0], dtype=np.int64)
+    return ewm_mean(true_range(high, low, close), alpha=alpha_from_alpha(1.0 / length),
+                    adjust=True, min_periods=length, lengths=lengths)
+
+
+def supertrend_state(n_rows:int) -> dict:
+    '''state of a supertrend that has not seen any bar yet'''
+    return {'atr': ewm_state(n_rows),
+            'bars': np.zeros(n_rows, dtype=np.int64),
+            'has_zero': np.zeros(n_rows, dtype=bool),
+            'close': np.full(n_rows, np.nan),
+            'upper': np.full(n_rows, np.nan),
+            'lower': np.full(n_rows, np.nan),
+            'direction': np.ones(n_rows),
+            'trend': np.full(n_rows, np.nan)}
+
+
+def supertrend(high:np.ndarray, low:np.ndarray, close:np.ndarray, length, multiplier, lengths=None,
+               state:dict=None, return_state:bool=False):
+    '''
+    pandas_ta.supertrend for every row at once. `length` and `multiplier` may differ per row.
+    Returns (trend, direction); like pandas_ta, the trend of the first bar is 0.0.
+    With `state` the rows continue earlier series: last close, ATR, final bands and direction.
+    '''
+    n_rows, n_bars = close.shape
+    length = as_rows(length, n_rows, dtype=np.int64)
+    multiplier = as_rows(multiplier, n_rows)
+    lengths = as_rows(n_bars if lengths is None else lengths, n_rows, dtype=np.int64)
+    state = supertrend_state(n_rows) if state is None else state
+    active = active_mask(lengths, n_bars)
+
+    has_zero = state['has_zero'] | np.any(((high - low) == 0) & active, axis=1)
+    tr = true_range(high, low, close, prev_close=state['close'], has_zero=has_zero, first=state['bars'] == 0)
+    matr, atr_state = ewm_mean(tr, alpha=alpha_from_alpha(1.0 / length), adjust=True, min_periods=length,
+                               lengths=lengths, state=state['atr'], return_state=True)
+    hl2 = 0.5 * (high + low)
+    matr = multiplier[:, None] * matr
+    upper = hl2 + matr
+    lower = hl2 - matr
+
+    prev_upper, prev_lower = state['upper'].copy(), state['lower'].copy()
+    prev_direction, prev_close, prev_trend = state['direction'].copy(), state['close'].copy(), state['trend'].copy()
+    bars = state['bars'].copy()
+    trend = np.full((n_rows, n_bars), np.nan)
+    direction = np.full((n_rows, n_bars), np.nan)
+    with np.errstate(invalid='ignore'):
+        for i in range(n_bars):
+            act = active[:, i]
+            cross_up = close[:, i] > prev_upper
+            cross_down = close[:, i] < prev_lower
+            d = np.where(cross_up, 1., np.where(cross_down, -1., prev_direction))
+            hold = ~cross_up & ~cross_down
+            lo = np.where(hold & (d > 0) & (lower[:, i] < prev_lower), prev_lower, lower[:, i])
+            up = np.where(hold & (d < 0) & (upper[:, i] > prev_upper), prev_upper, upper[:, i])
+            t = np.where(bars == 0, 0.0, np.where(d > 0, lo, up))
+            trend[:, i] = np.where(act, t, np.nan)
+            direction[:, i] = np.where(act, d, np.nan)
+
+            prev_upper = np.where(act, up, prev_upper)
+            prev_lower = np.where(act, lo, prev_lower)
+            prev_direction = np.where(act, d, prev_direction)
+            prev_close = np.where(act, close[:, i], prev_close)
+            prev_trend = np.where(act, t, prev_trend)
+            bars = bars + act
+
+    if return_state:
+        return trend, direction, {'atr': atr_state, 'bars': bars, 'has_zero': has_zero, 'close': prev_close,
+                                  'upper': prev_upper, 'lower': prev_lower, 'direction': prev_direction,
+                                  'trend': prev_trend}
+    return trend, direction
+
+
+def stack_states(states:list) -> dict:
+    '''concatenate per-row states (nested dicts of arrays) along the row axis'''
+    return {key: stack_states([st[key] for st in states]) if isinstance(states[0][key], dict)
+            else np.concatenate([st[key] for st in states]) for key in states[0]}
+
+
+def split_state(state:dict, n_parts:int) -> list:
+    def part(value, k):
+        if isinstance(value, dict):
+            return {key: part(v, k) for key, v in value.items()}
+        size = len(value) // n_parts
+        return value[k * size:(k + 1) * size]
+    return [part(state, k) for k in range(n_parts)]
+
+
+def batched_supertrend(high:np.ndarray, low:np.ndarray, close:np.ndarray, params:list, lengths=None,
+                       states:list=None, return_state:bool=False) -> list:
+    '''
+    all (period, multiplier, ...) parameter sets in one pass: the (tickers, bars) inputs are stacked
+    once per parameter set and walked together. Returns one (trend, direction) pair per parameter set,
+    or (trend, direction, state) with `return_state`; `states` continues earlier series.
+    '''
+    n_rows, n_bars = close.shape
+    n_params = len(params)
+    if n_params == 0:
+        return []
+    periods = np.repeat([int(p[0]) for p in params], n_rows)
+    multipliers = np.repeat([float(p[1]) for p in params], n_rows)
+    lengths = as_rows(n_bars if lengths is None else lengths, n_rows, dtype=np.int64)
+    state = None if states is None else stack_states(states)
+    result = supertrend(np.tile(high, (n_params, 1)), np.tile(low, (n_params, 1)),
+                        np.tile(close, (n_params, 1)), length=periods, multiplier=multipliers,
+                        lengths=np.tile(lengths, n_params), state=state, return_state=return_state)
+    trend, direction = result[0], result[1]
+    out = [(trend[k * n_rows:(k + 1) * n_rows], direction[k * n_rows:(k + 1) * n_rows]) for k in range(n_params)]
+    if return_state:
+        out = [pair + (st,) for pair, st in zip(out, split_state(result[2], n_params))]
+    return out
+
+
+def crossovers(close:np.ndarray, line:np.ndarray, start=0):
+    '''
+    buy = close crosses above `line` at bar i, sell = close crosses below it.
+    Works on 1-D or 2-D (rows, bars) input; bars before `start` (per row, or scalar) and bar 0 are
+    never flagged, and comparisons against NaN are False.
+    '''
+    buys = np.zeros(close.shape, dtype=float)
+    sells = np.zeros(close.shape, dtype=float)
+    if close.shape[-1] < 2:
+        return buys, sells
+    prev_close, prev_line = close[..., :-1], line[..., :-1]
+    cur_close, cur_line = close[..., 1:], line[..., 1:]
+    with np.errstate(invalid='ignore'):
+        buys[..., 1:] = (prev_close <= prev_line) & (cur_close > cur_line)
+        sells[..., 1:] = (prev_close >= prev_line) & (cur_close < cur_line)
+    start = np.maximum(np.asarray(start), 1)
+    warm_up = np.arange(close.shape[-1]) < (start[..., None] if start.ndim else start)
+    return np.where(warm_up, 0.0, buys), np.where(warm_up, 0.0, sells)
+
+
+def continued_crossovers(close:np.ndarray, line:np.ndarray, period:int, prev_close:np.ndarray,
+                         prev_line:np.ndarray, bars_seen:np.ndarray):
+    '''
+    crossovers() for bars that continue earlier series: `prev_close` / `prev_line` are the last values
+    already processed (NaN for a new series) and `bars_seen` how many bars came before, so the
+    `period - 1` warm-up is counted from the start of each series.
+    '''
+    ext_close = np.concatenate([prev_close[:, None], close], axis=1)
+    ext_line = np.concatenate([prev_line[:, None], line], axis=1)
+    buys, sells = crossovers(ext_close, ext_line, start=np.maximum(period - bars_seen, 1))
+    return buys[:, 1:], sells[:, 1:]
+
+
+def fractal_pivots(low:np.ndarray, high:np.ndarray, window:int=2):
+    '''
+    fractal pivots of (rows, bars) low / high arrays: a support bar has `window` strictly falling lows
+    before it and `window` strictly rising lows after it, a resistance bar the same with highs mirrored.
+    The first and last `window` bars of a row (and bars next to NaN padding) are never pivots.
+    '''
+    n_bars = low.shape[-1]
+    support = np.zeros(low.shape, dtype=bool)
+    resistance = np.zeros(high.shape, dtype=bool)
+    if n_bars < 2 * window + 1:
+        return support, resistance
+    with np.errstate(invalid='ignore'):
+        # falls[..., j] = bar j+1 is lower than bar j, rises[..., j] = bar j+1 is higher than bar j
+        low_falls, low_rises = low[..., 1:] < low[..., :-1], low[..., 1:] > low[..., :-1]
+        high_rises, high_falls = high[..., 1:] > high[..., :-1], high[..., 1:] < high[..., :-1]
+    inner = slice(window, n_bars - window)
+    support[..., inner] = True
+    resistance[..., inner] = True
+    for j in range(window):
+        # bar i needs the steps (i-j-1 -> i-j) before it and (i+j -> i+j+1) after it
+        before = slice(window - j - 1, n_bars - window - j - 1)
+        after = slice(window + j, n_bars - window + j)
+        support[..., inner] &= low_falls[..., before] & low_rises[..., after]
+        resistance[..., inner] &= high_rises[..., before] & high_falls[..., after]
+    return support, resistance & ~support
+
+
+def distinct_levels(values:np.ndarray, tolerance) -> np.ndarray:
+    '''
+    walks candidate levels in time order and keeps a level only when no kept level lies
+    within its `tolerance` (one for all levels or one per level) of it. Kept levels live in a sorted
+    list, so each check is a binary search plus a look at the two neighbours of the insertion point.
+    '''
+    keep = np.zeros(len(values), dtype=bool)
+    levels = list()
+    tolerances = np.broadcast_to(np.asarray(tolerance, dtype=float), np.shape(values)).tolist()
+    for k, (level, tolerance) in enumerate(zip(values.tolist(), tolerances)):
+        pos = bisect.bisect_left(levels, level)
+        if pos > 0 and abs(level - levels[pos - 1]) < tolerance:
+            continue
+        if pos < len(levels) and abs(level - levels[pos]) < tolerance:
+            continue
+        levels.insert(pos, level)
+        keep[k] = True
+    return keep
+
+
+def support_resistance(low:np.ndarray, high:np.ndarray, lengths=None, window:int=2):
+    '''
+    support / resistance levels of (rows, bars) arrays: the price of every fractal pivot that is at
+    least the mean bar range away from all earlier levels of either kind, NaN on other bars.
+
+    A pivot is only known `window` bars after it, so its level is put on that bar (pivot + window),
+    and the mean range it is compared with is the one of the bars up to there: a bar's value never
+    depends on later bars.
+    '''
+    n_rows, n_bars = low.shape
+    lengths = as_rows(n_bars if lengths is None else lengths, n_rows, dtype=np.int64)
+    is_support, is_resistance = fractal_pivots(low, high, window=window)
+    ranges = high - low
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # expanding mean of the bar ranges, NaN until a bar has a range
+        mean_range = np.cumsum(np.where(ranges == ranges, ranges, 0.), axis=1) / np.cumsum(ranges == ranges, axis=1)
+    support = np.full(low.shape, np.nan)
+    resistance = np.full(high.shape, np.nan)
+    for row in range(n_rows):
+        candidates = np.flatnonzero((is_support[row] | is_resistance[row])[:lengths[row]])
+        if len(candidates) == 0:
+            continue
+        values = np.where(is_support[row, candidates], low[row, candidates], high[row, candidates])
+        kept = candidates[distinct_levels(values, mean_range[row, candidates + window])]
+        kept_support = kept[is_support[row, kept]]
+        kept_resistance = kept[is_resistance[row, kept]]
+        support[row, kept_support + window] = low[row, kept_support]
+        resistance[row, kept_resistance + window] = high[row, kept_resistance]
+    return support, resistance
@@ -0,0 +1,146 @@
+'''
+In-memory pipeline: download -> indicators -> strategies (-> backtest) in one process, handing the
+tables from stage to stage instead of writing each one to saver.dir and parsing it again.
+
+Stage outputs still go to the same files the staged run writes, through a sink:
+
+- background: one writer thread, in submission order (history before indicators, the indicator
+  file before the incremental state that names it); the next stage computes meanwhile
+- sync: written before the next stage starts, like the staged run
+- none: nothing is written (incremental indicators then have no state to continue from)
+
+Signals are reported as soon as the strategies are computed; `run` returns after the sink
+has finished.
+'''
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from common.instrumentation import Recorder
+from common.property_reader import PropertyReader
+from core.backtester import BacktestRunner
+from core.data_collector import DataDownloader
+from core.indicators import IndicatorCalculator
+from core.strategies import Strategies
+
+
+class BackgroundSink:
+    '''runs output writes according to `mode` (background | sync | none)'''
+    modes = ('background', 'sync', 'none')
+
+    def __init__(self, mode:str='background', recorder:Recorder=None):
+        if mode not in self.modes:
+            raise ValueError('unknown pipeline.sink ' + mode + ', expected one of ' + ', '.join(self.modes))
+        self.mode = mode
+        self.recorder = Recorder.disabled() if recorder is None else recorder
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sink') if mode == 'background' else None
+        self.futures = list()
+
+    def submit(self, name:str, func, *args):
+        if self.mode == 'none':
+            return
+        # the write is recorded under the stage that produced the table
+        parent = self.recorder.current_path()
+
+        def job():
+            with self.recorder.stage('sink', parent=parent):
+                return func(*args)
+
+        if self.pool is None:
+            job()
+        else:
+            self.futures.append((name, self.pool.submit(job)))
+
+    def close(self):
+        '''waits for every pending write; raises the first failed one'''
+        if self.pool is None:
+            return
+        self.pool.shutdown(wait=True)
+        for name, future in self.futures:
+            error = future.exception()
+            if error is not None:
+                raise RuntimeError('writing ' + name + ' failed') from error
+
+
+class Pipeline:
+    '''
+    `timeframe` points every stage at saver.dir/<timeframe>, so each timeframe of a multi timeframe
+    run keeps its own history, indicator, strategy and state files. With saver.layout=dataset the
+    tables go to the timeframe's partitions of the one saver.dir dataset instead.
+    '''
+    def __init__(self, prop_file, recorder:Recorder=None, timeframe:str=None):
+        self.p_reader = PropertyReader(prop_file=prop_file)
+        self.recorder = Recorder.disabled() if recorder is None else recorder
+        self.downloader = DataDownloader(prop_file, recorder=self.recorder)
+        self.calculator = IndicatorCalculator(prop_file, recorder=self.recorder)
+        self.strategies = Strategies(prop_file=prop_file, recorder=self.recorder)
+        self.backtester = BacktestRunner(prop_file=prop_file, recorder=self.recorder)
+        self.timeframe = timeframe
+        if timeframe is not None:
+            directory = os.path.join(self.p_reader.historical_dir, timeframe)
+            os.makedirs(directory, exist_ok=True)
+            for stage in (self, self.downloader, self.calculator, self.strategies, self.backtester):
+                stage.p_reader.historical_dir = directory
+                stage.p_reader.timeframe = timeframe
+
+    def sink(self) -> BackgroundSink:
+        return BackgroundSink(mode=self.p_reader.pipeline_sink, recorder=self.recorder)
+
+    def write_history(self, df):
+        tables = self.downloader.tables
+        if tables.prepare(self.p_reader.history_startswith) is None:
+            raise FileNotFoundError(self.p_reader.historical_dir)
+        return tables.write(self.p_reader.history_startswith, df)
+
+    def run(self) -> dict:
+        '''
+        {'history', 'indicators', 'buys', 'sells', 'strategy', 'backtest'}; None when nothing was
+        downloaded. 'backtest' is None unless backtest.enabled.
+        '''
+        started = time.perf_counter()
+        sink = self.sink()
+        try:
+            print('Data Downloading starts..')
+            with self.recorder.stage('download') as span:
+                data_collector = self.downloader.data_collector()
+                history = self.downloader.collect(data_collector)
+                if history is None:
+                    print('nothing downloaded')
+                    return None
+                span.count(rows=history.shape[0], tickers=history['ticker'].nunique())
+                sink.submit('history', self.write_history, history)
+            result = self.process(history, sink, started=started)
+        finally:
+            # stage outputs that were computed are still written when a later stage fails
+            with self.recorder.stage('sink_wait'):
+                sink.close()
+        print('pipeline done after %.2fs' % (time.perf_counter() - started))
+        return result
+
+    def process(self, history, sink:BackgroundSink, started:float=None) -> dict:
+        '''indicators, strategies and backtest of a downloaded history table; outputs go to `sink`'''
+        started = time.perf_counter() if started is None else started
+        label = '' if self.timeframe is None else ' [' + self.timeframe + ']'
+        result = {'history': history, 'backtest': None}
+
+        print('\nIndicator calculations starts..' + label)
+        with self.recorder.stage('indicators', rows=history.shape[0]):
+            df, state = self.calculator.compute(history)
+            sink.submit('indicators', self.calculator.write_output, df, state)
+        result['indicators'] = df
+
+        print('\nStrategy application starts..' + label)
+        with self.recorder.stage('strategies', rows=df.shape[0]) as span:
+            buys, sells, strategy_df = self.strategies.compute(df)
+            span.count(buys=len(buys), sells=len(sells))
+            sink.submit('strategies', self.strategies.write_output, buys, sells, strategy_df)
+        result.update(buys=buys, sells=sells, strategy=strategy_df)
+        print('signals ready after %.2fs%s: %d buys, %d sells'
+              % (time.perf_counter() - started, label, len(buys), len(sells)))
+
+        if self.p_reader.backtest_enabled:
+            print('\nBacktest starts..' + label)
+            with self.recorder.stage('backtest', rows=df.shape[0]):
+                result['backtest'] = self.backtester.compute(df)
+                sink.submit('backtest', self.backtester.write_output, result['backtest'])
+            print(result['backtest']['rules'].to_string(index=False))
+        return result
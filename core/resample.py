@@ -0,0 +1,155 @@
+import math
+import numpy as np
+import pandas as pd
+
+
+'''
+Segment-reduce OHLCV aggregation. Bars are cut into consecutive segments given by their start
+rows, and every field of every ticker is reduced at once with ufunc.reduceat over the
+(bars, tickers) block: Open -> first, High -> max, Low -> min, Close / Adj Close -> last,
+Volume -> mean. NaN bars are skipped by max/min and count as zero volume, as in the old loop.
+'''
+
+FIRST = ('Open',)
+LAST = ('Close', 'Adj Close')
+MAX = ('High',)
+MIN = ('Low',)
+MEAN = ('Volume',)
+
+
+def count_bounds(n_rows:int, combine_interval:int) -> np.ndarray:
+    '''segment starts of np.array_split(df, ceil(n_rows / combine_interval))'''
+    if n_rows == 0:
+        return np.zeros(0, dtype=np.int64)
+    num_chunks = math.ceil(n_rows / combine_interval)
+    base, extra = divmod(n_rows, num_chunks)
+    sizes = np.full(num_chunks, base, dtype=np.int64)
+    sizes[:extra] += 1
+    return np.r_[0, np.cumsum(sizes)[:-1]].astype(np.int64)
+
+
+def rule_width(rule:str) -> pd.Timedelta:
+    '''
+    width of a time bucket rule; buckets are anchored to each day's session open, so rules longer
+    than a day (e.g. '2d', '1wk') cannot be built and raise ValueError
+    '''
+    try:
+        width = pd.Timedelta(rule)
+    except ValueError:
+        raise ValueError('unsupported bucket rule ' + str(rule) + ', expected minutes (m), hours (h) or days (d)')
+    if width <= pd.Timedelta(0) or width > pd.Timedelta('1d'):
+        raise ValueError('bucket rule ' + str(rule) + ' is not between one minute and one day; buckets are '
+                         'anchored to the session open of each day')
+    return width
+
+
+def time_bounds(dates:pd.Series, rule:str, session_start:str='09:30') -> (np.ndarray, pd.DatetimeIndex):
+    '''
+    segment starts and labels of time aligned buckets of width `rule` (e.g. '2h', '4h', '1d'),
+    anchored to each day's session open, so 4h buckets of a 09:30 session start at 09:30 and 13:30.
+    Bars before the open (pre-market) get one bucket of their own per day, labelled with the day's
+    midnight, instead of joining a bucket of the previous session. `dates` must be sorted.
+    '''
+    freq = rule_width(rule)
+    dates = pd.DatetimeIndex(dates)
+    if len(dates) == 0:
+        return np.zeros(0, dtype=np.int64), dates
+    opening = dates.normalize() + pd.Timedelta(session_start + ':00')
+    labels = opening + freq * np.floor((dates - opening) / freq).astype(np.int64)
+    labels = labels.where(dates >= opening, dates.normalize())
+    keys = labels.asi8
+    starts = np.r_[0, np.flatnonzero(keys[1:] != keys[:-1]) + 1].astype(np.int64)
+    return starts, labels[starts]
+
+
+def _reduce(values:np.ndarray, field:str, starts:np.ndarray, ends:np.ndarray) -> np.ndarray:
+    if field in FIRST:
+        return values[starts]
+    if field in LAST:
+        return values[ends - 1]
+    if field in MAX:
+        return np.fmax.reduceat(values, starts, axis=0)
+    if field in MIN:
+        return np.fmin.reduceat(values, starts, axis=0)
+    if field in MEAN:
+        sizes = (ends - starts).reshape((-1,) + (1,) * (values.ndim - 1))
+        return np.add.reduceat(np.nan_to_num(values), starts, axis=0) / sizes
+    return values[ends - 1]
+
+
+def aggregate(df:pd.DataFrame, starts:np.ndarray, labels=None, date_col='Date') -> pd.DataFrame:
+    '''
+    one output bar per segment for a frame with a `date_col` column and either flat OHLCV columns or
+    yf.download style (field, ticker) columns. The bar date is the segment label when given,
+    otherwise the date of the segment's first bar.
+    '''
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.r_[starts[1:], df.shape[0]].astype(np.int64)
+    if len(starts) == 0:
+        return df.iloc[:0]
+    data_cols = [col for col in df.columns if (col[0] if isinstance(col, tuple) else col) != date_col]
+    date_key = [col for col in df.columns if (col[0] if isinstance(col, tuple) else col) == date_col][0]
+
+    out = dict()
+    dates = df[date_key].iloc[starts] if labels is None else pd.Series(labels)
+    out[date_key] = dates.reset_index(drop=True)
+    fields = dict()
+    for col in data_cols:
+        fields.setdefault(col[0] if isinstance(col, tuple) else col, list()).append(col)
+    for field, cols in fields.items():
+        # one reduceat over every ticker of the field
+        reduced = _reduce(df[cols].to_numpy(dtype=float), field, starts, ends)
+        for i, col in enumerate(cols):
+            out[col] = reduced[:, i]
+    df_new = pd.DataFrame(out, columns=[date_key] + data_cols)
+    if isinstance(df.columns, pd.MultiIndex):
+        df_new.columns = pd.MultiIndex.from_tuples(df_new.columns, names=df.columns.names)
+    return df_new
+
+
+def cascade(df:pd.DataFrame, rules:list, session_start:str='09:30', date_col='Date') -> dict:
+    '''
+    {rule: frame} with the same bars as aggregate(df, *time_bounds(df[date_col], rule, session_start))
+    for every rule, in one pass from the finest rule to the coarsest. A rule whose width is a multiple
+    of a finer rule's width is reduced from that rule's bars (session anchored buckets nest), so
+    most rules read far fewer rows than `df` has. Volume is carried as sum and bar count so
+    its mean stays exact.
+    '''
+    date_key = [col for col in df.columns if (col[0] if isinstance(col, tuple) else col) == date_col][0]
+    fields = dict()
+    for col in df.columns:
+        if col != date_key:
+            fields.setdefault(col[0] if isinstance(col, tuple) else col, list()).append(col)
+    base = {'width': None, 'dates': pd.DatetimeIndex(df[date_key]), 'sizes': np.ones(df.shape[0]),
+            'values': {field: df[cols].to_numpy(dtype=float) for field, cols in fields.items()}}
+    for field in MEAN:
+        if field in base['values']:
+            base['values'][field] = np.nan_to_num(base['values'][field])
+
+    levels, out = [base], dict()
+    for rule in sorted(rules, key=pd.Timedelta):
+        width = pd.Timedelta(rule)
+        parent = [level for level in levels if level['width'] is None or width % level['width'] == pd.Timedelta(0)][-1]
+        starts, labels = time_bounds(parent['dates'], rule=rule, session_start=session_start)
+        if len(starts) == 0:
+            out[rule] = df.iloc[:0]
+            continue
+        ends = np.r_[starts[1:], len(parent['dates'])].astype(np.int64)
+        level = {'width': width, 'dates': labels, 'sizes': np.add.reduceat(parent['sizes'], starts), 'values': dict()}
+        for field, values in parent['values'].items():
+            level['values'][field] = np.add.reduceat(values, starts, axis=0) if field in MEAN \
+                else _reduce(values, field, starts, ends)
+        levels.append(level)
+
+        frame = {date_key: pd.Series(labels)}
+        for field, cols in fields.items():
+            values = level['values'][field]
+            if field in MEAN:
+                values = values / level['sizes'][:, None]
+            for i, col in enumerate(cols):
+                frame[col] = values[:, i]
+        frame = pd.DataFrame(frame, columns=[date_key] + [col for cols in fields.values() for col in cols])
+        if isinstance(df.columns, pd.MultiIndex):
+            frame.columns = pd.MultiIndex.from_tuples(frame.columns, names=df.columns.names)
+        out[rule] = frame
+    return out
@@ -0,0 +1,178 @@
+'''
+Rolling window kernels: SMA, standard deviation, Bollinger bands, session VWAP and rolling
+highs / lows.
+
+Same layout as core.kernels: 2-D float arrays shaped (tickers, bars), bars left-aligned and
+right-padded with NaN, `lengths` the number of real bars per row. Every kernel is O(bars) per
+row with no loop over the bars, so the cost barely depends on the window:
+
+- sums, means and standard deviations are differences of cumulative sums, taken over the values
+  minus each row's first bar so long histories do not lose precision to large running totals
+- rolling max / min use the van Herk / Gil-Werman split: block prefix and suffix extremes, two
+  ufunc.accumulate calls over the bars cut into blocks of the window width
+- VWAP is a cumulative sum that restarts at every session open (session_keys)
+
+Like `Series.rolling(window)`, a window that is not full or holds a NaN bar gives NaN.
+'''
+import numpy as np
+import pandas as pd
+from core.kernels import active_mask
+
+
+def _clear_padding(out:np.ndarray, lengths) -> np.ndarray:
+    if lengths is not None:
+        out[~active_mask(lengths, out.shape[1])] = np.nan
+    return out
+
+
+def _first_values(values:np.ndarray) -> np.ndarray:
+    first = values[:, :1].copy() if values.shape[1] > 0 else np.zeros((values.shape[0], 1))
+    first[first != first] = 0.
+    return first
+
+
+def _window_diff(cumulative:np.ndarray, window:int) -> np.ndarray:
+    '''(rows, bars) sums over the `window` bars ending at each bar from (rows, bars + 1) cumulative sums'''
+    n_rows, n_bars = cumulative.shape[0], cumulative.shape[1] - 1
+    out = np.full((n_rows, n_bars), np.nan)
+    if window <= n_bars:
+        out[:, window - 1:] = cumulative[:, window:] - cumulative[:, :n_bars - window + 1]
+    return out
+
+
+def _cumulative(values:np.ndarray) -> np.ndarray:
+    out = np.zeros((values.shape[0], values.shape[1] + 1))
+    np.cumsum(values, axis=1, out=out[:, 1:])
+    return out
+
+
+def window_counts(values:np.ndarray, window:int) -> np.ndarray:
+    '''number of non NaN bars in the `window` bars ending at each bar (NaN before the first full window)'''
+    return _window_diff(_cumulative((values == values).astype(float)), window)
+
+
+def flat_windows(values:np.ndarray, window:int) -> np.ndarray:
+    '''True where the `window` bars ending at a bar all hold the same value'''
+    n_bars = values.shape[1]
+    same = np.zeros(values.shape, dtype=bool)
+    same[:, 1:] = values[:, 1:] == values[:, :-1]
+    # bars since the last change of value
+    changed = np.maximum.accumulate(np.where(same, 0, np.arange(n_bars)[None, :]), axis=1)
+    return np.arange(n_bars)[None, :] - changed >= int(window) - 1
+
+
+def rolling_sum(values:np.ndarray, window:int, lengths=None) -> np.ndarray:
+    '''same as `Series.rolling(window).sum()` per row'''
+    window = int(window)
+    first = _first_values(values)
+    shifted = values - first
+    sums = _window_diff(_cumulative(np.where(shifted == shifted, shifted, 0.)), window) + window * first
+    sums[window_counts(values, window) != window] = np.nan
+    return _clear_padding(sums, lengths)
+
+
+def sma(values:np.ndarray, window:int, lengths=None) -> np.ndarray:
+    '''same as `Series.rolling(window).mean()` per row'''
+    return rolling_sum(values, window, lengths=lengths) / int(window)
+
+
+def rolling_std(values:np.ndarray, window:int, ddof:int=0, lengths=None) -> np.ndarray:
+    '''`Series.rolling(window).std(ddof=ddof)` per row; ddof=0 is the population deviation of Bollinger bands'''
+    window = int(window)
+    shifted = values - _first_values(values)
+    filled = np.where(shifted == shifted, shifted, 0.)
+    sums = _window_diff(_cumulative(filled), window)
+    squares = _window_diff(_cumulative(filled * filled), window)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        variance = (squares - sums * sums / window) / (window - ddof)
+    # rounding leaves a small variance (or a negative one) in flat windows, which pandas reports as 0
+    std = np.sqrt(np.maximum(variance, 0.))
+    std[flat_windows(values, window)] = 0.
+    std[window_counts(values, window) != window] = np.nan
+    if window - ddof <= 0:
+        std[:] = np.nan
+    return _clear_padding(std, lengths)
+
+
+def bollinger(values:np.ndarray, window:int, width:float, lengths=None) -> (np.ndarray, np.ndarray, np.ndarray):
+    '''(middle, upper, lower): the `window` bar SMA and `width` population standard deviations around it'''
+    middle = sma(values, window, lengths=lengths)
+    band = float(width) * rolling_std(values, window, ddof=0, lengths=lengths)
+    return middle, middle + band, middle - band
+
+
+def _rolling_extreme(values:np.ndarray, window:int, ufunc, fill:float, lengths=None) -> np.ndarray:
+    window = int(window)
+    n_rows, n_bars = values.shape
+    n_blocks = -(-n_bars // window)
+    blocks = np.full((n_rows, n_blocks * window), fill)
+    blocks[:, :n_bars] = np.where(values == values, values, fill)
+    blocks = blocks.reshape(n_rows, n_blocks, window)
+    # prefix[j]: extreme from the start of j's block to j; suffix[i]: from i to the end of i's block
+    prefix = ufunc.accumulate(blocks, axis=2).reshape(n_rows, -1)
+    suffix = ufunc.accumulate(blocks[:, :, ::-1], axis=2)[:, :, ::-1].reshape(n_rows, -1)
+    out = np.full((n_rows, n_bars), np.nan)
+    if window <= n_bars:
+        # the window i..j (i = j - window + 1) spans at most two blocks: suffix[i] covers the first, prefix[j] the second
+        out[:, window - 1:] = ufunc(suffix[:, :n_bars - window + 1], prefix[:, window - 1:n_bars])
+    out[window_counts(values, window) != window] = np.nan
+    return _clear_padding(out, lengths)
+
+
+def rolling_max(values:np.ndarray, window:int, lengths=None) -> np.ndarray:
+    '''same as `Series.rolling(window).max()` per row'''
+    return _rolling_extreme(values, window, np.maximum, -np.inf, lengths=lengths)
+
+
+def rolling_min(values:np.ndarray, window:int, lengths=None) -> np.ndarray:
+    '''same as `Series.rolling(window).min()` per row'''
+    return _rolling_extreme(values, window, np.minimum, np.inf, lengths=lengths)
+
+
+def previous(values:np.ndarray, lengths=None) -> np.ndarray:
+    '''each bar gets the value of the bar before it (`Series.shift(1)` per row)'''
+    out = np.full_like(values, np.nan, dtype=float)
+    out[:, 1:] = values[:, :-1]
+    return _clear_padding(out, lengths)
+
+
+def session_keys(timestamps:np.ndarray, session_start:str='09:30', timezone:str='America/New_York') -> np.ndarray:
+    '''
+    session number of every epoch second timestamp, like resample.time_bounds anchored to the
+    `session_start` open of each day in the exchange `timezone`: the bars of a day from the open on
+    are one session, the day's bars before the open (pre-market) another. Padding (NaN) gets -1.
+    '''
+    keys = np.full(timestamps.shape, -1, dtype=np.int64)
+    valid = timestamps == timestamps
+    local = pd.to_datetime(timestamps[valid].astype(np.int64), unit='s', utc=True).tz_convert(timezone).tz_localize(None)
+    days = local.normalize()
+    opened = local >= days + pd.Timedelta(session_start + ':00')
+    keys[valid] = 2 * (days.asi8 // (86400 * 10 ** 9)) + opened
+    return keys
+
+
+def session_vwap(high:np.ndarray, low:np.ndarray, close:np.ndarray, volume:np.ndarray, sessions:np.ndarray,
+                 lengths=None) -> np.ndarray:
+    '''
+    volume weighted average of the typical price (high + low + close) / 3 since the session's
+    first bar; `sessions` holds the session key of every bar (session_keys). Bars without volume
+    count as zero volume, so the VWAP is NaN until the session has traded.
+    '''
+    n_rows, n_bars = close.shape
+    typical = (high + low + close) / 3.
+    volume = np.where(volume == volume, volume, 0.)
+    traded = np.where(typical == typical, typical * volume, 0.)
+    volume = np.where(typical == typical, volume, 0.)
+    cum_traded, cum_volume = _cumulative(traded), _cumulative(volume)
+
+    # column of each bar's session start in the cumulative sums
+    starts = np.ones((n_rows, n_bars), dtype=bool)
+    starts[:, 1:] = sessions[:, 1:] != sessions[:, :-1]
+    first = np.maximum.accumulate(np.where(starts, np.arange(n_bars)[None, :], 0), axis=1)
+    rows = np.arange(n_rows)[:, None]
+    session_traded = cum_traded[:, 1:] - cum_traded[rows, first]
+    session_volume = cum_volume[:, 1:] - cum_volume[rows, first]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        vwap = session_traded / session_volume
+    vwap[session_volume <= 0] = np.nan
+    return _clear_padding(vwap, lengths)
@@ -0,0 +1,208 @@
+'''
+Strategy rules declared as data. A rule has a name, a buy and a sell expression over indicator
+columns, and the columns it reports, e.g.
+
+    ('ema100', 'buy_short > 0 and close > ema100', 'sell_short > 0 and close < ema100',
+     ['close', 'sup_short', 'ema100', 'buy_short', 'sell_short'])
+
+Expressions are Python syntax limited to column names, numbers, arithmetic, comparisons and
+and / or / not. They are evaluated column-wise over the whole frame, and every sub-expression is
+computed once per frame, however many rules share it.
+'''
+import ast
+import copy
+import operator
+import numpy as np
+import pandas as pd
+from common.instrumentation import Recorder
+
+
+def _divide(left, right):
+    '''float64 division: x / 0 gives inf (0 / 0 NaN) instead of raising, on single bars and on columns alike'''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.true_divide(left, right, dtype=np.float64)
+
+
+BIN_OPS = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: _divide}
+COMPARE_OPS = {ast.Gt: operator.gt, ast.GtE: operator.ge, ast.Lt: operator.lt, ast.LtE: operator.le,
+               ast.Eq: operator.eq, ast.NotEq: operator.ne}
+ALLOWED = (ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub, ast.BinOp, ast.Compare,
+           ast.Name, ast.Load, ast.Constant) + tuple(BIN_OPS) + tuple(COMPARE_OPS)
+
+# the four supertrend strategies the stage started with, used when conf.ini has no strategy.rules
+DEFAULT_RULES = [
+    ('short_medium', 'buy_short > 0 and buy_medium > 0', 'sell_short > 0 and sell_medium > 0',
+     ['close', 'sup_short', 'sup_medium', 'buy_short', 'sell_short']),
+    ('short_long', 'buy_short > 0 and buy_long > 0', 'sell_short > 0 and sell_long > 0',
+     ['close', 'sup_short', 'sup_long', 'buy_short', 'sell_short']),
+    ('ema55', 'buy_short > 0 and close > ema55', 'sell_short > 0 and close < ema55',
+     ['close', 'sup_short', 'ema55', 'buy_short', 'sell_short']),
+    ('ema100', 'buy_short > 0 and close > ema100', 'sell_short > 0 and close < ema100',
+     ['close', 'sup_short', 'ema100', 'buy_short', 'sell_short']),
+]
+
+
+def parse_expression(expression:str) -> ast.Expression:
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError('invalid rule expression ' + repr(expression) + ': ' + str(e))
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED):
+            raise ValueError('unsupported ' + type(node).__name__ + ' in rule expression ' + repr(expression))
+        if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise ValueError('only numeric constants are allowed in rule expression ' + repr(expression))
+    return tree
+
+
+def columns_of(tree:ast.AST) -> set:
+    return {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)}
+
+
+def _truthy(value) -> bool:
+    return value == value and value != 0
+
+
+class _ScalarTruth(ast.NodeTransformer):
+    '''
+    wraps plain values used as conditions in _truthy, so NaN is false as in the column-wise evaluation,
+    and turns divisions into _divide calls, so a zero divisor does not raise
+    '''
+    def wrap(self, node:ast.AST) -> ast.AST:
+        if isinstance(node, (ast.Compare, ast.BoolOp)) or (isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not)):
+            return node
+        return ast.Call(func=ast.Name(id='_truthy', ctx=ast.Load()), args=[node], keywords=[])
+
+    def visit_BoolOp(self, node:ast.BoolOp) -> ast.AST:
+        self.generic_visit(node)
+        node.values = [self.wrap(value) for value in node.values]
+        return node
+
+    def visit_UnaryOp(self, node:ast.UnaryOp) -> ast.AST:
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            node.operand = self.wrap(node.operand)
+        return node
+
+    def visit_BinOp(self, node:ast.BinOp) -> ast.AST:
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Div):
+            return ast.Call(func=ast.Name(id='_divide', ctx=ast.Load()), args=[node.left, node.right], keywords=[])
+        return node
+
+
+def compile_scalar(tree:ast.Expression):
+    '''code object evaluating a parsed expression on one bar, a dict of column -> float'''
+    tree = _ScalarTruth().visit(copy.deepcopy(tree))
+    tree.body = _ScalarTruth().wrap(tree.body)
+    return compile(ast.fix_missing_locations(tree), '<rule>', 'eval')
+
+
+class Rule:
+    def __init__(self, name:str, buy:str, sell:str, cols:list):
+        self.name = name
+        self.buy = parse_expression(buy)
+        self.sell = parse_expression(sell)
+        self.cols = list(cols)
+        self.scalar_buy = compile_scalar(self.buy)
+        self.scalar_sell = compile_scalar(self.sell)
+
+    def columns(self) -> set:
+        return columns_of(self.buy) | columns_of(self.sell) | set(self.cols)
+
+    def evaluate_bar(self, bar:dict) -> (bool, bool):
+        '''(buy, sell) for a single bar'''
+        scope = {'__builtins__': {}, '_truthy': _truthy, '_divide': _divide}
+        try:
+            return bool(eval(self.scalar_buy, scope, bar)), bool(eval(self.scalar_sell, scope, bar))
+        except NameError as e:
+            raise KeyError('rule ' + self.name + ': ' + str(e))
+
+
+class Evaluator:
+    '''
+    evaluates parsed expressions over one frame, memoising every node by its ast dump. `df` can also
+    be a dict of equally shaped arrays, e.g. (tickers, bars) matrices.
+    '''
+    def __init__(self, df:pd.DataFrame):
+        self.df = df
+        self.cache = dict()
+
+    def mask(self, tree:ast.AST) -> np.ndarray:
+        return self.__truthy(self.value(tree))
+
+    def value(self, node:ast.AST):
+        if isinstance(node, ast.Expression):
+            return self.value(node.body)
+        if isinstance(node, ast.Constant):
+            return node.value
+        key = ast.dump(node)
+        if key not in self.cache:
+            self.cache[key] = self.__compute(node)
+        return self.cache[key]
+
+    def __truthy(self, value) -> np.ndarray:
+        value = np.asarray(value)
+        if value.dtype == bool:
+            return value
+        with np.errstate(invalid='ignore'):
+            return (value != 0) & ~np.isnan(value)
+
+    def __compute(self, node:ast.AST):
+        if isinstance(node, ast.Name):
+            if node.id not in self.df:
+                raise KeyError('rule column ' + node.id + ' is not in the indicator file')
+            return np.asarray(self.df[node.id], dtype=float)
+        if isinstance(node, ast.BoolOp):
+            masks = [self.__truthy(self.value(v)) for v in node.values]
+            reduce = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+            return reduce.reduce(masks)
+        if isinstance(node, ast.UnaryOp):
+            operand = self.value(node.operand)
+            return ~self.__truthy(operand) if isinstance(node.op, ast.Not) else -operand
+        if isinstance(node, ast.BinOp):
+            return BIN_OPS[type(node.op)](self.value(node.left), self.value(node.right))
+        if isinstance(node, ast.Compare):
+            # a < b < c  ->  (a < b) & (b < c)
+            result, left = None, self.value(node.left)
+            with np.errstate(invalid='ignore'):
+                for op, comparator in zip(node.ops, node.comparators):
+                    right = self.value(comparator)
+                    current = COMPARE_OPS[type(op)](left, right)
+                    result = current if result is None else result & current
+                    left = right
+            return result
+        raise ValueError('unsupported rule node ' + type(node).__name__)
+
+
+class RuleSet:
+    '''the registered rules, in the order they are reported'''
+    key_cols = ['ticker', 'timestamp']
+
+    def __init__(self, rules:list):
+        self.rules = [rule if isinstance(rule, Rule) else Rule(*rule) for rule in rules]
+        names = [rule.name for rule in self.rules]
+        if len(set(names)) != len(names):
+            raise ValueError('duplicate strategy rule names: ' + ', '.join(names))
+
+    def evaluate(self, df:pd.DataFrame) -> dict:
+        '''rule name -> (buy mask, sell mask), all rules in one pass over `df`'''
+        evaluator = Evaluator(df)
+        return {rule.name: (evaluator.mask(rule.buy), evaluator.mask(rule.sell)) for rule in self.rules}
+
+    def signals(self, df:pd.DataFrame, recorder:Recorder=None) -> list:
+        '''
+        (rule, buys frame, sells frame) per rule, each frame holding the key and the rule's columns.
+        With a recorder every rule is timed; sub-expressions shared between rules are evaluated
+        once and counted towards the first rule that uses them.
+        '''
+        recorder = Recorder.disabled() if recorder is None else recorder
+        evaluator = Evaluator(df)
+        out = list()
+        for rule in self.rules:
+            with recorder.stage('rule:' + rule.name) as span:
+                cols = self.key_cols + [col for col in rule.cols if col not in self.key_cols]
+                buy, sell = evaluator.mask(rule.buy), evaluator.mask(rule.sell)
+                out.append((rule, df.loc[buy, cols], df.loc[sell, cols]))
+                span.count(buys=out[-1][1].shape[0], sells=out[-1][2].shape[0])
+        return out
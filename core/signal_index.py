@@ -0,0 +1,240 @@
+'''
+Signal index for screening queries without reloading the indicator table. It is built by the
+indicator stage and written to saver.dir/<saver.dir.signal_index><date>/ as npy arrays:
+
+- postings: per signal, the (timestamp, ticker) of every bar it fired on, sorted by timestamp.
+  Signals are the buy_* / sell_* flag columns and '<rule>:buy' / '<rule>:sell' of every
+  strategy rule whose columns are in the table.
+- snapshots: per ticker, its last `indicator.signal_index.last_bars` bars of every indicator column
+  (right aligned: the last slot is the latest bar).
+
+    python -m core.signal_index data/conf.ini --signal sell_medium --last 3 --where "close < ema200"
+
+lists the tickers with a sell_medium cross in their last 3 bars whose latest close is under ema200.
+The arrays are memory mapped, so a query reads the postings of one signal and a few snapshot columns.
+'''
+import argparse
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from common.property_reader import PropertyReader
+from common.schema import FLAG_PREFIXES
+from common.timestamps import to_datetime, to_epoch
+from core.rules import DEFAULT_RULES, Evaluator, RuleSet, columns_of, parse_expression
+from core.ticker_blocks import TickerBlocks
+
+
+META_FILE = 'meta.json'
+# timestamp of a snapshot slot before a ticker's first bar
+NO_BAR = np.iinfo(np.int64).min
+KEY_COLUMNS = ('ticker', 'timestamp', 'date')
+
+
+class SignalIndexBuilder:
+    '''
+    collects postings and snapshots from indicator frames holding whole tickers, e.g. the full
+    table or the batches of an out-of-core run, each frame's tickers after the previous frame's
+    '''
+    def __init__(self, rules:RuleSet=None, last_bars:int=5):
+        self.rules = RuleSet(DEFAULT_RULES) if rules is None else rules
+        self.last_bars = max(int(last_bars), 1)
+        self.tickers = list()
+        self.postings = dict()
+        self.columns = None
+        self.snapshots = dict()
+
+    def signal_masks(self, df:pd.DataFrame) -> dict:
+        masks = {col: np.asarray(df[col].to_numpy(dtype=float) > 0) for col in df.columns
+                 if str(col).startswith(FLAG_PREFIXES)}
+        evaluator = Evaluator(df)
+        for rule in self.rules.rules:
+            if all(col in df.columns for col in rule.columns()):
+                masks[rule.name + ':buy'] = evaluator.mask(rule.buy)
+                masks[rule.name + ':sell'] = evaluator.mask(rule.sell)
+        return masks
+
+    def add(self, df:pd.DataFrame):
+        if df.shape[0] == 0:
+            return
+        blocks = TickerBlocks(df)
+        df = blocks.df
+        offset = len(self.tickers)
+        self.tickers.extend(str(ticker) for ticker in blocks.tickers)
+        timestamps = to_epoch(df['timestamp'])
+        codes = blocks.codes.astype(np.int32) + offset
+        for signal, mask in self.signal_masks(df).items():
+            rows = np.flatnonzero(mask)
+            self.postings.setdefault(signal, list()).append((timestamps[rows], codes[rows]))
+
+        # the last `last_bars` rows of every ticker, right aligned; slots before the first bar are empty
+        slots = blocks.ends[:, None] - self.last_bars + np.arange(self.last_bars)[None, :]
+        empty = slots < blocks.starts[:, None]
+        slots = np.where(empty, blocks.starts[:, None], slots)
+        if self.columns is None:
+            self.columns = [col for col in df.columns if col not in KEY_COLUMNS and
+                            (pd.api.types.is_numeric_dtype(df[col]) or pd.api.types.is_bool_dtype(df[col]))]
+        snapshot = {'timestamp': np.where(empty, NO_BAR, timestamps[slots])}
+        for col in self.columns:
+            values = df[col].to_numpy()[slots]
+            if values.dtype == np.bool_:
+                values[empty] = False
+            else:
+                values = values.astype(np.result_type(values.dtype, np.float32))
+                values[empty] = np.nan
+            snapshot[col] = values
+        for name, values in snapshot.items():
+            self.snapshots.setdefault(name, list()).append(values)
+
+    def save(self, path:str) -> str:
+        '''writes the index directory at `path` (replacing an earlier one) and returns `path`'''
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        signals, timestamps, codes, start = dict(), list(), list(), 0
+        for signal in sorted(self.postings):
+            ts = np.concatenate([t for t, _ in self.postings[signal]])
+            code = np.concatenate([c for _, c in self.postings[signal]])
+            order = np.lexsort((code, ts))
+            timestamps.append(ts[order])
+            codes.append(code[order])
+            signals[signal] = [start, start + len(ts)]
+            start += len(ts)
+        np.save(os.path.join(tmp_path, 'postings_timestamp.npy'),
+                np.concatenate(timestamps) if timestamps else np.zeros(0, dtype=np.int64))
+        np.save(os.path.join(tmp_path, 'postings_ticker.npy'),
+                np.concatenate(codes) if codes else np.zeros(0, dtype=np.int32))
+        columns = ['timestamp'] + list(self.columns or list())
+        for i, col in enumerate(columns):
+            values = np.concatenate(self.snapshots[col]) if col in self.snapshots else np.zeros((0, self.last_bars))
+            np.save(os.path.join(tmp_path, 'snapshot_%d.npy' % i), values)
+        with open(os.path.join(tmp_path, META_FILE), 'w') as writer:
+            writer.write(json.dumps({'tickers': self.tickers, 'signals': signals, 'columns': columns,
+                                     'last_bars': self.last_bars}))
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        return path
+
+
+class SignalIndex:
+    def __init__(self, path:str):
+        self.path = path
+        with open(os.path.join(path, META_FILE), 'r') as handler:
+            meta = json.loads(handler.read())
+        self.tickers = np.asarray(meta['tickers'], dtype=object)
+        self.ticker_codes = {ticker: i for i, ticker in enumerate(meta['tickers'])}
+        self.signals = meta['signals']
+        self.columns = meta['columns']
+        self.last_bars = meta['last_bars']
+        self.posting_timestamps = np.load(os.path.join(path, 'postings_timestamp.npy'), mmap_mode='r')
+        self.posting_tickers = np.load(os.path.join(path, 'postings_ticker.npy'), mmap_mode='r')
+        self.snapshot_columns = {col: i for i, col in enumerate(self.columns)}
+        self.loaded = dict()
+
+    @staticmethod
+    def latest(directory:str, startswith:str) -> str:
+        '''the newest index directory in `directory`'''
+        names = sorted(name for name in os.listdir(directory) if name.startswith(startswith) and not name.endswith('.tmp'))
+        if len(names) == 0:
+            raise FileNotFoundError('no ' + startswith + '* signal index in ' + directory)
+        return os.path.join(directory, names[-1])
+
+    def snapshot(self, col:str) -> np.ndarray:
+        '''(tickers, last_bars) values of `col`'''
+        if col not in self.snapshot_columns:
+            raise KeyError('column ' + col + ' is not in the signal index')
+        if col not in self.loaded:
+            self.loaded[col] = np.load(os.path.join(self.path, 'snapshot_%d.npy' % self.snapshot_columns[col]),
+                                       mmap_mode='r')
+        return self.loaded[col]
+
+    def postings(self, signal:str, since:int=None, until:int=None) -> (np.ndarray, np.ndarray):
+        '''(timestamps, ticker codes) of `signal` in [since, until] epoch seconds, sorted by timestamp'''
+        if signal not in self.signals:
+            raise KeyError('unknown signal ' + signal + ', expected one of ' + ', '.join(sorted(self.signals)))
+        start, stop = self.signals[signal]
+        timestamps = self.posting_timestamps[start:stop]
+        lo = 0 if since is None else int(np.searchsorted(timestamps, since, side='left'))
+        hi = len(timestamps) if until is None else int(np.searchsorted(timestamps, until, side='right'))
+        return np.asarray(timestamps[lo:hi]), np.asarray(self.posting_tickers[start + lo:start + hi])
+
+    def screen(self, signal:str, last:int=None, since:int=None, until:int=None, where:str=None,
+               at:str='latest', tickers:list=None) -> pd.DataFrame:
+        '''
+        bars `signal` fired on, newest first: within each ticker's `last` bars and / or [since, until],
+        for `tickers` only, and where the `where` rule expression holds on the ticker's latest bar
+        (at='latest') or on the signal bar itself (at='signal', only for bars still in the snapshots)
+        '''
+        timestamps, codes = self.postings(signal, since=since, until=until)
+        if tickers is not None:
+            wanted = np.asarray([self.ticker_codes[t] for t in tickers if t in self.ticker_codes], dtype=np.int32)
+            keep = np.isin(codes, wanted)
+            timestamps, codes = timestamps[keep], codes[keep]
+        if last is not None:
+            if not 0 < last <= self.last_bars:
+                raise ValueError('last must be between 1 and indicator.signal_index.last_bars (%d)' % self.last_bars)
+            cutoff = np.asarray(self.snapshot('timestamp')[:, self.last_bars - last])
+            keep = timestamps >= cutoff[codes]
+            timestamps, codes = timestamps[keep], codes[keep]
+
+        if at not in ('latest', 'signal'):
+            raise ValueError('unknown at ' + at + ', expected latest or signal')
+        tree = None if where is None else parse_expression(where)
+        columns = sorted({'close'} | (set() if tree is None else columns_of(tree)))
+        columns = [col for col in columns if col in self.snapshot_columns]
+        if at == 'latest':
+            slots = np.full(len(codes), self.last_bars - 1)
+        else:
+            found = np.asarray(self.snapshot('timestamp'))[codes] == timestamps[:, None]
+            keep = found.any(axis=1)
+            timestamps, codes, slots = timestamps[keep], codes[keep], found[keep].argmax(axis=1)
+        values = {col: np.asarray(self.snapshot(col))[codes, slots] for col in columns}
+        if tree is not None:
+            keep = Evaluator(values).mask(tree)
+            timestamps, codes = timestamps[keep], codes[keep]
+            values = {col: v[keep] for col, v in values.items()}
+
+        df = pd.DataFrame({'ticker': self.tickers[codes], 'timestamp': timestamps, **values})
+        return df.iloc[::-1].reset_index(drop=True)
+
+    def latest_bars(self, ticker:str) -> pd.DataFrame:
+        '''the snapshot of one ticker, oldest bar first'''
+        if ticker not in self.ticker_codes:
+            raise KeyError('ticker ' + ticker + ' is not in the signal index')
+        code = self.ticker_codes[ticker]
+        df = pd.DataFrame({col: np.asarray(self.snapshot(col)[code]) for col in self.columns})
+        return df[df['timestamp'] != NO_BAR].reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='screening queries on the latest signal index')
+    parser.add_argument('prop_file', help='conf.ini')
+    parser.add_argument('--signal', help='flag column (e.g. sell_medium) or <rule>:buy / <rule>:sell')
+    parser.add_argument('--last', type=int, default=None, help="only signals in each ticker's last N bars")
+    parser.add_argument('--since', default=None, help='only signals at or after this date / time')
+    parser.add_argument('--where', default=None, help='rule expression, e.g. "close < ema200"')
+    parser.add_argument('--at', default='latest', choices=['latest', 'signal'], help='bar the --where expression is evaluated on')
+    parser.add_argument('--ticker', default=None, help='show the latest bars of one ticker')
+    parser.add_argument('--index', default=None, help='index directory (default: the latest in saver.dir)')
+    args = parser.parse_args()
+
+    p_reader = PropertyReader(prop_file=args.prop_file)
+    started = time.perf_counter()
+    index = SignalIndex(args.index or SignalIndex.latest(p_reader.historical_dir, p_reader.signal_index_startswith))
+    if args.ticker is not None:
+        result = index.latest_bars(args.ticker)
+    elif args.signal is not None:
+        since = None if args.since is None else int(to_epoch(pd.DatetimeIndex([pd.Timestamp(args.since)]))[0])
+        result = index.screen(args.signal, last=args.last, since=since, where=args.where, at=args.at)
+    else:
+        result = pd.DataFrame({'signal': sorted(index.signals),
+                               'postings': [index.signals[s][1] - index.signals[s][0] for s in sorted(index.signals)]})
+    elapsed = time.perf_counter() - started
+    if 'timestamp' in result.columns:
+        result['timestamp'] = to_datetime(result['timestamp'])
+    print(result.to_string(index=False))
+    print('%d rows in %.1f ms (%s)' % (result.shape[0], elapsed * 1000, Path(index.path).name))
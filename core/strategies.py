@@ -1,136 +1,84 @@
 import pandas as pd
+from common.instrumentation import Recorder
 from common.property_reader import PropertyReader
+from common.schema import Schema
 from common.utilities import Utilities
+from common.dataset import StageTables
+from common.storage import get_storage
+from common.timestamps import to_datetime, to_epoch
+from core.rules import DEFAULT_RULES, RuleSet
 import json
 from datetime import datetime, timedelta
 from pathlib import Path
-from datetime import date
 
 
 class Strategies:
-    def __init__(self, prop_file):
+    def __init__(self, prop_file, recorder:Recorder=None):
         self.p_reader = PropertyReader(prop_file=prop_file)
+        self.recorder = Recorder.disabled() if recorder is None else recorder
         self.utilities = Utilities()
+        self.storage = get_storage(self.p_reader.storage_format)
+        self.rules = RuleSet(self.p_reader.strategy_rules or DEFAULT_RULES)
+        self.tables = StageTables(self.p_reader, schema=Schema.from_properties(self.p_reader))
 
-    def strategy_supertrend_ema100(self, df):
-        df = self.filter_by_date(df)
-        df1 = df[((df['buy_short'] > 0.0) & (df['close'] > df['ema100'])) | (
-                (df['sell_short'] > 0.0) & (df['close'] < df['ema100']))]
-
-        cols = ['ticker', 'timestamp', 'close', 'sup_short', 'ema100', 'buy_short', 'sell_short']
-        df1 = df1[cols]
-        buys = df1[df1['buy_short'] > 0.0]
-        sells = df1[df1['sell_short'] > 0.0]
-        return buys, sells
-
-    def strategy_supertrend_ema55(self, df):
-        df = self.filter_by_date(df)
-        df1 = df[((df['buy_short'] > 0.0) & (df['close'] > df['ema55'])) | (
-                (df['sell_short'] > 0.0) & (df['close'] < df['ema55']))]
-
-        cols = ['ticker', 'timestamp', 'close', 'sup_short', 'ema55', 'buy_short', 'sell_short']
-        df1 = df1[cols]
-        buys = df1[df1['buy_short'] > 0.0]
-        sells = df1[df1['sell_short'] > 0.0]
-        return buys, sells
-
-    def strategy_supertrend_short_medium(self, df):
-        df = self.filter_by_date(df)
-        df1 = df[((df['buy_short'] > 0.0) & (df['buy_medium'] > 0.0)) | (
-                (df['sell_short'] > 0.0) & (df['sell_medium'] > 0.0))]
-
-        cols = ['ticker', 'timestamp', 'close', 'sup_short', 'sup_medium', 'buy_short', 'sell_short']
-        df1 = df1[cols]
-        buys = df1[df1['buy_short'] > 0.0]
-        sells = df1[df1['sell_short'] > 0.0]
-        return buys, sells
-
-    def strategy_supertrend_short_long(self, df):
-        df = self.filter_by_date(df)
-        df1 = df[((df['buy_short'] > 0.0) & (df['buy_long'] > 0.0)) | (
-                (df['sell_short'] > 0.0) & (df['sell_long'] > 0.0))]
-
-        cols = ['ticker', 'timestamp', 'close', 'sup_short', 'sup_long', 'buy_short', 'sell_short']
-        df1 = df1[cols]
-        buys = df1[df1['buy_short'] > 0.0]
-        sells = df1[df1['sell_short'] > 0.0]
-        return buys, sells
-
-    def filter_by_date(self, df) -> pd.DataFrame:
+    def cutoff(self, today:datetime=None) -> pd.Timestamp:
+        '''`last_interval + 1` days before `today` (now), a naive `today` being the exchange's local time'''
         filter_by_intervals = self.p_reader.last_interval + 1
-        filter_by_date = datetime.today() - timedelta(days=filter_by_intervals)
-        df = df[df['date'] >= filter_by_date]
-        return df
+        timezone = self.p_reader.session_timezone
+        today = pd.Timestamp.now(tz=timezone) if today is None else pd.Timestamp(today)
+        if today.tzinfo is None:
+            today = today.tz_localize(timezone)
+        return today - timedelta(days=filter_by_intervals)
 
-    def read_indicator_file(self) -> pd.DataFrame:
-        _dir = self.p_reader.historical_dir
-        _startswith = self.p_reader.indicator_startswith
-        latest_file = self.utilities.get_latest_file(directory=_dir, startswith=_startswith)
-
-        data = list()
-        with open(latest_file, 'r') as handler:
-            for line in handler:
-                js = json.loads(line)
-                data.append(js)
-        df = pd.DataFrame(data)
-        df = df.drop_duplicates(keep='first')
-        return df
+    def read_indicator_file(self, today:datetime=None) -> pd.DataFrame:
+        '''the bars from the cutoff on; the dataset layout only opens the partitions holding them'''
+        cutoff = to_epoch(pd.DatetimeIndex([self.cutoff(today)]))[0]
+        return self.tables.read(self.p_reader.indicator_startswith, start=cutoff)
 
     def create_df_output_file(self, df:pd.DataFrame) -> str:
-        _dir = self.p_reader.historical_dir
-        _startswith = self.p_reader.strategy_startswith
-        file_path = Path(_dir + '/' + _startswith + date.today().strftime("%Y_%m_%d"))
-        records = df.to_dict('records')
-        writer = open(str(file_path.absolute()), 'w')
-        for record in records:
-            writer.write(json.dumps(record))
-            writer.write('\n')
-        writer.close()
-        return str(file_path.absolute())
+        return self.tables.write(self.p_reader.strategy_startswith, df)
 
     def create_buy_sell_output_file(self, buys, sells):
         _dir = self.p_reader.historical_dir
         _startswith = self.p_reader.buysell_startswith
-        file_path = Path(_dir + '/' + _startswith + date.today().strftime("%Y_%m_%d"))
+        file_path = Path(_dir + '/' + _startswith + self.tables.day.strftime("%Y_%m_%d"))
 
         writer = open(str(file_path.absolute()), 'w')
         writer.write(json.dumps({'BUY':list(buys), 'SELL':list(sells)}))
         writer.close()
         return
 
-    def apply_strategies(self):
-        df = self.read_indicator_file()
-        df['date'] = pd.to_datetime(df.timestamp, format="%Y %m %d %H:%M:%S")
-
-        buy_sup_short_medium, sell_sup_short_medium = self.strategy_supertrend_short_medium(df)
-        buy_sup_short_long, sell_sup_short_long = self.strategy_supertrend_short_long(df)
-        buy_sup_short_ema55, sell_sup_short_ema55 = self.strategy_supertrend_ema55(df)
-        buy_sup_short_ema100, sell_sup_short_ema100 = self.strategy_supertrend_ema100(df)
-
-        # all list of stocks to file
-        all_buys = set(list(buy_sup_short_ema55['ticker']) + list(buy_sup_short_ema100['ticker']) + list(
-            buy_sup_short_long['ticker']) + list(buy_sup_short_medium['ticker']))
-        all_sells = set(list(sell_sup_short_ema55['ticker']) + list(sell_sup_short_ema100['ticker']) + list(
-            sell_sup_short_long['ticker']) + list(sell_sup_short_medium['ticker']))
-        self.create_buy_sell_output_file(all_buys, all_sells)
-
-        # save all filtered stocks to a file
-        frames = [buy_sup_short_medium, sell_sup_short_medium, buy_sup_short_long, sell_sup_short_long,
-                  buy_sup_short_ema55, sell_sup_short_ema55, buy_sup_short_ema100, sell_sup_short_ema100]
+    def compute(self, df:pd.DataFrame, today:datetime=None) -> (set, set, pd.DataFrame):
+        '''(buy tickers, sell tickers, signal rows) of the recent bars; `df` is not modified'''
+        with self.recorder.stage('filter') as span:
+            # compared as epoch seconds; only the kept rows get a datetime 'date'
+            cutoff = to_epoch(pd.DatetimeIndex([self.cutoff(today)]))[0]
+            df = df[df['timestamp'].to_numpy() >= cutoff]
+            df = df.assign(date=to_datetime(df['timestamp']))
+            span.count(rows=df.shape[0])
+        signals = self.rules.signals(df, recorder=self.recorder)
+
+        all_buys = set(ticker for _, buys, _ in signals for ticker in buys['ticker'])
+        all_sells = set(ticker for _, _, sells in signals for ticker in sells['ticker'])
+        frames = [frame for _, buys, sells in signals for frame in (buys, sells)]
         strategy_df = pd.concat(frames)
         strategy_df = strategy_df.drop_duplicates(keep='first')
-        self.create_df_output_file(strategy_df)
-        return
+        return all_buys, all_sells, strategy_df
+
+    def write_output(self, buys:set, sells:set, strategy_df:pd.DataFrame):
+        with self.recorder.stage('write', buys=len(buys), sells=len(sells), rows=strategy_df.shape[0]):
+            # all list of stocks to file
+            self.create_buy_sell_output_file(buys, sells)
+            # save all filtered stocks to a file
+            self.create_df_output_file(strategy_df)
 
+    def apply_strategies(self):
+        with self.recorder.stage('read') as span:
+            df = self.read_indicator_file()
+            span.count(rows=df.shape[0], tickers=df['ticker'].nunique())
+        buys, sells, strategy_df = self.compute(df)
+        self.write_output(buys, sells, strategy_df)
+        return
 
-# TODO: add Pankaj's Strategy
-"""
-## Pankaj Strategy
-interval: 10 min
-buy: price above 20 sma (bollinger) and above previous closest high 
-	strong buy: price above vwap
-sell: price below 5 ema + 1 interval
-leverage ??
-"""
 
 # TODO - add https://www.youtube.com/watch?v=KO7lX7-Fi7U strategy
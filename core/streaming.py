@@ -0,0 +1,343 @@
+'''
+Bar-by-bar streaming mode.
+
+Every ticker carries the same recurrences as the batch kernels (EMA weights, ATR, final bands,
+direction, last close), held as Python floats and advanced in O(1) per bar with the same floating
+point operations, so a stream reproduces the batch indicator columns. A stream can start from the
+state saved by the incremental indicator run (indicator.incremental) or from nothing.
+
+The newest bar of a ticker may still be revised by the data source: a bar with the same timestamp
+as the previous one replaces it (the ticker is rolled back one bar first), older bars are dropped.
+'''
+import argparse
+import math
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from common.chunked_reader import ChunkedReader
+from common.dataset import StageTables
+from common.property_reader import PropertyReader
+from common.storage import get_storage
+from common.utilities import Utilities
+from core import kernels
+from core.incremental import IncrementalIndicators
+from core.rules import DEFAULT_RULES, RuleSet
+
+
+# the bar columns a source hands over; the engine adds the EMA and supertrend columns
+BAR_COLUMNS = ['ticker', 'timestamp', 'open', 'high', 'low', 'close', 'volume']
+
+class StreamingEwm:
+    '''one row of kernels.ewm_mean'''
+    __slots__ = ('alpha', 'adjust', 'min_periods', 'weighted', 'old_wt', 'nobs')
+
+    def __init__(self, alpha:float, adjust:bool, min_periods:int=0, weighted:float=math.nan, old_wt:float=1.0,
+                 nobs:int=0):
+        self.alpha = alpha
+        self.adjust = adjust
+        self.min_periods = max(int(min_periods), 1)
+        self.weighted = weighted
+        self.old_wt = old_wt
+        self.nobs = nobs
+
+    def clone(self) -> 'StreamingEwm':
+        return StreamingEwm(self.alpha, self.adjust, self.min_periods, self.weighted, self.old_wt, self.nobs)
+
+    def update(self, cur:float) -> float:
+        is_obs = cur == cur
+        self.nobs += is_obs
+        weighted = self.weighted
+        if weighted == weighted:
+            self.old_wt = self.old_wt * (1. - self.alpha)
+            if is_obs:
+                new_wt = 1. if self.adjust else self.alpha
+                if weighted != cur:
+                    self.weighted = (self.old_wt * weighted + new_wt * cur) / (self.old_wt + new_wt)
+                self.old_wt = self.old_wt + new_wt if self.adjust else 1.
+        elif is_obs:
+            self.weighted = cur
+        return self.weighted if self.nobs >= self.min_periods else math.nan
+
+
+class StreamingSupertrend:
+    '''one row of kernels.supertrend plus its crossovers'''
+    __slots__ = ('period', 'multiplier', 'atr', 'bars', 'has_zero', 'close', 'upper', 'lower', 'direction', 'trend')
+
+    def __init__(self, period:int, multiplier:float):
+        self.period = int(period)
+        self.multiplier = float(multiplier)
+        self.atr = StreamingEwm(float(kernels.alpha_from_alpha(1.0 / self.period)), adjust=True,
+                                min_periods=self.period)
+        self.bars = 0
+        self.has_zero = False
+        self.close = math.nan
+        self.upper = math.nan
+        self.lower = math.nan
+        self.direction = 1.
+        self.trend = math.nan
+
+    def clone(self) -> 'StreamingSupertrend':
+        other = StreamingSupertrend.__new__(StreamingSupertrend)
+        for key in self.__slots__:
+            setattr(other, key, getattr(self, key))
+        other.atr = self.atr.clone()
+        return other
+
+    def update(self, high:float, low:float, close:float) -> (float, float, float, float):
+        '''(trend, direction, buy, sell) of the new bar'''
+        high_low = high - low
+        self.has_zero = self.has_zero or high_low == 0
+        if self.has_zero:
+            high_low += sys.float_info.epsilon
+        if self.bars == 0:
+            tr = math.nan
+        else:
+            tr = fmax(fmax(abs(high_low), abs(high - self.close)), abs(low - self.close))
+        matr = self.multiplier * self.atr.update(tr)
+        hl2 = 0.5 * (high + low)
+        upper, lower = hl2 + matr, hl2 - matr
+
+        cross_up = close > self.upper
+        cross_down = close < self.lower
+        d = 1. if cross_up else -1. if cross_down else self.direction
+        hold = not cross_up and not cross_down
+        lo = self.lower if hold and d > 0 and lower < self.lower else lower
+        up = self.upper if hold and d < 0 and upper > self.upper else upper
+        t = 0.0 if self.bars == 0 else lo if d > 0 else up
+
+        buy = sell = 0.0
+        if self.bars >= max(self.period - 1, 1):
+            buy = float(self.close <= self.trend and close > t)
+            sell = float(self.close >= self.trend and close < t)
+        self.upper, self.lower, self.direction, self.close, self.trend = up, lo, d, close, t
+        self.bars += 1
+        return t, d, buy, sell
+
+
+def fmax(a:float, b:float) -> float:
+    # np.fmax: NaN only when both are NaN
+    if a != a:
+        return b
+    if b != b:
+        return a
+    return a if a >= b else b
+
+
+class TickerStream:
+    '''indicator state of one ticker, plus the state before its newest bar for revisions'''
+    __slots__ = ('emas', 'supertrends', 'last_timestamp', 'previous', 'values')
+
+    def __init__(self, emas:list, supertrends:list):
+        self.emas = [StreamingEwm(float(kernels.alpha_from_span(span)), adjust=False) for span in emas]
+        self.supertrends = [StreamingSupertrend(period, multiplier) for period, multiplier, _ in supertrends]
+        self.last_timestamp = None
+        self.previous = None
+        self.values = None
+
+    def snapshot(self) -> 'TickerStream':
+        other = TickerStream.__new__(TickerStream)
+        other.emas = [ewm.clone() for ewm in self.emas]
+        other.supertrends = [sup.clone() for sup in self.supertrends]
+        other.last_timestamp, other.previous, other.values = self.last_timestamp, None, self.values
+        return other
+
+
+class StreamingEngine:
+    '''
+    Updates the indicators of a ticker when its next bar arrives and evaluates every strategy rule
+    on that bar. `on_bar` returns the signals of the bar as dicts (ticker, timestamp, rule, side, close).
+    Only the EMAs and supertrends are streamed, so rules using other columns are rejected up front.
+    '''
+    def __init__(self, emas:list, supertrends:list, rules:RuleSet, state:dict=None):
+        self.emas = list(emas)
+        self.supertrends = [tuple(sup) for sup in supertrends]
+        self.rules = rules
+        self.check_rules()
+        self.streams = dict()
+        self.counts = {'bars': 0, 'revisions': 0, 'stale': 0, 'signals': 0}
+        if state is not None:
+            self.load_state(state)
+
+    def columns(self) -> list:
+        '''the columns every streamed bar holds'''
+        return BAR_COLUMNS + ['ema' + str(span) for span in self.emas] + \
+            [prefix + identifier for _, _, identifier in self.supertrends for prefix in ('sup_', 'buy_', 'sell_')]
+
+    def check_rules(self):
+        columns = set(self.columns())
+        for rule in self.rules.rules:
+            missing = sorted(rule.columns() - columns)
+            if len(missing) > 0:
+                raise ValueError('rule ' + rule.name + ' uses ' + ', '.join(missing) + ', which streaming does not '
+                                 'compute; it streams ' + ', '.join(self.columns()))
+
+    def __new_stream(self) -> TickerStream:
+        return TickerStream(self.emas, self.supertrends)
+
+    def load_state(self, state:dict):
+        '''continue from an IncrementalIndicators state; bars up to its last_timestamp are stale'''
+        if not IncrementalIndicators(self.emas, self.supertrends).usable(state):
+            raise ValueError('indicator state was saved with different indicator.emas / indicator.supertrends')
+        for i, ticker in enumerate(state['tickers']):
+            stream = self.__new_stream()
+            for ewm, span in zip(stream.emas, self.emas):
+                saved = state['emas'][span]
+                ewm.weighted, ewm.old_wt, ewm.nobs = float(saved['weighted'][i]), float(saved['old_wt'][i]), int(saved['nobs'][i])
+            for sup, (_, _, identifier) in zip(stream.supertrends, self.supertrends):
+                saved = state['supertrends'][identifier]
+                sup.atr.weighted = float(saved['atr']['weighted'][i])
+                sup.atr.old_wt = float(saved['atr']['old_wt'][i])
+                sup.atr.nobs = int(saved['atr']['nobs'][i])
+                sup.bars, sup.has_zero = int(saved['bars'][i]), bool(saved['has_zero'][i])
+                for key in ('close', 'upper', 'lower', 'direction', 'trend'):
+                    setattr(sup, key, float(saved[key][i]))
+            stream.last_timestamp = state['last_timestamp'][i]
+            self.streams[ticker] = stream
+
+    def on_bar(self, bar:dict) -> list:
+        ticker, timestamp = bar['ticker'], bar['timestamp']
+        stream = self.streams.get(ticker)
+        if stream is None:
+            stream = self.streams[ticker] = self.__new_stream()
+        elif stream.last_timestamp is not None and timestamp <= stream.last_timestamp:
+            if timestamp < stream.last_timestamp or stream.previous is None:
+                self.counts['stale'] += 1
+                return []
+            # a revision of the newest bar: roll back and apply it again
+            stream = self.streams[ticker] = stream.previous
+            self.counts['revisions'] += 1
+
+        stream.previous = stream.snapshot()
+        high, low, close = float(bar['high']), float(bar['low']), float(bar['close'])
+        values = dict(bar)
+        for ewm, span in zip(stream.emas, self.emas):
+            values['ema' + str(span)] = ewm.update(close)
+        for sup, (_, _, identifier) in zip(stream.supertrends, self.supertrends):
+            values['sup_' + identifier], _, values['buy_' + identifier], values['sell_' + identifier] = \
+                sup.update(high, low, close)
+        stream.last_timestamp = timestamp
+        stream.values = values
+        self.counts['bars'] += 1
+
+        signals = list()
+        for rule in self.rules.rules:
+            buy, sell = rule.evaluate_bar(values)
+            for side, flagged in (('BUY', buy), ('SELL', sell)):
+                if flagged:
+                    signals.append({'ticker': ticker, 'timestamp': timestamp, 'rule': rule.name, 'side': side,
+                                    'close': close})
+        self.counts['signals'] += len(signals)
+        return signals
+
+    def run(self, source, on_signal=None) -> dict:
+        '''
+        feeds every bar of `source` through on_bar. Latency is measured per bar from the moment the
+        source hands it over until its signals are emitted.
+        '''
+        latencies = list()
+        started = time.perf_counter()
+        for bar in source:
+            received = time.perf_counter()
+            signals = self.on_bar(bar)
+            if on_signal is not None:
+                for signal in signals:
+                    on_signal(signal)
+            latencies.append(time.perf_counter() - received)
+        elapsed = time.perf_counter() - started
+        latencies = np.asarray(latencies) * 1e6
+        stats = dict(self.counts)
+        stats.update({'elapsed_sec': elapsed,
+                      'bars_per_sec': len(latencies) / elapsed if elapsed > 0 else math.nan,
+                      'latency_p50_us': float(np.percentile(latencies, 50)) if len(latencies) else math.nan,
+                      'latency_p99_us': float(np.percentile(latencies, 99)) if len(latencies) else math.nan,
+                      'latency_max_us': float(latencies.max()) if len(latencies) else math.nan})
+        return stats
+
+
+class ReplaySource:
+    '''
+    yields the bars of a history file (or of an already read history `table`) in (timestamp, ticker)
+    order. `speed` is market seconds per wall clock second (e.g. 60 plays one minute of bars per
+    second); 0 replays as fast as possible.
+    '''
+    columns = BAR_COLUMNS
+
+    def __init__(self, path:str=None, speed:float=0.0, chunk_rows:int=200000, after=None, table:pd.DataFrame=None):
+        self.path = path
+        self.speed = float(speed)
+        self.chunk_rows = chunk_rows
+        self.after = after
+        self.table = table
+
+    def frame(self) -> pd.DataFrame:
+        df = self.table if self.table is not None else ChunkedReader(self.path, chunk_rows=self.chunk_rows).read()
+        df = df[[col for col in self.columns if col in df.columns]]
+        if self.after is not None:
+            df = df[df['timestamp'] > self.after]
+        return df.sort_values(['timestamp', 'ticker'], kind='mergesort', ignore_index=True)
+
+    def __iter__(self):
+        df = self.frame()
+        columns = list(df.columns)
+        first, started = None, time.monotonic()
+        for row in zip(*[df[col].tolist() for col in columns]):
+            bar = dict(zip(columns, row))
+            if self.speed > 0:
+                first = bar['timestamp'] if first is None else first
+                wait = (bar['timestamp'] - first) / self.speed - (time.monotonic() - started)
+                if wait > 0:
+                    time.sleep(wait)
+            yield bar
+
+
+class StreamRunner:
+    def __init__(self, prop_file):
+        self.p_reader = PropertyReader(prop_file=prop_file)
+        self.utilities = Utilities()
+        self.storage = get_storage(self.p_reader.storage_format)
+        self.tables = StageTables(self.p_reader)
+
+    def read_state(self):
+        try:
+            latest_file = self.utilities.get_latest_file(directory=self.p_reader.historical_dir,
+                                                         startswith=self.p_reader.state_startswith)
+        except IndexError:
+            return None
+        return self.utilities.read_pkl(latest_file)
+
+    def replay(self, speed:float=None, use_state:bool=True) -> dict:
+        speed = self.p_reader.stream_speed if speed is None else speed
+        state = self.read_state() if use_state else None
+        if state is not None and not IncrementalIndicators(self.p_reader.emas, self.p_reader.supertrends).usable(state):
+            print('indicator state does not match the indicator settings, streaming from scratch')
+            state = None
+        engine = StreamingEngine(self.p_reader.emas, self.p_reader.supertrends,
+                                 RuleSet(self.p_reader.strategy_rules or DEFAULT_RULES), state=state)
+        history = self.tables.read(self.p_reader.history_startswith)
+        signals = list()
+
+        def on_signal(signal):
+            signals.append(signal)
+            if self.p_reader.stream_print_signals:
+                print(signal['side'], signal['ticker'], signal['rule'], signal['timestamp'], signal['close'])
+
+        stats = engine.run(ReplaySource(speed=speed, table=history), on_signal)
+        if len(signals) > 0:
+            file_path = self.storage.path_for(directory=self.p_reader.historical_dir,
+                                              startswith=self.p_reader.stream_startswith)
+            self.storage.write(pd.DataFrame(signals), file_path)
+        print('stream: %(bars)d bars, %(signals)d signals, %(revisions)d revisions, %(stale)d stale bars' % stats)
+        print('stream: %.0f bars/sec, latency p50 %.1fus p99 %.1fus max %.1fus'
+              % (stats['bars_per_sec'], stats['latency_p50_us'], stats['latency_p99_us'], stats['latency_max_us']))
+        return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='replay the latest history file through the streaming engine')
+    parser.add_argument('prop_file', help='conf.ini')
+    parser.add_argument('--speed', type=float, default=None, help='market seconds per second, 0 = unthrottled')
+    parser.add_argument('--no-state', action='store_true', help='ignore the saved indicator state')
+    args = parser.parse_args()
+    StreamRunner(args.prop_file).replay(speed=args.speed, use_state=not args.no_state)
@@ -0,0 +1,198 @@
+'''
+Parameter sweep over supertrend (period, multiplier) and EMA spans.
+
+The history is packed once into (tickers, bars) matrices in shared memory. A task is one
+(period, multiplier) pair on one shard of tickers: the worker maps the matrices, computes the
+supertrend once and backtests the sweep rule for every EMA span against it. Finished tasks are
+appended to a checkpoint file, so an interrupted sweep resumes where it stopped.
+'''
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from common.dataset import StageTables
+from common.property_reader import PropertyReader
+from common.shared_arrays import SharedArrays
+from common.storage import get_storage
+from common.utilities import Utilities
+from core import kernels
+from core.backtester import Backtester, signal_values
+from core.rules import Evaluator, parse_expression
+from core.ticker_blocks import TickerBlocks
+
+PRICE_COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+METRIC_ARRAYS = ['total_return', 'max_drawdown', 'exposure']
+
+_shared = None
+
+
+def _attach(specs:dict):
+    global _shared
+    _shared = SharedArrays.attach(specs)
+
+
+def sweep_task(task:dict) -> dict:
+    '''backtest one (period, multiplier) pair on one ticker shard for every ema span of the task'''
+    start, stop = task['start'], task['stop']
+    columns = {col: _shared[col][start:stop] for col in PRICE_COLUMNS if col in _shared}
+    lengths = _shared['lengths'][start:stop]
+    close = columns['close']
+    trend, _ = kernels.supertrend(high=columns['high'], low=columns['low'], close=close, length=task['period'],
+                                  multiplier=task['multiplier'], lengths=lengths)
+    columns['sup'] = trend
+    columns['buy'], columns['sell'] = kernels.crossovers(close=close, line=trend, start=task['period'] - 1)
+    backtester = Backtester(None, fee_bps=task['fee_bps'], entry_lag=task['entry_lag'],
+                            allow_short=task['allow_short'])
+    buy_rule, sell_rule = parse_expression(task['buy']), parse_expression(task['sell'])
+
+    records = list()
+    for span in task['emas']:
+        columns['ema'] = kernels.ema(close, span=span, lengths=lengths)
+        evaluator = Evaluator(columns)
+        result = backtester.simulate(close, signal_values(evaluator.mask(buy_rule), evaluator.mask(sell_rule)), lengths)
+        record = {'ema': span, 'trades': int(result['trades'].sum()), 'wins': int(result['wins'].sum())}
+        for name in METRIC_ARRAYS:
+            record[name] = result[name].tolist()
+        records.append(record)
+    return {'key': task['key'], 'records': records}
+
+
+class ParameterSweep:
+    def __init__(self, prop_file):
+        self.p_reader = PropertyReader(prop_file=prop_file)
+        self.utilities = Utilities()
+        self.storage = get_storage(self.p_reader.storage_format)
+        self.tables = StageTables(self.p_reader)
+
+    def read_history_file(self) -> (str, pd.DataFrame):
+        latest_file = self.tables.latest(self.p_reader.history_startswith)
+        return latest_file, self.tables.read(self.p_reader.history_startswith)
+
+    def grid(self) -> list:
+        return list(itertools.product(self.p_reader.sweep_periods, self.p_reader.sweep_multipliers))
+
+    def fingerprint(self, history_file:str, n_tickers:int) -> str:
+        '''identifies a sweep: same grid, rule, costs, shards and input file -> same checkpoint'''
+        stat = os.stat(history_file)
+        config = [self.grid(), self.p_reader.sweep_emas, self.p_reader.sweep_buy, self.p_reader.sweep_sell,
+                  self.p_reader.backtest_fee_bps, self.p_reader.backtest_entry_lag, self.p_reader.backtest_allow_short,
+                  self.p_reader.sweep_shard_tickers, n_tickers, history_file, stat.st_size, stat.st_mtime]
+        return hashlib.md5(json.dumps(config, default=str).encode()).hexdigest()[:12]
+
+    def tasks(self, n_tickers:int) -> list:
+        shard = max(self.p_reader.sweep_shard_tickers, 1)
+        tasks = list()
+        for period, multiplier in self.grid():
+            for start in range(0, n_tickers, shard):
+                tasks.append({'key': '%s_%s_%d' % (period, multiplier, start), 'period': period,
+                              'multiplier': multiplier, 'start': start, 'stop': min(start + shard, n_tickers),
+                              'emas': list(self.p_reader.sweep_emas), 'buy': self.p_reader.sweep_buy,
+                              'sell': self.p_reader.sweep_sell, 'fee_bps': self.p_reader.backtest_fee_bps,
+                              'entry_lag': self.p_reader.backtest_entry_lag,
+                              'allow_short': self.p_reader.backtest_allow_short})
+        return tasks
+
+    def read_checkpoint(self, path:str) -> dict:
+        done = dict()
+        if not os.path.exists(path):
+            return done
+        with open(path, 'r') as handler:
+            for line in handler:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    # a line cut short by the interruption
+                    continue
+                done[result['key']] = result
+        return done
+
+    def run_tasks(self, tasks:list, shared:SharedArrays, checkpoint:str, done:dict) -> dict:
+        pending = [task for task in tasks if task['key'] not in done]
+        print('sweep: %d tasks, %d already done' % (len(tasks), len(tasks) - len(pending)))
+        started = time.monotonic()
+        writer = open(checkpoint, 'a')
+        try:
+            def finished(result, count):
+                done[result['key']] = result
+                writer.write(json.dumps(result) + '\n')
+                writer.flush()
+                elapsed = time.monotonic() - started
+                eta = elapsed / count * (len(pending) - count)
+                print('sweep: %d/%d tasks (%.0f%%), %.1fs elapsed, eta %.1fs'
+                      % (len(tasks) - len(pending) + count, len(tasks), 100.0 * count / len(pending), elapsed, eta))
+
+            if self.p_reader.sweep_workers <= 1:
+                global _shared
+                _shared = shared
+                for count, task in enumerate(pending, start=1):
+                    finished(sweep_task(task), count)
+            else:
+                with ProcessPoolExecutor(max_workers=self.p_reader.sweep_workers, initializer=_attach,
+                                         initargs=(shared.specs,)) as executor:
+                    futures = [executor.submit(sweep_task, task) for task in pending]
+                    for count, future in enumerate(as_completed(futures), start=1):
+                        finished(future.result(), count)
+        finally:
+            writer.close()
+        return done
+
+    def rank(self, tasks:list, done:dict) -> pd.DataFrame:
+        merged = dict()
+        for task in tasks:
+            for record in done[task['key']]['records']:
+                key = (task['period'], task['multiplier'], record['ema'])
+                entry = merged.setdefault(key, {name: list() for name in METRIC_ARRAYS + ['trades', 'wins']})
+                for name in METRIC_ARRAYS:
+                    entry[name].extend(record[name])
+                entry['trades'].append(record['trades'])
+                entry['wins'].append(record['wins'])
+
+        rows = list()
+        for (period, multiplier, span), entry in merged.items():
+            returns = np.asarray(entry['total_return'], dtype=float)
+            trades, wins = sum(entry['trades']), sum(entry['wins'])
+            rows.append({'period': period, 'multiplier': multiplier, 'ema': span, 'tickers': len(returns),
+                         'mean_return': np.nanmean(returns) if len(returns) else np.nan,
+                         'median_return': np.nanmedian(returns) if len(returns) else np.nan,
+                         'std_return': np.nanstd(returns) if len(returns) else np.nan,
+                         'mean_max_drawdown': np.nanmean(entry['max_drawdown']) if len(returns) else np.nan,
+                         'mean_exposure': np.nanmean(entry['exposure']) if len(returns) else np.nan,
+                         'trades': trades, 'win_rate': wins / trades if trades else np.nan})
+        ranked = pd.DataFrame(rows).sort_values(self.p_reader.sweep_rank_by, ascending=False, kind='mergesort',
+                                                ignore_index=True)
+        ranked.insert(0, 'rank', np.arange(1, ranked.shape[0] + 1))
+        return ranked
+
+    def run(self) -> pd.DataFrame:
+        history_file, df = self.read_history_file()
+        blocks = TickerBlocks(df)
+        arrays = {col: blocks.pack(col) for col in PRICE_COLUMNS if col in df.columns}
+        arrays['lengths'] = blocks.lengths
+        tasks = self.tasks(len(blocks))
+        _dir = self.p_reader.historical_dir
+        checkpoint = str(Path(_dir + '/' + self.p_reader.sweep_checkpoint_startswith
+                              + self.fingerprint(history_file, len(blocks))).absolute())
+
+        with SharedArrays(arrays) as shared:
+            done = self.run_tasks(tasks, shared, checkpoint, self.read_checkpoint(checkpoint))
+        ranked = self.rank(tasks, done)
+
+        file_path = self.storage.path_for(directory=_dir, startswith=self.p_reader.sweep_startswith)
+        self.storage.write(ranked, file_path)
+        os.remove(checkpoint)
+        print(ranked.head(10).to_string(index=False))
+        return ranked
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='rank supertrend / ema parameter sets by backtest metrics')
+    parser.add_argument('prop_file', help='conf.ini')
+    args = parser.parse_args()
+    ParameterSweep(args.prop_file).run()
@@ -0,0 +1,99 @@
+import heapq
+import numpy as np
+import pandas as pd
+from core import kernels
+
+
+class TickerBlocks:
+    '''
+    A long (ticker, timestamp, ...) frame sorted once by (ticker, timestamp) and cut into contiguous
+    per-ticker blocks by offset boundaries. Block i spans rows starts[i]:ends[i] of `df`.
+
+    - `view(col, i)` is a zero-copy slice of one ticker's column
+    - `pack(col)` lays a column out as a (tickers, bars) NaN padded matrix for the batched kernels
+    - `assign(name, matrix)` writes a kernel result back into a preallocated output column
+    '''
+    def __init__(self, df:pd.DataFrame, key:str='ticker', order:str='timestamp'):
+        if self.is_sorted(df, key, order):
+            self.df = df.reset_index(drop=True)
+        else:
+            self.df = df.sort_values([key, order], kind='mergesort', ignore_index=True)
+        n = self.df.shape[0]
+        keys = self.keys(self.df[key])
+        if n == 0:
+            self.starts = np.zeros(0, dtype=np.int64)
+        else:
+            self.starts = np.r_[0, np.flatnonzero(keys[1:] != keys[:-1]) + 1].astype(np.int64)
+        self.ends = np.r_[self.starts[1:], n].astype(np.int64) if n else np.zeros(0, dtype=np.int64)
+        self.tickers = self.df[key].iloc[self.starts].to_numpy(dtype=object)
+        self.lengths = self.ends - self.starts
+        self.width = int(self.lengths.max()) if n else 0
+
+        self.codes = np.repeat(np.arange(len(self.starts)), self.lengths)
+        self.positions = np.arange(n) - np.repeat(self.starts, self.lengths)
+        self.flat_index = self.codes * self.width + self.positions
+
+    @staticmethod
+    def keys(values:pd.Series) -> np.ndarray:
+        '''comparable keys: the integer codes of a categorical column (sorted categories), else the values'''
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            return values.cat.codes.to_numpy()
+        return values.to_numpy()
+
+    @staticmethod
+    def is_sorted(df:pd.DataFrame, key:str, order:str) -> bool:
+        '''stage outputs are written in (ticker, timestamp) order, which makes the sort a no-op'''
+        if df.shape[0] < 2 or not pd.Index(df[key]).is_monotonic_increasing:
+            return df.shape[0] < 2
+        keys, values = TickerBlocks.keys(df[key]), df[order].to_numpy()
+        same = keys[1:] == keys[:-1]
+        return bool(np.all(values[1:][same] >= values[:-1][same]))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def shards(self, n_shards:int) -> list:
+        '''
+        up to `n_shards` sorted arrays of block numbers with about equal bar counts: the longest
+        processing time rule places every ticker, longest first, in the shard with the fewest bars
+        '''
+        n_shards = max(min(int(n_shards), len(self)), 1)
+        heap = [(0, k) for k in range(n_shards)]
+        members = [list() for _ in range(n_shards)]
+        for i in np.argsort(-self.lengths, kind='stable'):
+            bars, k = heapq.heappop(heap)
+            members[k].append(i)
+            heapq.heappush(heap, (bars + int(self.lengths[i]), k))
+        return [np.sort(np.asarray(rows, dtype=np.int64)) for rows in members if len(rows) > 0]
+
+    def block(self, i:int) -> slice:
+        return slice(int(self.starts[i]), int(self.ends[i]))
+
+    def iter_blocks(self):
+        for i, ticker in enumerate(self.tickers):
+            yield ticker, self.block(i)
+
+    def column(self, col:str) -> np.ndarray:
+        return self.df[col].to_numpy(dtype=float)
+
+    def view(self, col:str, i:int) -> np.ndarray:
+        return self.column(col)[self.block(i)]
+
+    def pack(self, col:str) -> np.ndarray:
+        return kernels.pad_groups(self.column(col), self.codes, self.positions, len(self), self.width)
+
+    def unpack(self, matrix:np.ndarray, out:np.ndarray=None) -> np.ndarray:
+        if out is None:
+            out = np.empty(self.df.shape[0], dtype=matrix.dtype)
+        np.take(matrix, self.flat_index, out=out)
+        return out
+
+    def assign(self, name:str, matrix:np.ndarray, dtype=None):
+        '''`dtype` converts the unpacked column, e.g. to float32 or bool (non zero = True)'''
+        values = self.unpack(matrix)
+        if dtype == np.bool_:
+            values = values > 0
+        elif dtype is not None:
+            values = values.astype(dtype, copy=False)
+        self.df[name] = values
+        return self.df
@@ -0,0 +1,95 @@
+'''
+Multi timeframe runs: loader.interval is downloaded once, every interval in loader.timeframes is
+built from it with one resample.cascade pass (session anchored buckets, like loader.combine_rule),
+and indicators / strategies run per timeframe. Each timeframe's files go to saver.dir/<timeframe>/
+(with saver.layout=dataset: the tables to the <timeframe> partitions of the saver.dir dataset).
+
+    loader.interval=30m
+    loader.timeframes=['30m', '1h', '2h', '4h', '1d']
+
+`run` returns {timeframe: Pipeline.process result}; `confirmed` intersects the buy or sell tickers
+of several timeframes for confirmation style strategies.
+'''
+import time
+import pandas as pd
+from common.instrumentation import Recorder
+from common.property_reader import PropertyReader
+from core import resample
+from core.data_collector import DataDownloader
+from core.pipeline import Pipeline
+
+
+def interval_width(interval:str) -> pd.Timedelta:
+    '''bar width of a provider interval such as 5m, 30m, 1h, 1d'''
+    try:
+        return pd.Timedelta(interval)
+    except ValueError:
+        raise ValueError('unsupported timeframe ' + interval + ', expected minutes (m), hours (h) or days (d)')
+
+
+def confirmed(results:dict, side:str='buys', timeframes:list=None) -> set:
+    '''tickers with a `side` ('buys' / 'sells') signal on every one of `timeframes` (default: all)'''
+    timeframes = list(results) if timeframes is None else timeframes
+    sets = [results[timeframe][side] for timeframe in timeframes if results.get(timeframe) is not None]
+    return set.intersection(*sets) if len(sets) > 0 else set()
+
+
+class MultiTimeframe:
+    def __init__(self, prop_file, recorder:Recorder=None):
+        self.p_reader = PropertyReader(prop_file=prop_file)
+        self.recorder = Recorder.disabled() if recorder is None else recorder
+        base = interval_width(self.p_reader.interval)
+        self.timeframes = sorted(self.p_reader.timeframes, key=interval_width)
+        for timeframe in self.timeframes:
+            if interval_width(timeframe) > base:
+                # coarser timeframes are session anchored buckets of at most a day
+                resample.rule_width(timeframe)
+            if interval_width(timeframe) < base:
+                raise ValueError('timeframe ' + timeframe + ' is finer than loader.interval ' + self.p_reader.interval)
+        self.base = base
+        self.downloader = DataDownloader(prop_file, recorder=self.recorder)
+        self.pipelines = {timeframe: Pipeline(prop_file, recorder=self.recorder, timeframe=timeframe)
+                          for timeframe in self.timeframes}
+
+    def aggregate(self, downloaded:dict) -> dict:
+        '''{timeframe: {category: (tickers, frame)}} from the base interval download'''
+        rules = [timeframe for timeframe in self.timeframes if interval_width(timeframe) > self.base]
+        by_timeframe = {timeframe: dict() for timeframe in self.timeframes}
+        for category, (tickers, frame) in downloaded.items():
+            frames = resample.cascade(frame, rules, session_start=self.p_reader.session_start)
+            for timeframe in self.timeframes:
+                by_timeframe[timeframe][category] = (tickers, frames.get(timeframe, frame))
+        return by_timeframe
+
+    def run(self) -> dict:
+        started = time.perf_counter()
+        # one writer thread for every timeframe: the next timeframe computes while the last one is written
+        sink = self.pipelines[self.timeframes[0]].sink()
+        results = dict()
+        try:
+            print('Data Downloading starts.. (' + self.p_reader.interval + ' for ' + ', '.join(self.timeframes) + ')')
+            with self.recorder.stage('download'):
+                data_collector = self.downloader.data_collector(raw=True)
+                downloaded = self.downloader.download(data_collector)
+            if len(downloaded) == 0:
+                print('nothing downloaded')
+                return None
+            with self.recorder.stage('aggregate', timeframes=len(self.timeframes)):
+                by_timeframe = self.aggregate(downloaded)
+            del downloaded
+
+            for timeframe in self.timeframes:
+                pipeline = self.pipelines[timeframe]
+                with self.recorder.stage('tf:' + timeframe):
+                    history = self.downloader.convert(data_collector, by_timeframe.pop(timeframe),
+                                                      name='history ' + timeframe)
+                    sink.submit('history ' + timeframe, pipeline.write_history, history)
+                    results[timeframe] = pipeline.process(history, sink, started=started)
+        finally:
+            with self.recorder.stage('sink_wait'):
+                sink.close()
+
+        for side in ('buys', 'sells'):
+            print(side, 'on every timeframe:', sorted(confirmed(results, side)))
+        print('multi timeframe run done after %.2fs' % (time.perf_counter() - started))
+        return results
@@ -1,31 +1,79 @@
+from pathlib import Path
+from common.instrumentation import Recorder
+from common.property_reader import PropertyReader
+from core.backtester import BacktestRunner
 from core.data_collector import DataDownloader
 from core.indicators import IndicatorCalculator
+from core.pipeline import Pipeline
+from core.timeframes import MultiTimeframe
 from core.strategies import Strategies
 
 
-def data_downloader(prop_file):
+def data_downloader(prop_file, recorder=None):
     print('Data Downloading starts..')
-    downloader = DataDownloader(prop_file)
+    downloader = DataDownloader(prop_file, recorder=recorder)
     downloader.download_data()
     print('Data Downloading done..')
 
 
-def indicator_calculator(prop_file):
+def indicator_calculator(prop_file, recorder=None):
     print('\nIndicator calculations starts..')
-    indicator_calc = IndicatorCalculator(prop_file)
+    indicator_calc = IndicatorCalculator(prop_file, recorder=recorder)
     indicator_calc.calculate_indicators()
     print('Indicator calculations done..')
 
 
-def strategy_runner(prop_file):
+def strategy_runner(prop_file, recorder=None):
     print('\nStrategy application starts..')
-    strategy_maker = Strategies(prop_file=prop_file)
+    strategy_maker = Strategies(prop_file=prop_file, recorder=recorder)
     strategy_maker.apply_strategies()
     print('Strategy application done..')
 
 
+def backtest_runner(prop_file, recorder=None):
+    print('\nBacktest starts..')
+    backtester = BacktestRunner(prop_file=prop_file, recorder=recorder)
+    backtester.run_backtest()
+    print('Backtest done..')
+
+
+def write_run_report(prop_file, recorder:Recorder) -> str:
+    if not recorder.enabled:
+        return None
+    p_reader = PropertyReader(prop_file=prop_file)
+    file_path = Path(p_reader.historical_dir + '/' + p_reader.report_startswith
+                     + recorder.created.strftime("%Y_%m_%d_%H%M%S") + '.json')
+    recorder.write_report(str(file_path.absolute()))
+    print('\n' + recorder.summary())
+    print('Run report:', str(file_path.absolute()))
+    return str(file_path.absolute())
+
+
+def run(prop_file):
+    p_reader = PropertyReader(prop_file=prop_file)
+    recorder = Recorder.from_properties(p_reader)
+    recorder.annotate(interval=p_reader.interval, period=p_reader.period, fetcher=p_reader.fetcher,
+                      storage_format=p_reader.storage_format, emas=p_reader.emas, supertrends=p_reader.supertrends)
+    try:
+        if len(p_reader.timeframes) > 0:
+            MultiTimeframe(prop_file, recorder=recorder).run()
+            return
+        if p_reader.pipeline_in_memory:
+            Pipeline(prop_file, recorder=recorder).run()
+            return
+        with recorder.stage('download'):
+            data_downloader(prop_file, recorder=recorder)
+        with recorder.stage('indicators'):
+            indicator_calculator(prop_file, recorder=recorder)
+        with recorder.stage('strategies'):
+            strategy_runner(prop_file, recorder=recorder)
+        with recorder.stage('backtest'):
+            backtest_runner(prop_file, recorder=recorder)
+    finally:
+        # a failed run still leaves the timings of the stages that ran
+        write_run_report(prop_file, recorder)
+
+
 if __name__ == '__main__':
     prop_file = '/Users/shekagra/Documents/dev/team-per/trader/data/conf.ini'
-    data_downloader(prop_file)
-    indicator_calculator(prop_file)
-    strategy_runner(prop_file)
+    run(prop_file)
@@ -0,0 +1,37 @@
+import configparser
+from pathlib import Path
+import pytest
+
+REPO = Path(__file__).resolve().parents[1]
+
+
+@pytest.fixture
+def make_conf(tmp_path):
+    '''
+    writes a copy of data/conf.ini for an offline run into tmp_path: synthetic bars, no rate limit,
+    cache and instrumentation off, saver.dir in tmp_path; `tickers` replaces the ticker file and
+    keyword arguments override keys of any section, e.g. make_conf(**{'indicator.incremental': 'True'})
+    '''
+    def make(tickers:str=None, **overrides) -> str:
+        config = configparser.ConfigParser()
+        config.read(REPO / 'data' / 'conf.ini')
+        saver_dir = tmp_path / 'historical_data'
+        saver_dir.mkdir(exist_ok=True)
+        settings = {'loader.fetcher': 'synthetic', 'loader.rate.per_sec': '0', 'cache.mode': 'off',
+                    'instrument.enabled': 'False', 'saver.dir': str(saver_dir),
+                    'loader.ticker.file': str(REPO / 'data' / 'tickers.txt')}
+        if tickers is not None:
+            ticker_file = tmp_path / 'tickers.txt'
+            ticker_file.write_text(tickers)
+            settings['loader.ticker.file'] = str(ticker_file)
+        settings.update(overrides)
+        for key, value in settings.items():
+            section = next((name for name in config.sections() if config.has_option(name, key)), None)
+            if section is None:
+                raise KeyError(key + ' is not in data/conf.ini')
+            config.set(section, key, str(value))
+        prop_file = tmp_path / 'conf.ini'
+        with open(prop_file, 'w') as writer:
+            config.write(writer)
+        return str(prop_file)
+    return make
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import pytest
+from core.backtester import Backtester
+from core.rules import RuleSet
+
+RULES = RuleSet([('flags', 'buy > 0', 'sell > 0', ['close', 'buy', 'sell'])])
+
+
+def frame(close:list, buy:list, sell:list, ticker:str='A') -> pd.DataFrame:
+    return pd.DataFrame({'ticker': ticker, 'timestamp': np.arange(len(close), dtype=np.int64) * 60,
+                         'close': np.array(close, dtype=float), 'buy': np.array(buy, dtype=float),
+                         'sell': np.array(sell, dtype=float)})
+
+
+# buy on bar 1, sell on bar 3
+ROUND_TRIP = frame([100, 100, 110, 121, 121, 110], [0, 1, 0, 0, 0, 0], [0, 0, 0, 1, 0, 0])
+
+
+def test_fill_at_the_signal_close():
+    result = Backtester(RULES).run(ROUND_TRIP)
+    trade = result['trades'].iloc[0]
+    # held over bars 2 and 3: filled at bar 1's close, closed at bar 3's
+    assert (trade['entry_price'], trade['exit_price'], trade['bars']) == (100., 121., 2)
+    assert (trade['entry_timestamp'], trade['exit_timestamp']) == (60, 180)
+    assert trade['return'] == pytest.approx(0.21)
+    assert not trade['open']
+    summary = result['summary'].iloc[0]
+    assert summary['total_return'] == pytest.approx(0.21)
+    assert summary['exposure'] == pytest.approx(2 / 6)
+    assert summary['buy_hold_return'] == pytest.approx(0.1)
+
+
+def test_entry_lag_delays_entry_and_exit():
+    trade = Backtester(RULES, entry_lag=1).run(ROUND_TRIP)['trades'].iloc[0]
+    assert (trade['entry_price'], trade['exit_price']) == (110., 121.)
+    assert trade['return'] == pytest.approx(0.1)
+
+
+def test_fee_is_charged_on_every_position_change():
+    result = Backtester(RULES, fee_bps=10).run(ROUND_TRIP)
+    assert result['trades'].iloc[0]['return'] == pytest.approx(0.21 - 0.002)
+    assert result['summary'].iloc[0]['total_return'] == pytest.approx((1.1 - 0.001) * 1.1 * (1 - 0.001) - 1)
+
+
+def test_trade_open_at_the_last_bar_is_flagged():
+    df = pd.concat([ROUND_TRIP, frame([50, 55, 60, 66], [1, 0, 0, 0], [0, 0, 0, 0], ticker='B')], ignore_index=True)
+    trades = Backtester(RULES).run(df)['trades'].set_index('ticker')
+    assert not trades.loc['A', 'open']
+    assert trades.loc['B', 'open'] and trades.loc['B', 'return'] == pytest.approx(66 / 50 - 1)
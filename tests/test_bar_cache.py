@@ -0,0 +1,82 @@
+import pandas as pd
+from core.bar_cache import BarCache, CachedFetcher, merge_ranges, subtract_ranges
+from core.fetchers import SyntheticFetcher
+
+TICKERS = ['AAA', 'BBB']
+
+
+def day(text:str) -> pd.Timestamp:
+    return pd.Timestamp(text)
+
+
+class RecordingFetcher(SyntheticFetcher):
+    '''SyntheticFetcher recording every (start, end) request; `factor` scales the prices, like a back-adjustment'''
+    def __init__(self):
+        super().__init__(end='2024-06-28')
+        self.requests = list()
+        self.factor = 1.0
+
+    def fetch(self, tickers:list, interval:str, period:str=None, start:str=None, end:str=None) -> pd.DataFrame:
+        self.requests.append((start, end))
+        df = super().fetch(tickers, interval, period=period, start=start, end=end)
+        prices = [col for col in df.columns if col[0] in ('Adj Close', 'Close', 'High', 'Low', 'Open')]
+        df[prices] = df[prices] * self.factor
+        return df
+
+
+def test_merge_ranges_joins_overlapping_and_adjacent_ranges():
+    ranges = [(day('2024-03-10'), day('2024-03-15')), (day('2024-03-01'), day('2024-03-05')),
+              (day('2024-03-05'), day('2024-03-08')), (day('2024-03-12'), day('2024-03-20')),
+              (day('2024-03-25'), day('2024-03-25'))]
+    assert merge_ranges(ranges) == [[day('2024-03-01'), day('2024-03-08')], [day('2024-03-10'), day('2024-03-20')]]
+
+
+def test_subtract_ranges_finds_head_middle_and_tail_gaps():
+    covered = [(day('2024-03-05'), day('2024-03-10')), (day('2024-03-12'), day('2024-03-20'))]
+    window = (day('2024-03-01'), day('2024-03-25'))
+    assert subtract_ranges(window, covered) == [(day('2024-03-01'), day('2024-03-05')),
+                                                (day('2024-03-10'), day('2024-03-12')),
+                                                (day('2024-03-20'), day('2024-03-25'))]
+    assert subtract_ranges((day('2024-03-06'), day('2024-03-09')), covered) == []
+    # coverage ends before the current day, which is never covered: it is always a gap
+    assert subtract_ranges((day('2024-03-13'), day('2024-03-21')), covered) == [(day('2024-03-20'), day('2024-03-21'))]
+
+
+def expected(fetcher:RecordingFetcher) -> pd.DataFrame:
+    '''the bars of the second run's window straight from the provider'''
+    df = fetcher.fetch(TICKERS, '1d', start='2024-04-20', end='2024-05-21')
+    fetcher.requests.pop()
+    return df[df['Date'] < day('2024-05-21')].reset_index(drop=True)
+
+
+def run(fetcher:RecordingFetcher, directory:str, today:str) -> pd.DataFrame:
+    cached = CachedFetcher(fetcher, BarCache(directory), today=today)
+    df = cached.fetch(TICKERS, '1d', period='1mo')
+    cached.close()
+    return df
+
+
+def test_second_run_fetches_the_tail_from_the_newest_cached_day(tmp_path):
+    fetcher = RecordingFetcher()
+    first = run(fetcher, str(tmp_path), '2024-05-15')
+    assert fetcher.requests == [('2024-04-15', '2024-05-16')]
+
+    fetcher.requests.clear()
+    second = run(fetcher, str(tmp_path), '2024-05-20')
+    # 2024-05-14 is the newest cached day before the still forming 2024-05-15
+    assert fetcher.requests == [('2024-05-14', '2024-05-21')]
+    direct = expected(fetcher)
+    pd.testing.assert_frame_equal(second.reset_index(drop=True), direct, check_freq=False, check_names=False)
+    assert first['Date'].iloc[-1] < second['Date'].iloc[-1]
+
+
+def test_back_adjusted_history_is_fetched_again(tmp_path):
+    fetcher = RecordingFetcher()
+    run(fetcher, str(tmp_path), '2024-05-15')
+    fetcher.requests.clear()
+    fetcher.factor = 0.5
+    second = run(fetcher, str(tmp_path), '2024-05-20')
+    # the tail disagrees on 2024-05-14, so the whole window is requested again
+    assert fetcher.requests == [('2024-05-14', '2024-05-21'), ('2024-04-20', '2024-05-21')]
+    direct = expected(fetcher)
+    pd.testing.assert_frame_equal(second.reset_index(drop=True), direct, check_freq=False, check_names=False)
@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import pytest
+from benchmarks.universe import SyntheticUniverse
+from core import kernels
+from core.indicators import Indicators
+
+
+def loop_crossovers(close:np.ndarray, line:np.ndarray, period:int):
+    '''the per bar loop Indicators.calculate_supertrend used before the crossovers were vectorized'''
+    buys, sells = np.zeros(len(close)), np.zeros(len(close))
+    for i in range(period - 1, len(close)):
+        if close[i - 1] <= line[i - 1] and close[i] > line[i]:
+            buys[i] = 1.0
+        if close[i - 1] >= line[i - 1] and close[i] < line[i]:
+            sells[i] = 1.0
+    return buys, sells
+
+
+def ticker_frames(n_tickers:int=5, n_bars:int=300) -> list:
+    history = SyntheticUniverse(n_tickers, n_bars).history_frame()
+    return [frame.reset_index(drop=True) for _, frame in history.groupby('ticker')]
+
+
+def with_ties(close:np.ndarray, line:np.ndarray) -> np.ndarray:
+    '''close equal to the line on every 7th bar, so <= / >= see exact ties'''
+    close = close.copy()
+    ties = np.arange(len(close)) % 7 == 3
+    close[ties & (line == line)] = line[ties & (line == line)]
+    return close
+
+
+@pytest.mark.parametrize('period,multiplier', [(2, 1), (10, 3), (12, 4), (15, 5)])
+def test_crossovers_match_loop(period, multiplier):
+    for frame in ticker_frames():
+        high, low, close = (frame[col].to_numpy()[None, :] for col in ('high', 'low', 'close'))
+        line, _ = kernels.supertrend(high=high, low=low, close=close, length=period, multiplier=multiplier)
+        # the supertrend warm-up is 0.0; a line without a value there (NaN) must give the same flags as the loop
+        nan_warm_up = line[0].copy()
+        nan_warm_up[:period] = np.nan
+        for line_values in (line[0], nan_warm_up):
+            for values in (close[0], with_ties(close[0], line_values)):
+                expected = loop_crossovers(values, line_values, period)
+                buys, sells = kernels.crossovers(close=values, line=line_values, start=period - 1)
+                assert np.array_equal(buys, expected[0])
+                assert np.array_equal(sells, expected[1])
+
+
+def test_crossovers_batched_rows_match_loop():
+    '''2-D input with a per row warm-up, as calculate_supertrends passes it'''
+    frames = ticker_frames(n_tickers=4, n_bars=120)
+    close = np.vstack([with_ties(f['close'].to_numpy(), f['close'].rolling(5).mean().to_numpy()) for f in frames])
+    line = np.vstack([f['close'].rolling(5).mean().to_numpy() for f in frames])
+    periods = np.array([2, 5, 9, 30])
+    buys, sells = kernels.crossovers(close=close, line=line, start=periods - 1)
+    for row, period in enumerate(periods):
+        expected = loop_crossovers(close[row], line[row], int(period))
+        assert np.array_equal(buys[row], expected[0])
+        assert np.array_equal(sells[row], expected[1])
+
+
+def test_calculate_supertrend_flags_match_loop():
+    indicators = Indicators()
+    for frame in ticker_frames(n_tickers=3):
+        df = indicators.calculate_supertrend(frame.copy(), identifier='short', period=10, multiplier=3)
+        expected = loop_crossovers(df['close'].to_numpy(), df['sup_short'].to_numpy(), 10)
+        assert np.array_equal(df['buy_short'].to_numpy(), expected[0])
+        assert np.array_equal(df['sell_short'].to_numpy(), expected[1])
+        # nothing is flagged during the period - 1 warm-up
+        assert not df[['buy_short', 'sell_short']].iloc[:9].to_numpy().any()
@@ -0,0 +1,11 @@
+from core.data_collector import DataDownloader
+
+
+def test_category_without_data_is_skipped(make_conf):
+    prop_file = make_conf(tickers='<EMPTY>\n<STOCKS>\naapl\nmsft\n')
+    downloader = DataDownloader(prop_file)
+    downloaded = downloader.download(downloader.data_collector())
+    assert list(downloaded) == ['STOCKS']
+    tickers, frame = downloaded['STOCKS']
+    assert tickers == ['aapl', 'msft']
+    assert frame.shape[0] > 0
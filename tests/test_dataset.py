@@ -0,0 +1,64 @@
+from datetime import date
+import numpy as np
+import pandas as pd
+import pytest
+from common.dataset import Dataset, StageTables
+from common.property_reader import PropertyReader
+from common.storage import get_storage
+
+DAY = 86400
+
+
+def bars(tickers:list, start:str, days:int) -> pd.DataFrame:
+    first = int(pd.Timestamp(start, tz='UTC').timestamp())
+    frames = [pd.DataFrame({'ticker': ticker, 'timestamp': first + DAY * np.arange(days, dtype=np.int64),
+                            'close': np.arange(days) + 10. * i}) for i, ticker in enumerate(tickers)]
+    return pd.concat(frames, ignore_index=True)
+
+
+@pytest.fixture
+def dataset(tmp_path) -> Dataset:
+    dataset = Dataset(str(tmp_path), get_storage('parquet'), granularity='M')
+    # January and February hold AAA and BBB, March only CCC
+    dataset.write('indicators', '1d', pd.concat([bars(['AAA', 'BBB'], '2024-01-01', 60),
+                                                 bars(['CCC'], '2024-03-01', 20)], ignore_index=True))
+    return dataset
+
+
+def periods(partitions:list) -> list:
+    return [partition['period'] for partition in partitions]
+
+
+def test_partitions_are_pruned_on_start(dataset):
+    march = int(pd.Timestamp('2024-03-01', tz='UTC').timestamp())
+    _, partitions = dataset.partitions('indicators', '1d')
+    assert periods(partitions) == ['2024-01', '2024-02', '2024-03']
+    _, partitions = dataset.partitions('indicators', '1d', start=march - DAY)
+    assert periods(partitions) == ['2024-02', '2024-03']
+    _, partitions = dataset.partitions('indicators', '1d', start=march)
+    assert periods(partitions) == ['2024-03']
+
+
+def test_partitions_are_pruned_on_tickers(dataset):
+    _, partitions = dataset.partitions('indicators', '1d', tickers=['CCC'])
+    assert periods(partitions) == ['2024-03']
+    _, partitions = dataset.partitions('indicators', '1d', tickers=['AAA', 'ZZZ'])
+    assert periods(partitions) == ['2024-01', '2024-02']
+    _, partitions = dataset.partitions('indicators', '1d', tickers=['ZZZ'])
+    assert partitions == []
+
+
+def test_read_returns_the_selected_bars(dataset):
+    start = int(pd.Timestamp('2024-02-20', tz='UTC').timestamp())
+    df = dataset.read('indicators', '1d', start=start, tickers=['BBB'])
+    assert set(df['ticker']) == {'BBB'}
+    assert df['timestamp'].min() == start and df.shape[0] == 60 - 50
+
+
+@pytest.mark.parametrize('layout', ['files', 'dataset'])
+def test_prepare_and_write_use_the_run_day(make_conf, layout):
+    p_reader = PropertyReader(prop_file=make_conf(**{'saver.layout': layout}))
+    tables = StageTables(p_reader, day=date(2024, 3, 9))
+    prepared = tables.prepare(p_reader.history_startswith)
+    assert '2024_03_09' in prepared
+    assert tables.write(p_reader.history_startswith, bars(['AAA'], '2024-03-01', 5)) == prepared
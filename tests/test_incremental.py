@@ -0,0 +1,32 @@
+import pandas as pd
+import pytest
+import main
+from common.dataset import StageTables
+from common.property_reader import PropertyReader
+from common.schema import Schema
+from core.indicators import IndicatorCalculator
+
+
+def indicator_table(prop_file:str) -> pd.DataFrame:
+    p_reader = PropertyReader(prop_file=prop_file)
+    return StageTables(p_reader, schema=Schema.from_properties(p_reader)).read(p_reader.indicator_startswith)
+
+
+@pytest.mark.parametrize('tickers', ['<STOCKS>\naapl\n', '<STOCKS>\naapl\nmsft\nnvda\n'])
+def test_incremental_runs_twice_on_categorical_tickers(make_conf, tickers):
+    prop_file = make_conf(tickers=tickers, **{'schema.categorical': 'True', 'indicator.incremental': 'True',
+                                              'indicator.incremental.verify': 'True'})
+    main.run(prop_file)
+    first = indicator_table(prop_file)
+    assert isinstance(first['ticker'].dtype, pd.CategoricalDtype)
+
+    # the second run continues from the saved state
+    main.run(prop_file)
+    second = indicator_table(prop_file)
+    assert isinstance(second['ticker'].dtype, pd.CategoricalDtype)
+    assert second.shape == first.shape
+
+    # same columns as a full recompute of the history
+    full = IndicatorCalculator(make_conf(tickers=tickers, **{'schema.categorical': 'True'}))
+    expected, _ = full.compute(full.tables.read(full.p_reader.history_startswith))
+    pd.testing.assert_frame_equal(second[expected.columns], expected, check_exact=True)
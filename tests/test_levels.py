@@ -0,0 +1,33 @@
+import numpy as np
+from benchmarks.universe import SyntheticUniverse
+from core import kernels
+
+
+def rows(n_tickers:int=4, n_bars:int=400):
+    history = SyntheticUniverse(n_tickers, n_bars).history_frame()
+    frames = [frame for _, frame in history.groupby('ticker')]
+    return (np.vstack([frame['low'].to_numpy() for frame in frames]),
+            np.vstack([frame['high'].to_numpy() for frame in frames]))
+
+
+def test_levels_are_set_on_the_confirming_bar():
+    low, high = rows()
+    for window in (2, 3):
+        is_support, is_resistance = kernels.fractal_pivots(low, high, window=window)
+        support, resistance = kernels.support_resistance(low, high, window=window)
+        assert support.any() and resistance.any()
+        for row in range(low.shape[0]):
+            for bar in np.flatnonzero(support[row] == support[row]):
+                assert is_support[row, bar - window] and support[row, bar] == low[row, bar - window]
+            for bar in np.flatnonzero(resistance[row] == resistance[row]):
+                assert is_resistance[row, bar - window] and resistance[row, bar] == high[row, bar - window]
+
+
+def test_levels_do_not_look_ahead():
+    '''the levels of a history are the levels of every prefix of it'''
+    low, high = rows(n_bars=300)
+    support, resistance = kernels.support_resistance(low, high)
+    for cut in (20, 120, 299):
+        prefix = kernels.support_resistance(low[:, :cut], high[:, :cut])
+        np.testing.assert_array_equal(prefix[0], support[:, :cut])
+        np.testing.assert_array_equal(prefix[1], resistance[:, :cut])
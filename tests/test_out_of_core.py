@@ -0,0 +1,62 @@
+import os
+import pandas as pd
+import pytest
+import main
+from common.utilities import Utilities
+from core.indicators import IndicatorCalculator
+
+OVERRIDES = {'schema.categorical': 'True', 'indicator.levels': 'True', 'indicator.signal_index': 'False'}
+TICKERS = '<STOCKS>\n' + '\n'.join(['aapl', 'msft', 'nvda', 'amzn', 'googl', 'meta', 'tsla', 'amd', 'intc', 'csco',
+                                     'orcl', 'adbe', 'crm', 'nflx', 'pypl', 'qcom', 'txn', 'ibm', 'uber', 'shop']) + '\n'
+
+
+def calculate(prop_file:str) -> pd.DataFrame:
+    calculator = IndicatorCalculator(prop_file)
+    calculator.calculate_indicators()
+    return calculator.tables.read(calculator.p_reader.indicator_startswith)
+
+
+@pytest.mark.parametrize('layout,storage_format', [('files', 'jsonl'), ('files', 'parquet'), ('files', 'npy'),
+                                                   ('dataset', 'parquet')])
+def test_out_of_core_equals_in_memory(make_conf, layout, storage_format):
+    settings = dict(OVERRIDES, **{'saver.layout': layout, 'saver.format': storage_format})
+    main.data_downloader(make_conf(tickers=TICKERS, **settings))
+    in_memory = calculate(make_conf(tickers=TICKERS, **settings))
+    calculator = IndicatorCalculator(make_conf(tickers=TICKERS, **dict(settings, **{'indicator.memory.mb': '0.2'})))
+    # several batches of whole tickers
+    assert calculator.batch_rows() < in_memory.shape[0] / 4
+    out_of_core = calculate(make_conf(tickers=TICKERS, **dict(settings, **{'indicator.memory.mb': '0.2'})))
+    pd.testing.assert_frame_equal(out_of_core, in_memory, check_exact=True)
+
+
+def test_failed_batch_leaves_no_partial_table(make_conf, monkeypatch):
+    main.data_downloader(make_conf(tickers=TICKERS, **OVERRIDES))
+    complete = calculate(make_conf(tickers=TICKERS, **OVERRIDES))
+    prop_file = make_conf(tickers=TICKERS, **dict(OVERRIDES, **{'indicator.memory.mb': '0.2'}))
+    calculator = IndicatorCalculator(prop_file)
+    saver_dir = calculator.p_reader.historical_dir
+    latest = Utilities().get_latest_file(saver_dir, calculator.p_reader.indicator_startswith)
+
+    compute = calculator.ema_supertrend_calculator
+    calls = list()
+
+    def failing(df):
+        calls.append(df.shape[0])
+        if len(calls) == 2:
+            raise RuntimeError('batch failed')
+        return compute(df)
+
+    monkeypatch.setattr(calculator, 'ema_supertrend_calculator', failing)
+    with pytest.raises(RuntimeError):
+        calculator.calculate_indicators()
+    assert [name for name in os.listdir(saver_dir) if name.endswith('.tmp')] == []
+    # the table written before the failed run is still the latest one, unchanged
+    assert Utilities().get_latest_file(saver_dir, calculator.p_reader.indicator_startswith) == latest
+    pd.testing.assert_frame_equal(calculator.tables.read(calculator.p_reader.indicator_startswith), complete,
+                                  check_exact=True)
+
+
+def test_latest_file_skips_tmp_tables(tmp_path):
+    for name in ('indicators-2021_03_01', 'indicators-2021_03_02', 'indicators-2021_03_03.tmp'):
+        (tmp_path / name).write_text('')
+    assert Utilities().get_latest_file(str(tmp_path), 'indicators-') == str(tmp_path / 'indicators-2021_03_02')
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import pytest
+from core import resample
+from core.timeframes import MultiTimeframe
+
+
+def bars(times:list) -> pd.DataFrame:
+    dates = pd.DatetimeIndex(times)
+    values = np.arange(len(dates), dtype=float) + 100
+    return pd.DataFrame({'Date': dates, 'Open': values, 'High': values + 1, 'Low': values - 1,
+                         'Close': values + 0.5, 'Volume': np.full(len(dates), 10.)})
+
+
+PRE_MARKET = ['2021-03-01 14:00', '2021-03-01 15:30', '2021-03-02 08:00', '2021-03-02 09:00',
+              '2021-03-02 09:30', '2021-03-02 10:30', '2021-03-02 13:30', '2021-03-02 15:00']
+
+
+def test_pre_market_bars_get_their_own_bucket():
+    dates = pd.DatetimeIndex(PRE_MARKET)
+    for rule in ('1h', '2h', '4h', '1d'):
+        starts, labels = resample.time_bounds(dates, rule=rule, session_start='09:30')
+        bucket = np.searchsorted(starts, np.arange(len(dates)), side='right') - 1
+        # 08:00 and 09:00 of 03-02 share a bucket labelled at midnight, apart from 03-01 and from the session
+        assert bucket[2] == bucket[3]
+        assert bucket[1] != bucket[2] and bucket[3] != bucket[4]
+        assert labels[bucket[2]] == pd.Timestamp('2021-03-02 00:00')
+    _, labels = resample.time_bounds(dates, rule='1d', session_start='09:30')
+    assert list(labels) == [pd.Timestamp('2021-03-01 09:30'), pd.Timestamp('2021-03-02 00:00'),
+                            pd.Timestamp('2021-03-02 09:30')]
+
+
+def test_cascade_matches_aggregate_with_pre_market_bars():
+    times = pd.date_range('2021-03-01 07:00', '2021-03-05 16:00', freq='30min')
+    df = bars(list(times[(times.hour >= 7) & (times.hour < 16)]))
+    rules = ['1h', '2h', '4h', '1d']
+    frames = resample.cascade(df, rules, session_start='09:30')
+    for rule in rules:
+        expected = resample.aggregate(df, *resample.time_bounds(df['Date'], rule, session_start='09:30'))
+        pd.testing.assert_frame_equal(frames[rule].reset_index(drop=True), expected.reset_index(drop=True))
+
+
+def test_rules_longer_than_a_day_are_rejected(make_conf):
+    for rule in ('2d', '1wk', '36h'):
+        with pytest.raises(ValueError):
+            resample.time_bounds(pd.DatetimeIndex(PRE_MARKET), rule=rule)
+    with pytest.raises(ValueError, match='2d'):
+        MultiTimeframe(make_conf(**{'loader.interval': '1h', 'loader.timeframes': "['1h', '4h', '2d']"}))
+    assert MultiTimeframe(make_conf(**{'loader.interval': '1h', 'loader.timeframes': "['1h', '4h', '1d']"})).timeframes \
+        == ['1h', '4h', '1d']
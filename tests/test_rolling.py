@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import pytest
+from core import rolling
+
+
+def padded_rows(n_rows:int=6, n_bars:int=400, seed:int=1) -> (np.ndarray, np.ndarray):
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(1, n_bars + 1, n_rows)
+    lengths[0] = n_bars
+    values = np.full((n_rows, n_bars), np.nan)
+    for i, length in enumerate(lengths):
+        values[i, :length] = 200 + np.cumsum(rng.normal(0, 1, length))
+    values[1, 50] = np.nan
+    values[2, 10:30] = values[2, 10]
+    return values, lengths
+
+
+@pytest.mark.parametrize('window', [1, 5, 20])
+def test_rolling_kernels_match_pandas(window):
+    values, lengths = padded_rows()
+    results = {'sum': rolling.rolling_sum(values, window, lengths=lengths),
+               'mean': rolling.sma(values, window, lengths=lengths),
+               'std': rolling.rolling_std(values, window, ddof=0, lengths=lengths),
+               'max': rolling.rolling_max(values, window, lengths=lengths),
+               'min': rolling.rolling_min(values, window, lengths=lengths)}
+    for i, length in enumerate(lengths):
+        window_of = pd.Series(values[i, :length]).rolling(window)
+        expected = {'sum': window_of.sum(), 'mean': window_of.mean(), 'std': window_of.std(ddof=0),
+                    'max': window_of.max(), 'min': window_of.min()}
+        for name, series in expected.items():
+            np.testing.assert_allclose(results[name][i, :length], series.to_numpy(), rtol=1e-7, atol=1e-9)
+            assert np.isnan(results[name][i, length:]).all()
+        np.testing.assert_array_equal(results['max'][i, :length], expected['max'].to_numpy())
+
+
+def test_vwap_restarts_at_the_session_open():
+    # 10 minute bars of two New York days, from pre-market to after hours (00:00 UTC falls at 20:00 EDT)
+    local = pd.date_range('2021-06-01 07:00', '2021-06-01 21:50', freq='10min').append(
+        pd.date_range('2021-06-02 07:00', '2021-06-02 21:50', freq='10min'))
+    timestamps = local.tz_localize('America/New_York').tz_convert('UTC').asi8 // 10 ** 9
+    rng = np.random.default_rng(2)
+    close = 100 + np.cumsum(rng.normal(0, 0.1, len(local)))
+    high, low, volume = close + 0.2, close - 0.2, rng.integers(100, 1000, len(local)).astype(float)
+
+    sessions = rolling.session_keys(timestamps.astype(float)[None, :], session_start='09:30', timezone='America/New_York')
+    vwap = rolling.session_vwap(high[None, :], low[None, :], close[None, :], volume[None, :], sessions)[0]
+
+    frame = pd.DataFrame({'traded': (high + low + close) / 3 * volume, 'volume': volume,
+                          'session': local.strftime('%Y-%m-%d') + np.where(local.strftime('%H:%M') >= '09:30', 'S', 'P')})
+    grouped = frame.groupby('session', sort=False)
+    expected = grouped['traded'].cumsum() / grouped['volume'].cumsum()
+    np.testing.assert_allclose(vwap, expected.to_numpy(), rtol=1e-12)
+    # the first bar at 09:30 starts over, the bars after 00:00 UTC continue the session
+    opening = np.flatnonzero(local == pd.Timestamp('2021-06-01 09:30'))[0]
+    assert vwap[opening] == pytest.approx((high[opening] + low[opening] + close[opening]) / 3)
+    assert len(np.unique(sessions)) == 4
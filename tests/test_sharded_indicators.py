@@ -0,0 +1,36 @@
+import pandas as pd
+import pytest
+from benchmarks.universe import SyntheticUniverse
+from common.schema import Schema
+from core.indicators import Indicators
+from core.ticker_blocks import TickerBlocks
+
+EMAS = [9, 21, 55]
+SUPERTRENDS = [(10, 3, 'short'), (12, 4, 'medium'), (15, 5, 'long')]
+
+
+def history(n_tickers:int=12, n_bars:int=160) -> pd.DataFrame:
+    df = SyntheticUniverse(n_tickers, n_bars).history_frame()
+    # uneven histories, so the shards hold different numbers of tickers
+    keep = df.groupby('ticker').cumcount(ascending=False) < 40 + 10 * df['ticker'].str[1:].astype(int)
+    return df[keep].reset_index(drop=True)
+
+
+@pytest.mark.parametrize('workers', [2, 3])
+def test_sharded_equals_serial(workers):
+    df = history()
+    indicators = Indicators(schema=Schema(categorical=True, flags='bool'))
+    serial = TickerBlocks(df.copy())
+    indicators.calculate_emas(serial, emas=EMAS)
+    indicators.calculate_supertrends(serial, supertrends=SUPERTRENDS)
+    sharded = indicators.calculate_sharded(TickerBlocks(df.copy()), emas=EMAS, supertrends=SUPERTRENDS, workers=workers)
+    pd.testing.assert_frame_equal(sharded, serial.df, check_exact=True)
+
+
+def test_shards_balance_bars():
+    blocks = TickerBlocks(history())
+    shards = blocks.shards(3)
+    rows = sorted(int(i) for shard in shards for i in shard)
+    assert rows == list(range(len(blocks)))
+    bars = [int(blocks.lengths[shard].sum()) for shard in shards]
+    assert max(bars) - min(bars) <= int(blocks.lengths.max())
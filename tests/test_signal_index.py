@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import pytest
+from core.rules import RuleSet
+from core.signal_index import SignalIndex, SignalIndexBuilder
+
+LAST_BARS = 5
+
+
+def indicator_frame() -> pd.DataFrame:
+    '''AAA: 10 bars, buy_x on bars 1, 6 and 8; BBB: 2 bars, buy_x on both'''
+    aaa = pd.DataFrame({'ticker': 'AAA', 'timestamp': np.arange(10, dtype=np.int64) * 60,
+                        'close': np.arange(10) + 100., 'buy_x': np.isin(np.arange(10), [1, 6, 8]).astype(float)})
+    bbb = pd.DataFrame({'ticker': 'BBB', 'timestamp': np.arange(2, dtype=np.int64) * 60 + 30,
+                        'close': [50., 40.], 'buy_x': [1., 1.]})
+    return pd.concat([aaa, bbb], ignore_index=True)
+
+
+@pytest.fixture
+def index(tmp_path) -> SignalIndex:
+    builder = SignalIndexBuilder(rules=RuleSet([]), last_bars=LAST_BARS)
+    builder.add(indicator_frame())
+    return SignalIndex(builder.save(str(tmp_path / 'signal-index-2024_03_01')))
+
+
+def signals(df:pd.DataFrame) -> list:
+    return list(zip(df['ticker'], df['timestamp'] // 60))
+
+
+def test_postings_are_sorted_by_time(index):
+    timestamps, codes = index.postings('buy_x')
+    assert list(timestamps) == [30, 60, 90, 360, 480]
+    assert list(index.tickers[codes]) == ['BBB', 'AAA', 'BBB', 'AAA', 'AAA']
+
+
+def test_last_keeps_the_signals_of_each_tickers_last_bars(index):
+    # newest first; AAA's last 3 bars are 7..9, BBB has fewer bars than that
+    assert signals(index.screen('buy_x', last=3)) == [('AAA', 8), ('BBB', 1), ('BBB', 0)]
+    assert signals(index.screen('buy_x', last=5)) == [('AAA', 8), ('AAA', 6), ('BBB', 1), ('BBB', 0)]
+    with pytest.raises(ValueError):
+        index.screen('buy_x', last=LAST_BARS + 1)
+
+
+def test_where_on_the_latest_bar(index):
+    df = index.screen('buy_x', where='close > 100')
+    # AAA's latest close is 109, BBB's 40
+    assert signals(df) == [('AAA', 8), ('AAA', 6), ('AAA', 1)]
+    assert list(df['close']) == [109.] * 3
+
+
+def test_where_on_the_signal_bar(index):
+    df = index.screen('buy_x', at='signal', where='close > 45')
+    # the signal bars still in the snapshots: AAA 6 (106) and 8 (108), BBB 0 (50) and 1 (40)
+    assert signals(df) == [('AAA', 8), ('AAA', 6), ('BBB', 0)]
+    assert list(df['close']) == [108., 106., 50.]
+
+
+def test_latest_bars_skip_empty_slots(index):
+    assert list(index.latest_bars('BBB')['close']) == [50., 40.]
+    assert list(index.latest_bars('AAA')['timestamp'] // 60) == [5, 6, 7, 8, 9]
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+from common.storage import get_storage
+
+
+def frame(start:int, rows:int) -> pd.DataFrame:
+    return pd.DataFrame({'ticker': ['T%d' % (i % 3) for i in range(start, start + rows)],
+                         'timestamp': np.arange(start, start + rows, dtype=np.int64),
+                         'close': np.arange(start, start + rows) / 7.})
+
+
+@pytest.mark.parametrize('name', ['parquet', 'npy'])
+def test_columnar_formats_refuse_append(tmp_path, name):
+    storage = get_storage(name)
+    path = str(tmp_path / ('table' + storage.suffix))
+    storage.write(frame(0, 5), path)
+    with pytest.raises(ValueError):
+        storage.write(frame(5, 5), path, append=True)
+    pd.testing.assert_frame_equal(storage.read(path), frame(0, 5))
+
+
+@pytest.mark.parametrize('name', ['jsonl', 'parquet', 'npy'])
+def test_writer_builds_one_table_from_frames(tmp_path, name):
+    storage = get_storage(name)
+    path = str(tmp_path / ('table' + storage.suffix))
+    with storage.writer(path) as writer:
+        for start in range(0, 30, 10):
+            writer.write(frame(start, 10))
+    pd.testing.assert_frame_equal(storage.read(path), frame(0, 30))
+
+
+def test_json_lines_write_non_finite_values_as_null(tmp_path):
+    storage = get_storage('jsonl')
+    path = str(tmp_path / 'table')
+    df = pd.DataFrame({'ticker': ['NaN', 'x: NaN'], 'timestamp': [1, 2], 'close': [np.nan, np.inf]})
+    storage.write(df, path)
+    with open(path) as handler:
+        assert [line.endswith('"close": null}\n') for line in handler] == [True, True]
+    for chunk in storage.iter_chunks(path, chunk_rows=10):
+        # strings holding 'NaN' are left alone, non-finite values come back as NaN
+        assert list(chunk['ticker']) == ['NaN', 'x: NaN']
+        assert chunk['close'].isna().all()
+
+
+def test_json_lines_read_legacy_nan_literals(tmp_path):
+    path = tmp_path / 'table'
+    path.write_text('{"ticker": "A: NaN", "close": NaN}\n{"ticker": "B", "close": Infinity}\n')
+    chunk = next(get_storage('jsonl').iter_chunks(str(path), chunk_rows=10))
+    assert list(chunk['ticker']) == ['A: NaN', 'B']
+    assert np.isnan(chunk['close'].iloc[0]) and chunk['close'].iloc[1] == np.inf
@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+from benchmarks.universe import SyntheticUniverse
+from core.indicators import Indicators
+from core.rules import DEFAULT_RULES, Rule, RuleSet
+from core.streaming import ReplaySource, StreamingEngine
+from core.ticker_blocks import TickerBlocks
+
+EMAS = [9, 21, 55, 100]
+SUPERTRENDS = [(10, 3, 'short'), (12, 4, 'medium'), (15, 5, 'long')]
+RULES = DEFAULT_RULES + [
+    # high - low is 0 on flat bars, so the division sees zero divisors
+    ('ratio', 'buy_short > 0 and close / ema9 > 1', 'sell_short > 0 or (close - ema21) / (high - low) < -3',
+     ['close', 'ema9', 'ema21'])]
+
+
+def batch_signals(history:pd.DataFrame, rules:RuleSet) -> set:
+    indicators = Indicators()
+    blocks = TickerBlocks(history)
+    indicators.calculate_emas(blocks, EMAS)
+    df = indicators.calculate_supertrends(blocks, SUPERTRENDS)
+    signals = set()
+    for name, (buy, sell) in rules.evaluate(df).items():
+        for side, mask in (('BUY', buy), ('SELL', sell)):
+            for ticker, timestamp in zip(df['ticker'][mask], df['timestamp'][mask]):
+                signals.add((ticker, int(timestamp), name, side))
+    return signals
+
+
+def test_streaming_signals_match_batch():
+    history = SyntheticUniverse(4, 400).history_frame()
+    # flat bars on every 13th row
+    flat = np.arange(history.shape[0]) % 13 == 5
+    for col in ('open', 'high', 'low'):
+        history.loc[flat, col] = history.loc[flat, 'close']
+    rules = RuleSet(RULES)
+    engine = StreamingEngine(EMAS, SUPERTRENDS, rules)
+    streamed = list()
+    engine.run(ReplaySource(table=history), streamed.append)
+    expected = batch_signals(history, rules)
+    assert len(expected) > 0
+    assert {(s['ticker'], int(s['timestamp']), s['rule'], s['side']) for s in streamed} == expected
+
+
+def test_division_by_zero_does_not_raise_on_a_bar():
+    rule = Rule('ratio', 'close / volume > 1', '(close - open) / (high - low) < 0', ['close'])
+    bar = {'close': 10., 'volume': 0., 'open': 10., 'high': 10., 'low': 10.}
+    # 10 / 0 is inf, 0 / 0 is NaN: the same as the column-wise evaluation
+    assert rule.evaluate_bar(bar) == (True, False)
+    buy, sell = RuleSet([rule]).evaluate(pd.DataFrame([bar]))['ratio']
+    assert (bool(buy[0]), bool(sell[0])) == (True, False)
+
+
+def test_rules_on_columns_streaming_does_not_compute_are_rejected():
+    rules = RuleSet([('bands', 'close > bb_mid_20', 'close < ema9', ['close', 'bb_mid_20'])])
+    with pytest.raises(ValueError, match='bb_mid_20'):
+        StreamingEngine(EMAS, SUPERTRENDS, rules)
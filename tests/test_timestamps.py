@@ -0,0 +1,30 @@
+from datetime import datetime
+import pandas as pd
+from common.chunked_reader import ChunkedReader
+from common.storage import get_storage
+from common.timestamps import to_epoch
+from core.strategies import Strategies
+
+
+def test_legacy_strings_are_exchange_local_times():
+    # 09:30 New York is 14:30 UTC in winter and 13:30 UTC in summer
+    epochs = to_epoch(['2024 01 02 09:30:00', '2024 07 01 09:30:00'], timezone='America/New_York')
+    assert list(epochs) == [int(pd.Timestamp('2024-01-02 14:30', tz='UTC').timestamp()),
+                            int(pd.Timestamp('2024-07-01 13:30', tz='UTC').timestamp())]
+    # without a timezone they stay UTC, as before
+    assert to_epoch(['2024 01 02 09:30:00'])[0] == int(pd.Timestamp('2024-01-02 09:30', tz='UTC').timestamp())
+
+
+def test_reader_localizes_legacy_files(tmp_path):
+    storage = get_storage('jsonl')
+    path = str(tmp_path / 'history.jsonl')
+    storage.write(pd.DataFrame({'ticker': ['A'], 'timestamp': ['2024 03 15 16:00:00'], 'close': [1.]}), path)
+    df = ChunkedReader(path, timezone='America/New_York').read()
+    assert df['timestamp'].iloc[0] == int(pd.Timestamp('2024-03-15 16:00', tz='America/New_York').timestamp())
+
+
+def test_cutoff_is_built_in_the_exchange_timezone(make_conf):
+    strategies = Strategies(make_conf(**{'strategy.last.intervals': '2'}))
+    cutoff = strategies.cutoff(datetime(2024, 3, 20, 9, 30))
+    assert cutoff == pd.Timestamp('2024-03-17 09:30', tz='America/New_York')
+    assert to_epoch(pd.DatetimeIndex([cutoff]))[0] == int(pd.Timestamp('2024-03-17 13:30', tz='UTC').timestamp())